@@ -0,0 +1,150 @@
+"""
+Compares maximal marginal relevance search of LangChain, which Chroma runs through its
+max_marginal_relevance_search, with the native mmr of the retriever over Chroma and over
+the NumPy backend. Reports query latency, time of the diversity selection alone and
+how often the native mmr selects the same documents as LangChain. Random vectors stand
+in for the embeddings like in vector_backends.py, so GPT4All is not needed.
+
+Usage:
+  python benchmarks/mmr.py [<num_vectors>] [<dim>] [<num_queries>] [<fetch_k>]
+"""
+
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import numpy as np
+from vector_backends import RandomEmbeddings, make_queries
+
+TOP_K = 4
+LAMBDA_MULT = 0.5
+
+
+def measure(search: Callable[[str], list[str]], queries: list[str]) -> dict:
+    latencies = []
+    results = []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        "latency_p50_ms": 1000 * latencies[len(latencies) // 2],
+        "latency_p95_ms": 1000 * latencies[int(0.95 * len(latencies))],
+        "latency_mean_ms": 1000 * statistics.fmean(latencies),
+        "results": results,
+    }
+
+
+def selection_ms(fetch_k: int, dim: int, repeats: int = 200) -> tuple[float, float]:
+    """Mean time of the diversity selection alone over the same candidates."""
+
+    from langchain_community.vectorstores.utils import maximal_marginal_relevance
+
+    from mulmod.retrieve.numpy_store import mmr, normalize
+
+    rng = np.random.default_rng(0)
+    vectors = normalize(rng.standard_normal((fetch_k, dim))).astype(np.float32)
+    query = normalize(rng.standard_normal((1, dim)))[0].astype(np.float32)
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        maximal_marginal_relevance(query, vectors, LAMBDA_MULT, TOP_K)
+    langchain_ms = 1000 * (time.perf_counter() - start) / repeats
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        mmr(vectors @ query, vectors, TOP_K, LAMBDA_MULT)
+    native_ms = 1000 * (time.perf_counter() - start) / repeats
+
+    return langchain_ms, native_ms
+
+
+def main() -> None:
+    from langchain_community.vectorstores.chroma import Chroma
+
+    from mulmod.retrieve.custom_vector import chroma_max_marginal_relevance_with_score
+    from mulmod.retrieve.numpy_store import NumpyVectorStore, normalize
+
+    num_vectors = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 384
+    num_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    fetch_k = int(sys.argv[4]) if len(sys.argv) > 4 else 20
+
+    embeddings = RandomEmbeddings(dim)
+    texts = [f"chunk {i}" for i in range(num_vectors)]
+    ids = [str(i) for i in range(num_vectors)]
+    queries = make_queries(num_vectors, num_queries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        chroma = Chroma(
+            collection_name="benchmark",
+            embedding_function=embeddings,
+            collection_metadata={"hnsw:space": "cosine"},
+            persist_directory=directory,
+        )
+        numpy_store = NumpyVectorStore(embedding=embeddings)
+        for start in range(0, num_vectors, 1000):
+            chroma.add_texts(texts[start : start + 1000], ids=ids[start : start + 1000])
+            numpy_store.add_texts(
+                texts[start : start + 1000], ids=ids[start : start + 1000]
+            )
+
+        reports = {
+            "langchain chroma": measure(
+                lambda q: [
+                    d.page_content
+                    for d in chroma.max_marginal_relevance_search(
+                        q, k=TOP_K, fetch_k=fetch_k, lambda_mult=LAMBDA_MULT
+                    )
+                ],
+                queries,
+            ),
+            "native chroma": measure(
+                lambda q: [
+                    d.page_content
+                    for d, _ in chroma_max_marginal_relevance_with_score(
+                        chroma, embeddings.embed_query(q), TOP_K, fetch_k, LAMBDA_MULT
+                    )
+                ],
+                queries,
+            ),
+            "native numpy": measure(
+                lambda q: [
+                    d.page_content
+                    for d, _ in numpy_store.max_marginal_relevance_search_with_score_by_vector(
+                        normalize(np.asarray([embeddings.embed_query(q)]))[0],
+                        TOP_K,
+                        fetch_k,
+                        LAMBDA_MULT,
+                    )
+                ],
+                queries,
+            ),
+        }
+
+    reference = reports["langchain chroma"]["results"]
+    for name, report in reports.items():
+        # langchain keeps the selected documents in the order of their similarity,
+        # numpy selects from exact candidates, chroma from approximate ones of hnsw
+        agreement = statistics.fmean(
+            set(r) == set(e) for r, e in zip(report["results"], reference)
+        )
+        print(
+            f"{name:>16}: query p50 {report['latency_p50_ms']:.2f}ms "
+            f"p95 {report['latency_p95_ms']:.2f}ms mean {report['latency_mean_ms']:.2f}ms, "
+            f"same selection as langchain {agreement:.3f}"
+        )
+
+    langchain_ms, native_ms = selection_ms(fetch_k, dim)
+    print(
+        f"selection of {TOP_K} of {fetch_k} candidates: langchain {langchain_ms:.3f}ms, "
+        f"native {native_ms:.3f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""
+Compares the Chroma, NumPy and quantized vector backends of the retriever on build time, query
+latency and peak resident memory. Every backend runs in its own process, so the memory
+of one does not count for the other. Random vectors stand in for the embeddings, so
+GPT4All is not needed, and every query is a noisy copy of one of the chunks, so it has
+a true neighbour like a real query would. Chunks carry texts and metadata of the size
+of the real ones, so their memory is counted too.
+
+Usage:
+  python benchmarks/vector_backends.py [<num_vectors>] [<dim>] [<num_queries>]
+"""
+
+import hashlib
+import multiprocessing
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+TOP_K = 3
+# characters of a chunk text, like a text chunk of the extractor
+TEXT_CHARS = 800
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RandomEmbeddings(Embeddings):
+    """
+    Deterministic random vectors seeded by the hash of the name of the text, the part
+    before ":". Query "query <i> near chunk <j>" is the vector of "chunk <j>" with added
+    noise.
+    """
+
+    def __init__(self, dim: int, noise: float = 1.5) -> None:
+        self.dim = dim
+        self.noise = noise
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.vector(t).tolist() for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        _, near = text.split(" near ")
+        return (self.vector(near) + self.noise * self.vector(text)).tolist()
+
+    def vector(self, text: str) -> np.ndarray:
+        name = text.split(":", 1)[0]
+        seed = int.from_bytes(hashlib.sha256(name.encode("utf-8")).digest()[:4], "big")
+        return np.random.default_rng(seed).standard_normal(self.dim)
+
+
+def make_chunks(start: int, end: int) -> tuple[list[str], list[dict[str, str | int]]]:
+    """
+    Texts named "chunk <i>: ..." of random words and metadata like of the index. They
+    are made batch by batch, so only the store keeps them in memory like in the index.
+    """
+
+    rng = np.random.default_rng(start)
+    words = [
+        "".join(rng.choice(list("etaoinshrdlu"), size=rng.integers(2, 10)))
+        for _ in range(2000)
+    ]
+    texts = []
+    metadatas = []
+    for i in range(start, end):
+        text = f"chunk {i}:"
+        while len(text) < TEXT_CHARS:
+            text += " " + " ".join(rng.choice(words, size=20))
+        texts.append(text[:TEXT_CHARS])
+        metadatas.append(
+            {
+                "source": f"./resources/corpus/document-{i // 500}.pdf",
+                "page_number": i // 5 % 100 + 1,
+                "doc_id": hashlib.sha256(str(i).encode("utf-8")).hexdigest(),
+            }
+        )
+    return texts, metadatas
+
+
+def make_queries(num_vectors: int, num_queries: int) -> list[str]:
+    return [
+        f"query {i} near chunk {i * 7919 % num_vectors}" for i in range(num_queries)
+    ]
+
+
+def run(
+    backend: str, num_vectors: int, dim: int, num_queries: int
+) -> dict[str, float | list[list[str]]]:
+    from langchain_community.vectorstores.chroma import Chroma
+
+    from mulmod.retrieve.numpy_store import NumpyVectorStore
+    from mulmod.retrieve.quantized_store import QuantizedVectorStore
+
+    embeddings = RandomEmbeddings(dim)
+    queries = make_queries(num_vectors, num_queries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        rss_start = peak_rss_mb()
+        start = time.perf_counter()
+
+        if backend == "chroma":
+            store = Chroma(
+                collection_name="benchmark",
+                embedding_function=embeddings,
+                collection_metadata={"hnsw:space": "cosine"},
+                persist_directory=directory,
+            )
+        elif backend == "numpy":
+            store = NumpyVectorStore(embedding=embeddings, persist_directory=directory)
+        else:
+            store = QuantizedVectorStore(
+                embedding=embeddings, persist_directory=directory, quantization=backend
+            )
+
+        for batch in range(0, num_vectors, 1000):
+            end = min(batch + 1000, num_vectors)
+            texts, metadatas = make_chunks(batch, end)
+            store.add_texts(
+                texts, metadatas=metadatas, ids=[str(i) for i in range(batch, end)]
+            )
+        build_s = time.perf_counter() - start
+
+        latencies = []
+        results = []
+        for query in queries:
+            start = time.perf_counter()
+            docs = store.similarity_search_with_score(query, k=TOP_K)
+            latencies.append(time.perf_counter() - start)
+            results.append([d.page_content.split(":", 1)[0] for d, _ in docs])
+
+        latencies.sort()
+        return {
+            "build_s": build_s,
+            "latency_p50_ms": 1000 * latencies[len(latencies) // 2],
+            "latency_p95_ms": 1000 * latencies[int(0.95 * len(latencies))],
+            "latency_mean_ms": 1000 * statistics.fmean(latencies),
+            "rss_mb": peak_rss_mb() - rss_start,
+            "results": results,
+        }
+
+
+def exact_results(num_vectors: int, dim: int, num_queries: int) -> list[list[str]]:
+    """Top-k of every query by float32 brute force, the reference of the recall."""
+
+    embeddings = RandomEmbeddings(dim)
+    vectors = np.asarray(
+        embeddings.embed_documents([f"chunk {i}" for i in range(num_vectors)])
+    )
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    results = []
+    for query_text in make_queries(num_vectors, num_queries):
+        query = np.asarray(embeddings.embed_query(query_text))
+        top = np.argsort(-(vectors @ query))[:TOP_K]
+        results.append([f"chunk {t}" for t in top])
+    return results
+
+
+def main() -> None:
+    num_vectors = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    dim = int(sys.argv[2]) if len(sys.argv) > 2 else 384
+    num_queries = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+    context = multiprocessing.get_context("spawn")
+    reports = {}
+    for backend in ("chroma", "numpy", "int8", "binary"):
+        with context.Pool(1) as pool:
+            reports[backend] = pool.apply(run, (backend, num_vectors, dim, num_queries))
+
+    exact = exact_results(num_vectors, dim, num_queries)
+    for backend, report in reports.items():
+        found = sum(len(set(r) & set(e)) for r, e in zip(report["results"], exact))
+        recall = found / sum(len(e) for e in exact)
+        print(
+            f"{backend:>6}: build {report['build_s']:.2f}s, query p50 "
+            f"{report['latency_p50_ms']:.2f}ms p95 {report['latency_p95_ms']:.2f}ms "
+            f"mean {report['latency_mean_ms']:.2f}ms, peak rss +{report['rss_mb']:.0f}MB, "
+            f"recall@{TOP_K} {recall:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+COMPLETE_MARKER = ".complete"
+
+
+def hash_file(filepath: str, chunk_size: int = 1 << 20) -> str:
+    """Returns sha256 hex digest of the file content."""
+
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_params(*parts: Any) -> str:
+    """Returns sha256 hex digest of json serializable parameters."""
+
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class ArtifactCache:
+    """
+    On-disk content-addressed cache for outputs of the ingestion stages.
+
+    Every artifact is stored under `<cache_dir>/<stage>/<key>`. The key of a stage is
+    a hash of its parameters and of the keys of the stages it depends on, so changing
+    one parameter invalidates only the stages downstream of it.
+
+    Attributes:
+    cache_dir:
+        Root directory of the cache. If None the cache is disabled, loads always miss
+        and saves are no-ops.
+    """
+
+    cache_dir: str | None = "./resources/cache"
+
+    @property
+    def enabled(self) -> bool:
+        return self.cache_dir is not None
+
+    def path(self, stage: str, key: str) -> str:
+        return os.path.join(str(self.cache_dir), stage, key)
+
+    def load(self, stage: str, key: str) -> Any | None:
+        """Loads json artifact of a stage. Returns None on a miss."""
+
+        if not self.enabled:
+            return None
+
+        path = self.path(stage, key) + ".json"
+        if not os.path.exists(path):
+            logger.info(f"Cache miss for stage {stage}.")
+            return None
+
+        with open(path, encoding="utf-8") as f:
+            logger.info(f"Cache hit for stage {stage}.")
+            return json.load(f)
+
+    def save(self, stage: str, key: str, data: Any) -> None:
+        """Atomically writes json artifact of a stage."""
+
+        if not self.enabled:
+            return
+
+        path = self.path(stage, key) + ".json"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def is_complete(self, stage: str, key: str) -> bool:
+        """Checks whether a directory artifact of a stage was fully written."""
+
+        if not self.enabled:
+            return False
+
+        return os.path.exists(os.path.join(self.path(stage, key), COMPLETE_MARKER))
+
+    def stage_dir(
+        self, stage: str, key: str, base_key: str | None = None
+    ) -> str | None:
+        """
+        Returns a directory for a directory artifact of a stage. Leftovers of an
+        interrupted run are removed so the stage starts from scratch, or from a copy
+        of the complete artifact of `base_key`, e.g. to update an index.
+        """
+
+        if not self.enabled:
+            return None
+
+        path = self.path(stage, key)
+        if not self.is_complete(stage, key):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            if base_key is not None and self.is_complete(stage, base_key):
+                shutil.copytree(
+                    self.path(stage, base_key),
+                    path,
+                    ignore=shutil.ignore_patterns(COMPLETE_MARKER),
+                )
+        os.makedirs(path, exist_ok=True)
+
+        return path
+
+    def mark_complete(self, stage: str, key: str) -> None:
+        if not self.enabled:
+            return
+
+        open(os.path.join(self.path(stage, key), COMPLETE_MARKER), "w").close()
+
+
+@dataclass
+class TieredCache:
+    """
+    Two tier cache of generated strings keyed by a hash of everything that influences
+    them, e.g. summaries by the content or image bytes, prompts, model and generation
+    parameters. It also keeps the encoded image payloads and embeddings.
+
+    The first tier is an in-process LRU, the second are files on disk which are
+    evicted from the least recently used when their size exceeds the cap. It is
+    safe to use from multiple threads.
+
+    Attributes:
+    label:
+        Name of the cached values in the logs and the prefix of the stats keys.
+    cache_dir:
+        Directory of the disk tier. If None only the in-process tier is used.
+    max_items:
+        Maximum number of values in the in-process tier.
+    max_disk_mb:
+        Size cap of the disk tier.
+    """
+
+    label: str = "summaries"
+    cache_dir: str | None = "./resources/cache/summaries"
+    max_items: int = 4096
+    max_disk_mb: float = 256
+
+    def __post_init__(self) -> None:
+        self.memory: OrderedDict[str, str] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.disk_bytes = 0
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.disk_bytes = sum(size for _, _, size in self.disk_entries())
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    def stats(self) -> dict[str, int]:
+        return {
+            f"{self.label}_memory_hits": self.memory_hits,
+            f"{self.label}_disk_hits": self.disk_hits,
+            f"{self.label}_misses": self.misses,
+            f"{self.label}_memory_items": len(self.memory),
+            f"{self.label}_disk_bytes": self.disk_bytes,
+        }
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return self.memory[key]
+
+        value = self.load(key)
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.disk_hits += 1
+            self.remember(key, value)
+            return value
+
+    def put(self, key: str, value: str) -> None:
+        with self.lock:
+            self.remember(key, value)
+
+        self.store(key, value)
+
+    def remember(self, key: str, value: str) -> None:
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def path(self, key: str) -> str:
+        return os.path.join(str(self.cache_dir), key[:2], key + ".txt")
+
+    def load(self, key: str) -> str | None:
+        if self.cache_dir is None:
+            return None
+
+        path = self.path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+
+        # modification time orders the entries for eviction
+        os.utime(path)
+        return value
+
+    def store(self, key: str, value: str) -> None:
+        if self.cache_dir is None:
+            return
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(value)
+        size = os.path.getsize(tmp_path)
+        if os.path.exists(path):
+            size -= os.path.getsize(path)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.disk_bytes += size
+            if self.disk_bytes > self.max_disk_mb * 2**20:
+                self.evict()
+
+    def evict(self) -> None:
+        """Removes least recently used files until the disk tier is at 90% of the cap."""
+
+        entries = sorted(self.disk_entries())
+        target = 0.9 * self.max_disk_mb * 2**20
+        total = sum(size for _, _, size in entries)
+
+        removed = 0
+        for _, path, size in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+
+        self.disk_bytes = total
+        logger.info(f"Evicted {removed} {self.label} from the disk cache.")
+
+    def disk_entries(self) -> list[tuple[float, str, int]]:
+        """Returns (modification time, path, size) of every value on disk."""
+
+        entries = []
+        for dirpath, _, filenames in os.walk(str(self.cache_dir)):
+            for filename in filenames:
+                if not filename.endswith(".txt"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
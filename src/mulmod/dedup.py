@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+from typing import Any
+
+from mulmod.extract import Extraction
+from mulmod.img import get_img_dhash, get_img_stats, hamming_distance
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class ImageFilter:
+    """
+    Filters extracted images before they are summarized. Tiny icons and nearly
+    uniform ornaments are dropped, and near-duplicates (e.g. a logo repeated on
+    every page) are grouped by perceptual hashes so only the first image of a group
+    is kept. The dropped duplicates are returned separately with the path of the
+    kept image in `metadata["duplicate_of"]`, so their pages can be mapped to its
+    retrieval entry. The kept image is never changed, it may be indexed already.
+
+    The filter remembers the kept images until `reset`, so duplicates are found
+    across the windows of a streaming extraction too.
+
+    Attributes:
+    min_width:
+        Images narrower than this many pixels are dropped.
+    min_height:
+        Images lower than this many pixels are dropped.
+    min_entropy:
+        Images whose grayscale entropy in bits is lower are dropped.
+    max_distance:
+        Images whose hashes differ in at most this many of the 64 bits are
+        duplicates.
+    """
+
+    min_width: int = 48
+    min_height: int = 48
+    min_entropy: float = 1.0
+    max_distance: int = 6
+
+    def __post_init__(self) -> None:
+        self.reset()
+
+    def reset(self) -> None:
+        self.kept: list[tuple[int, Extraction]] = []
+
+    def cache_params(self) -> dict[str, Any]:
+        """Parameters which influence the filtered images."""
+
+        return {
+            "min_width": self.min_width,
+            "min_height": self.min_height,
+            "min_entropy": self.min_entropy,
+            "max_distance": self.max_distance,
+            "separate_duplicates": True,
+        }
+
+    def filter(
+        self, images: list[Extraction]
+    ) -> tuple[list[Extraction], list[Extraction]]:
+        """
+        Returns the images worth summarizing, one per group of duplicates, and the
+        dropped duplicates.
+        """
+
+        filtered = []
+        duplicates = []
+        num_small = 0
+
+        for image in images:
+            stats = get_img_stats(image.content)
+            if (
+                stats["width"] < self.min_width
+                or stats["height"] < self.min_height
+                or stats["entropy"] < self.min_entropy
+            ):
+                num_small += 1
+                continue
+
+            dhash = get_img_dhash(image.content)
+            original = self.find(dhash)
+            if original is not None:
+                image.metadata["duplicate_of"] = original.content
+                duplicates.append(image)
+                continue
+
+            self.kept.append((dhash, image))
+            filtered.append(image)
+
+        if num_small or duplicates:
+            logger.info(
+                f"Dropped {num_small} small or blank images and {len(duplicates)} duplicates, kept {len(filtered)} images."
+            )
+
+        return filtered, duplicates
+
+    def find(self, dhash: int) -> Extraction | None:
+        """Returns the closest kept image within `max_distance` of the hash."""
+
+        best = None
+        best_distance = self.max_distance + 1
+        for kept_hash, image in self.kept:
+            distance = hamming_distance(dhash, kept_hash)
+            if distance < best_distance:
+                best, best_distance = image, distance
+
+        return best
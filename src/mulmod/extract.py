@@ -1,13 +1,30 @@
+import gc
+import hashlib
+import multiprocessing
 import os
-from dataclasses import dataclass
+import resource
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field, replace
 from enum import Enum
 from pathlib import Path
+from typing import Any, Iterator
 
 from pydantic import BaseModel
-from unstructured.documents.elements import CompositeElement, Element, Table
+from pypdf import PdfReader, PdfWriter
+from unstructured.chunking.title import chunk_by_title
+from unstructured.documents.elements import (
+    CompositeElement,
+    Element,
+    FigureCaption,
+    Image,
+    Table,
+)
 from unstructured.partition.pdf import partition_pdf
 
 from mulmod.logger import get_logger
+from mulmod.router import HI_RES, PageRouter
 
 logger = get_logger(__name__)
 
@@ -28,10 +45,14 @@ class Extraction(BaseModel):
         content (str):
             Content of the extraction. If the type is IMAGE then the content is path
             to that image.
+        metadata (dict[str, Any]):
+            Additional information about the extraction, e.g. caption of an image or
+            the page it starts on.
     """
 
     type: ExtractionType
     content: str
+    metadata: dict[str, Any] = {}
 
 
 @dataclass
@@ -39,6 +60,27 @@ class Extractions:
     texts: list[Extraction]
     tables: list[Extraction]
     images: list[Extraction]
+    # images dropped as duplicates of kept ones, they are not summarized
+    duplicates: list[Extraction] = field(default_factory=list)
+
+    def to_dict(self) -> dict[str, list[dict[str, Any]]]:
+        return {
+            "texts": [e.model_dump(mode="json") for e in self.texts],
+            "tables": [e.model_dump(mode="json") for e in self.tables],
+            "images": [e.model_dump(mode="json") for e in self.images],
+            "duplicates": [e.model_dump(mode="json") for e in self.duplicates],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, list[dict[str, Any]]]) -> "Extractions":
+        return cls(
+            texts=[Extraction.model_validate(e) for e in data["texts"]],
+            tables=[Extraction.model_validate(e) for e in data["tables"]],
+            images=[Extraction.model_validate(e) for e in data["images"]],
+            duplicates=[
+                Extraction.model_validate(e) for e in data.get("duplicates", [])
+            ],
+        )
 
 
 @dataclass
@@ -55,6 +97,16 @@ class PdfExtractor:
         Threshold for combining text chunks.
     img_dir:
         Directory to store extracted images.
+    num_workers:
+        Number of worker processes partitioning page ranges in parallel. With 1
+        the whole document is partitioned in the current process.
+    pages_per_task:
+        Number of pages partitioned by a worker at once.
+    router:
+        If set, pages with a clean text layer are partitioned with the fast strategy
+        and only the rest with hi_res.
+    max_memory_mb:
+        Ceiling on the resident memory respected by the streaming extraction.
     """
 
     max_characters: int = 1000
@@ -63,6 +115,23 @@ class PdfExtractor:
 
     base_img_dir: str = "./resources/figs"
 
+    num_workers: int = 1
+    pages_per_task: int = 8
+    router: PageRouter | None = None
+    max_memory_mb: int | None = None
+
+    def cache_params(self) -> dict[str, Any]:
+        """Parameters which influence the extraction output."""
+
+        return {
+            "max_characters": self.max_characters,
+            "new_after_n_chars": self.new_after_n_chars,
+            "combine_text_under_n_chars": self.combine_text_under_n_chars,
+            "router": self.router.cache_params() if self.router else None,
+            "image_captions": True,
+            "page_numbers": True,
+        }
+
     def extract(self, filepath: str) -> Extractions:
         """
         Extracts texts, tables, images from the PDF document.
@@ -77,31 +146,232 @@ class PdfExtractor:
         """
         logger.info(f"Started extraction on {filepath}.")
 
-        self.img_dir = os.path.join(self.base_img_dir, Path(filepath).stem)
+        self.img_dir = self.image_dir(filepath)
+        # images of a previous extraction would be listed together with the new ones
+        shutil.rmtree(self.img_dir, ignore_errors=True)
 
-        pdf_elements: list[Element] = partition_pdf(
-            filename=filepath,
-            strategy="hi_res",
-            extract_images_in_pdf=True,
-            infer_table_structure=True,
-            chunking_strategy="by_title",
+        if self.router is not None or self.num_workers > 1:
+            pdf_elements = self.partition_ranges(filepath, self.page_tasks(filepath))
+        else:
+            pdf_elements = partition_pages(filepath, self.img_dir)
+
+        chunks = chunk_by_title(
+            pdf_elements,
             max_characters=self.max_characters,
             new_after_n_chars=self.new_after_n_chars,
             combine_text_under_n_chars=self.combine_text_under_n_chars,
-            extract_image_block_output_dir=self.img_dir,
         )
 
-        texts, tables = PdfExtractor.categorize(pdf_elements)
+        texts, tables = PdfExtractor.categorize(chunks)
+        images = PdfExtractor.get_imgs(
+            self.img_dir, image_captions(pdf_elements), image_pages(pdf_elements)
+        )
 
         logger.info(
-            f"Extracted {len(texts)} texts, {len(tables)} tables and {len(os.listdir(self.img_dir))} images."
+            f"Extracted {len(texts)} texts, {len(tables)} tables and {len(images)} images."
         )
         logger.info(f"The extracted images are in {self.img_dir}")
 
-        images = PdfExtractor.get_imgs(self.img_dir)
-
         return Extractions(texts=texts, tables=tables, images=images)
 
+    def iter_extract(self, filepath: str) -> Iterator[Extractions]:
+        """
+        Extracts the PDF document one window of pages at a time, so only elements
+        and rasterized pages of the current window are held in memory. The window
+        shrinks when the resident memory exceeds `max_memory_mb` and grows back up
+        to `pages_per_task` pages when there is room again.
+
+        Parameters:
+            filepath (str):
+                Path to the PDF file.
+
+        Yields:
+            Extractions:
+                Extracted elements of a single window of pages.
+        """
+        logger.info(f"Started streaming extraction on {filepath}.")
+
+        self.img_dir = self.image_dir(filepath)
+        # images of a previous extraction would be listed together with the new ones
+        shutil.rmtree(self.img_dir, ignore_errors=True)
+
+        strategies = self.page_strategies(filepath)
+        window = self.pages_per_task
+
+        start = 0
+        while start < len(strategies):
+            end = start + 1
+            while (
+                end < len(strategies)
+                and end - start < window
+                and strategies[end] == strategies[start]
+            ):
+                end += 1
+
+            window_img_dir = os.path.join(
+                self.img_dir, f"pages-{start + 1:05d}-{end:05d}"
+            )
+            elements = partition_pages(
+                filepath, window_img_dir, (start, end), strategies[start]
+            )
+            chunks = chunk_by_title(
+                elements,
+                max_characters=self.max_characters,
+                new_after_n_chars=self.new_after_n_chars,
+                combine_text_under_n_chars=self.combine_text_under_n_chars,
+            )
+            texts, tables = PdfExtractor.categorize(chunks)
+            images = PdfExtractor.get_imgs(
+                window_img_dir, image_captions(elements), image_pages(elements)
+            )
+
+            # drop the elements before handing the window over, the caller may hold
+            # the generator suspended for a long time while it embeds the window
+            del elements, chunks
+            gc.collect()
+
+            logger.info(
+                f"Extracted {len(texts)} texts, {len(tables)} tables and {len(images)} images from pages {start + 1}-{end}."
+            )
+
+            yield Extractions(texts=texts, tables=tables, images=images)
+
+            window = self.next_window(window)
+            start = end
+
+    def extract_many(
+        self, filepaths: list[str]
+    ) -> Iterator[tuple[str, Extractions | None]]:
+        """
+        Extracts several PDF documents, each of them by a single worker process, so
+        `num_workers` documents are extracted at once. Documents are yielded as
+        soon as they are extracted, the caller can summarize and index them while
+        the rest is still being extracted.
+
+        Parameters:
+            filepaths (list[str]):
+                Paths to the PDF files.
+
+        Yields:
+            tuple[str, Extractions | None]:
+                Path of the document and its extractions, None if the extraction
+                failed. A failure is logged and does not stop the other documents.
+        """
+
+        if self.num_workers <= 1 or len(filepaths) <= 1:
+            # a single document still has its page ranges partitioned in parallel
+            for filepath in filepaths:
+                yield filepath, extract_or_none(self, filepath)
+            return
+
+        # page ranges of a document are not partitioned in parallel again inside a
+        # worker, the workers are busy with the other documents
+        extractor = replace(self, num_workers=1)
+
+        logger.info(
+            f"Extracting {len(filepaths)} documents with {self.num_workers} workers."
+        )
+        # the caller already runs threads, e.g. the warm-up of the LLM, and forking
+        # while one of them holds a lock can deadlock the worker
+        with ProcessPoolExecutor(
+            max_workers=min(self.num_workers, len(filepaths)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+        ) as executor:
+            futures = {
+                executor.submit(extract_or_none, extractor, filepath): filepath
+                for filepath in filepaths
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def image_dir(self, filepath: str) -> str:
+        """
+        Directory of the images of the document. Documents with the same name in
+        different directories get different image directories.
+        """
+
+        path_hash = hashlib.sha256(os.path.abspath(filepath).encode("utf-8"))
+        return os.path.join(
+            self.base_img_dir, f"{Path(filepath).stem}-{path_hash.hexdigest()[:8]}"
+        )
+
+    def next_window(self, window: int) -> int:
+        """Adapts number of pages in the next window to the memory ceiling."""
+
+        if self.max_memory_mb is None:
+            return window
+
+        rss = current_rss_mb()
+        if rss > self.max_memory_mb:
+            if window > 1:
+                logger.warning(
+                    f"Resident memory {rss:.0f} MB is over {self.max_memory_mb} MB, shrinking the window to {window // 2} pages."
+                )
+            return max(1, window // 2)
+        if rss < self.max_memory_mb / 2:
+            return min(self.pages_per_task, window * 2)
+        return window
+
+    def page_strategies(self, filepath: str) -> list[str]:
+        if self.router is None:
+            return [HI_RES] * len(PdfReader(filepath).pages)
+        return self.router.route(filepath)
+
+    def page_tasks(self, filepath: str) -> list[tuple[tuple[int, int], str]]:
+        """
+        Splits the document into page ranges of at most `pages_per_task` pages which
+        share the same partitioning strategy.
+        """
+
+        strategies = self.page_strategies(filepath)
+
+        tasks = []
+        start = 0
+        for i in range(1, len(strategies) + 1):
+            if (
+                i == len(strategies)
+                or strategies[i] != strategies[start]
+                or i - start == self.pages_per_task
+            ):
+                tasks.append(((start, i), strategies[start]))
+                start = i
+
+        return tasks
+
+    def partition_ranges(
+        self, filepath: str, tasks: list[tuple[tuple[int, int], str]]
+    ) -> list[Element]:
+        """
+        Partitions page ranges of the PDF, in worker processes if `num_workers` > 1.
+        Every range writes images into its own directory under `img_dir`. Elements
+        are merged in page order.
+        """
+
+        ranges = [page_range for page_range, _ in tasks]
+        strategies = [strategy for _, strategy in tasks]
+        img_dirs = [
+            os.path.join(self.img_dir, f"pages-{start + 1:05d}-{end:05d}")
+            for start, end in ranges
+        ]
+        args = ([filepath] * len(tasks), img_dirs, ranges, strategies)
+
+        logger.info(
+            f"Partitioning {len(tasks)} page ranges with {self.num_workers} workers."
+        )
+
+        if self.num_workers > 1:
+            with ProcessPoolExecutor(
+                max_workers=max(1, min(self.num_workers, len(tasks))),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+            ) as executor:
+                results = list(executor.map(partition_pages, *args))
+        else:
+            results = list(map(partition_pages, *args))
+
+        return [element for elements in results for element in elements]
+
     @staticmethod
     def categorize(
         elements: list[Element],
@@ -121,22 +391,188 @@ class PdfExtractor:
         tables = []
 
         for element in elements:
+            metadata = {}
+            if element.metadata.page_number is not None:
+                metadata["page_number"] = element.metadata.page_number
+
             if isinstance(element, CompositeElement):
-                texts.append(Extraction(type=ExtractionType.TEXT, content=element.text))
+                texts.append(
+                    Extraction(
+                        type=ExtractionType.TEXT,
+                        content=element.text,
+                        metadata=metadata,
+                    )
+                )
             elif isinstance(element, Table):
                 tables.append(
-                    Extraction(type=ExtractionType.TABLE, content=element.text)
+                    Extraction(
+                        type=ExtractionType.TABLE,
+                        content=element.text,
+                        metadata=metadata,
+                    )
                 )
 
         return texts, tables
 
     @staticmethod
-    def get_imgs(img_dir: str) -> list[Extraction]:
+    def get_imgs(
+        img_dir: str,
+        captions: dict[str, str] | None = None,
+        pages: dict[str, int] | None = None,
+    ) -> list[Extraction]:
         images = []
-
-        for filename in os.listdir(img_dir):
-            filepath = os.path.join(img_dir, filename)
-            if filename.endswith(".jpg"):
-                images.append(Extraction(type=ExtractionType.IMAGE, content=filepath))
+        captions = captions or {}
+        pages = pages or {}
+
+        for dirpath, dirnames, filenames in os.walk(img_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                if filename.endswith(".jpg"):
+                    metadata = {}
+                    caption = captions.get(os.path.normpath(filepath))
+                    if caption:
+                        metadata["caption"] = caption
+                    page = pages.get(os.path.normpath(filepath))
+                    if page is not None:
+                        metadata["page_number"] = page
+                    images.append(
+                        Extraction(
+                            type=ExtractionType.IMAGE,
+                            content=filepath,
+                            metadata=metadata,
+                        )
+                    )
 
         return images
+
+
+def image_captions(elements: list[Element], max_chars: int = 500) -> dict[str, str]:
+    """
+    Finds a caption for every extracted image. It is the nearest figure caption on
+    the same page, or the text right next to the image if the page has none.
+
+    Returns:
+    Captions by normalized image paths.
+    """
+
+    captions = {}
+
+    for i, element in enumerate(elements):
+        image_path = getattr(element.metadata, "image_path", None)
+        if not isinstance(element, Image) or not image_path:
+            continue
+
+        page = element.metadata.page_number
+        same_page = [
+            (abs(j - i), other)
+            for j, other in enumerate(elements)
+            if j != i
+            and other.metadata.page_number == page
+            and not isinstance(other, Image)
+            and other.text.strip()
+        ]
+        if not same_page:
+            continue
+
+        figure_captions = [c for c in same_page if isinstance(c[1], FigureCaption)]
+        _, caption = min(figure_captions or same_page, key=lambda c: c[0])
+
+        captions[os.path.normpath(image_path)] = caption.text.strip()[:max_chars]
+
+    return captions
+
+
+def image_pages(elements: list[Element]) -> dict[str, int]:
+    """Returns page numbers of the extracted images by their normalized paths."""
+
+    return {
+        os.path.normpath(element.metadata.image_path): element.metadata.page_number
+        for element in elements
+        if isinstance(element, Image)
+        and getattr(element.metadata, "image_path", None)
+        and element.metadata.page_number is not None
+    }
+
+
+def extract_or_none(extractor: PdfExtractor, filepath: str) -> Extractions | None:
+    """Extracts the document, logs the error and returns None if it fails."""
+
+    try:
+        return extractor.extract(filepath)
+    except Exception:
+        logger.exception(f"Extraction of {filepath} failed, skipping it.")
+        return None
+
+
+def current_rss_mb() -> float:
+    """Current resident memory of the process. Falls back to the peak off Linux."""
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def init_worker() -> None:
+    """Keeps tesseract single threaded, parallelism comes from the worker processes."""
+
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+
+
+def partition_pages(
+    filepath: str,
+    img_dir: str,
+    page_range: tuple[int, int] | None = None,
+    strategy: str = HI_RES,
+) -> list[Element]:
+    """
+    Partitions the PDF into (not chunked) elements.
+
+    Parameters:
+    filepath:
+        Path to the PDF file.
+    img_dir:
+        Directory to store extracted images.
+    page_range:
+        Zero based half-open range of pages to partition. If None the whole document
+        is partitioned. Page numbers in the metadata of the elements are relative to
+        the whole document.
+    strategy:
+        Partitioning strategy of unstructured. Images and table structure are
+        extracted only with hi_res.
+    """
+
+    kwargs: dict[str, Any] = {"strategy": strategy}
+    if strategy == HI_RES:
+        kwargs.update(
+            extract_images_in_pdf=True,
+            infer_table_structure=True,
+            extract_image_block_output_dir=img_dir,
+        )
+
+    if page_range is None:
+        return partition_pdf(filename=filepath, **kwargs)
+
+    start, end = page_range
+
+    reader = PdfReader(filepath)
+    writer = PdfWriter()
+    for i in range(start, end):
+        writer.add_page(reader.pages[i])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        range_path = os.path.join(tmp_dir, Path(filepath).name)
+        with open(range_path, "wb") as f:
+            writer.write(f)
+
+        elements: list[Element] = partition_pdf(
+            filename=range_path, metadata_filename=filepath, **kwargs
+        )
+
+    for element in elements:
+        if element.metadata.page_number is not None:
+            element.metadata.page_number += start
+
+    return elements
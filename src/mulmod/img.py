@@ -1,7 +1,17 @@
 import base64
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from io import BytesIO
+from typing import Any
 
-from PIL import Image
+from PIL import Image, ImageStat
+
+from mulmod.cache import TieredCache, hash_params
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
 
 
 def get_img_base64(filepath: str):
@@ -10,3 +20,167 @@ def get_img_base64(filepath: str):
     pil_image.save(buffered, format="JPEG")
     img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
     return img_str
+
+
+def encode_img(filepath: str, max_side: int, quality: int) -> str:
+    """Downscales the image to fit `max_side` and encodes it as base64 JPEG."""
+
+    with Image.open(filepath) as pil_image:
+        pil_image = pil_image.convert("RGB")
+        pil_image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+        buffered = BytesIO()
+        pil_image.save(buffered, format="JPEG", quality=quality, optimize=True)
+
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+@dataclass
+class ImagePayloadStore:
+    """
+    Store of base64 payloads of images sent to the vision model. Every image is
+    downscaled to the resolution the model can use and encoded only once, then it
+    is served from an in-process LRU backed by files on disk.
+
+    Attributes:
+    max_side:
+        Longer side of the downscaled image in pixels. Llava sees at most 672.
+    quality:
+        JPEG quality of the encoded image.
+    cache_dir:
+        Directory of the disk tier. If None only the in-process tier is used.
+    max_items:
+        Maximum number of payloads in the in-process tier.
+    max_disk_mb:
+        Size cap of the disk tier.
+    """
+
+    max_side: int = 672
+    quality: int = 85
+    cache_dir: str | None = "./resources/cache/images"
+    max_items: int = 256
+    max_disk_mb: float = 512
+
+    def __post_init__(self) -> None:
+        self.cache = TieredCache(
+            label="payloads",
+            cache_dir=self.cache_dir,
+            max_items=self.max_items,
+            max_disk_mb=self.max_disk_mb,
+        )
+
+    def cache_params(self) -> dict[str, Any]:
+        """Parameters which influence the payloads."""
+
+        return {"max_side": self.max_side, "quality": self.quality}
+
+    def key(self, filepath: str) -> str:
+        # size and modification time are cheaper to check than hashing the file
+        stat = os.stat(filepath)
+        return hash_params(
+            os.path.abspath(filepath),
+            stat.st_size,
+            stat.st_mtime_ns,
+            self.cache_params(),
+        )
+
+    def get_base64(self, filepath: str) -> str:
+        """Returns base64 JPEG of the downscaled image, encodes it on a miss."""
+
+        key = self.key(filepath)
+        payload = self.cache.get(key)
+        if payload is None:
+            payload = encode_img(filepath, self.max_side, self.quality)
+            self.cache.put(key, payload)
+
+        return payload
+
+    def prefetch(self, filepaths: list[str], num_workers: int = 1) -> None:
+        """Encodes the images which are not stored yet in worker processes."""
+
+        missing = {}
+        for filepath in filepaths:
+            key = self.key(filepath)
+            if self.cache.get(key) is None:
+                missing[key] = filepath
+
+        if len(missing) == 0:
+            return
+
+        logger.info(f"Encoding {len(missing)} image payloads.")
+
+        args = (
+            list(missing.values()),
+            [self.max_side] * len(missing),
+            [self.quality] * len(missing),
+        )
+        if num_workers > 1 and len(missing) > 1:
+            # spawned, forking while other threads hold locks can deadlock
+            with ProcessPoolExecutor(
+                max_workers=min(num_workers, len(missing)),
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                payloads = list(executor.map(encode_img, *args))
+        else:
+            payloads = list(map(encode_img, *args))
+
+        for key, payload in zip(missing, payloads):
+            self.cache.put(key, payload)
+
+
+def get_img_stats(filepath: str) -> dict[str, float]:
+    """Simple statistics of an image, brightness and saturation are in [0, 1]."""
+
+    with Image.open(filepath) as pil_image:
+        gray = pil_image.convert("L")
+        hsv = pil_image.convert("HSV")
+
+        return {
+            "width": pil_image.width,
+            "height": pil_image.height,
+            "brightness": ImageStat.Stat(gray).mean[0] / 255,
+            "saturation": ImageStat.Stat(hsv).mean[1] / 255,
+            "entropy": gray.entropy(),
+        }
+
+
+def describe_img_stats(stats: dict[str, float]) -> str:
+    """Describes image statistics in words, so they can be part of a retrieval key."""
+
+    if stats["entropy"] > 6.0:
+        kind = "Photo or detailed figure"
+    elif stats["entropy"] > 3.0:
+        kind = "Chart or diagram"
+    else:
+        kind = "Simple graphic"
+
+    color = "in color" if stats["saturation"] > 0.15 else "in grayscale"
+    tone = "dark" if stats["brightness"] < 0.35 else "light"
+
+    return f"{kind} {color}, {tone}, {stats['width']}x{stats['height']} pixels."
+
+
+def get_img_dhash(filepath: str, hash_size: int = 8) -> int:
+    """
+    Difference hash of an image. Images which look alike have hashes differing in
+    few bits, regardless of their size and compression.
+    """
+
+    with Image.open(filepath) as pil_image:
+        small = pil_image.convert("L").resize(
+            (hash_size + 1, hash_size), Image.Resampling.LANCZOS
+        )
+
+    pixels = list(small.getdata())
+    dhash = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            dhash = (dhash << 1) | (left > right)
+
+    return dhash
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
@@ -0,0 +1,147 @@
+import threading
+from typing import Any
+
+from langchain_community.chat_models import ChatOllama
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.outputs import ChatGenerationChunk, GenerationChunk
+
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Ollama reloads the model whenever a request asks for a different context size, so
+# all requests to the same model share it
+NUM_CTX = 8192
+KEEP_ALIVE = "30m"
+
+NS_PER_S = 1e9
+
+CHARS_PER_TOKEN = 4
+
+
+class OllamaChat(ChatOllama):
+    """
+    ChatOllama which asks the server to keep the model loaded between requests.
+
+    Ollama reuses the evaluated context of the longest prompt prefix shared with the
+    previous request of the same slot, so the prompts should start with the same
+    system message and keep the varying content at their end.
+
+    Attributes:
+    keep_alive:
+        How long the model stays loaded after a request, e.g. "30m" or -1 for ever.
+        If None the server default is used.
+    """
+
+    keep_alive: int | str | None = KEEP_ALIVE
+    num_ctx: int | None = NUM_CTX
+
+    @property
+    def _default_params(self) -> dict[str, Any]:
+        params = super()._default_params
+        if self.keep_alive is not None:
+            params["keep_alive"] = self.keep_alive
+        return params
+
+    def warm_up(self, system_msg: str) -> None:
+        """
+        Loads the model and evaluates the system message, so the first real request
+        pays neither of them.
+        """
+
+        try:
+            self.invoke(
+                [SystemMessage(content=system_msg), HumanMessage(content="Hi")],
+                num_predict=1,
+            )
+        except Exception as e:
+            logger.warning(f"Warm-up of model {self.model} failed: {e}")
+            return
+
+        logger.info(f"Model {self.model} is loaded and warmed up.")
+
+    def warm_up_in_background(self, system_msg: str) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.warm_up, args=(system_msg,), name="warm-up", daemon=True
+        )
+        thread.start()
+        return thread
+
+
+class LlmTimings(BaseCallbackHandler):
+    """
+    Collects timings Ollama reports with the last chunk of every response. Prompt
+    evaluation counts only the tokens which were not reused from the cached prefix,
+    so it shows how much time goes to re-processing the prompt.
+
+    Attributes:
+    name:
+        Name used in the logs.
+    log_each:
+        Whether to log the timings of every response, otherwise only `report`
+        summarizes them.
+    """
+
+    def __init__(self, name: str, log_each: bool = False) -> None:
+        self.name = name
+        self.log_each = log_each
+
+        self.lock = threading.Lock()
+        self.responses: list[dict[str, float]] = []
+
+    def on_llm_new_token(
+        self,
+        token: str,
+        *,
+        chunk: GenerationChunk | ChatGenerationChunk | None = None,
+        **kwargs: Any,
+    ) -> None:
+        info = chunk.generation_info if chunk is not None else None
+        if not info or not info.get("done"):
+            return
+
+        timing = {
+            "load_s": info.get("load_duration", 0) / NS_PER_S,
+            "prompt_tokens": info.get("prompt_eval_count", 0),
+            "prompt_eval_s": info.get("prompt_eval_duration", 0) / NS_PER_S,
+            "generated_tokens": info.get("eval_count", 0),
+            "generation_s": info.get("eval_duration", 0) / NS_PER_S,
+        }
+        with self.lock:
+            self.responses.append(timing)
+
+        if self.log_each:
+            logger.info(f"{self.name}: {format_timing(timing)}")
+
+    def report(self) -> dict[str, float]:
+        """Sums timings of all the responses."""
+
+        with self.lock:
+            total = {
+                key: sum(r[key] for r in self.responses)
+                for key in (
+                    "load_s",
+                    "prompt_tokens",
+                    "prompt_eval_s",
+                    "generated_tokens",
+                    "generation_s",
+                )
+            }
+            total["responses"] = len(self.responses)
+
+        return total
+
+
+def format_timing(timing: dict[str, float]) -> str:
+    return (
+        f"load {timing['load_s']:.2f}s, prompt eval {timing['prompt_tokens']:.0f} tokens "
+        f"in {timing['prompt_eval_s']:.2f}s, generation {timing['generated_tokens']:.0f} "
+        f"tokens in {timing['generation_s']:.2f}s."
+    )
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough number of tokens of a text, about 4 characters per token."""
+
+    return len(text) // CHARS_PER_TOKEN + 1
@@ -1,30 +1,78 @@
+import glob
+import multiprocessing
+import os
 import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Iterator
 
-from mulmod.extract import Extractions, PdfExtractor
+from mulmod.cache import ArtifactCache, TieredCache, hash_file, hash_params
+from mulmod.dedup import ImageFilter
+from mulmod.extract import Extraction, Extractions, ExtractionType, PdfExtractor
+from mulmod.img import ImagePayloadStore
+from mulmod.llm import LlmTimings, format_timing
 from mulmod.logger import get_logger
+from mulmod.ocr import OcrSummarizer
+from mulmod.retrieve.embeddings import CachedEmbeddings
+from mulmod.retrieve.progressive import BackgroundIndexer, image_proxy
 from mulmod.retrieve.rag import Rag
-from mulmod.retrieve.retriever import RetrievalResult, Retriever
+from mulmod.router import PageRouter
+from mulmod.scheduler import Scheduler, format_report
+from mulmod.server import QueryServer
+from mulmod.retrieve.retriever import DEFAULT_COLLECTION, RetrievalResult, Retriever
+from mulmod.retrieve.snapshot import SnapshotPayloadStore
 from mulmod.summary import Summarizer
 
 USAGE = """\
 Usage:
-  python main.py <filepath> <mode>
+  python main.py <filepath> <mode> [<image_index>]
 Arguments:
-  <filepath>    : Path to the PDF file.
+  <filepath>    : Path to the PDF file, to a directory of PDF files or a quoted
+                  glob of PDF files, e.g. "papers/**/*.pdf". With mode 2 also
+                  a snapshot exported by mode 3, e.g. "index.snapshot".
   <mode>        : 0: retrieval_only
                   1: rag
+                  2: server answering queries over HTTP
+                  3: export the index into a snapshot file
+  <image_index> : llm: images are indexed by LLM summaries (default)
+                  ocr: images are indexed by OCR, captions and statistics
+                  hybrid: as ocr, LLM summaries for images with little text
 """
 
 STOP_TOKEN = "<stop>"
+SOURCES_PREFIX = "in:"
 INTRO_RET_MSG = f"""\
 Ask a query about the input PDF to print relevant texts and images for it.
+To search only some of the PDFs start the query with {SOURCES_PREFIX}<file>,<file>.
 To stop simply type {STOP_TOKEN}.
 """
 INTRO_CHAT_MSG = f"""\
 Ask a query about the input PDF to get answer from the chatbot.
+To search only some of the PDFs start the query with {SOURCES_PREFIX}<file>,<file>.
+Press Ctrl+C to stop the answer being generated.
 To stop simply type {STOP_TOKEN}.
 """
 
+CORPUS_COLLECTION = "corpus"
+
+SERVER_HOST = os.environ.get("MULMOD_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("MULMOD_PORT", "8000"))
+SERVER_PROCESSES = int(os.environ.get("MULMOD_SERVER_PROCESSES", "1"))
+
+SNAPSHOT_SUFFIX = ".snapshot"
+SNAPSHOT_PATH = os.environ.get("MULMOD_SNAPSHOT", f"./resources/index{SNAPSHOT_SUFFIX}")
+
+# every extraction process loads its own layout and OCR models, which take
+# gigabytes of memory, so the cores of large machines are not all used by default
+EXTRACT_WORKERS = int(
+    os.environ.get("MULMOD_EXTRACT_WORKERS", min(4, os.cpu_count() or 1))
+)
+
+IMAGE_INDEX_MODES = ("llm", "ocr", "hybrid")
+
 logger = get_logger(__name__)
 
 
@@ -35,23 +83,77 @@ def print_relevant(retrieval: RetrievalResult) -> None:
 
     print("Found this relevant texts and images :")
     for e in retrieval:
+        location = e[0].metadata.get("source", "")
+        if "page_number" in e[0].metadata:
+            location += f" page {e[0].metadata['page_number']}"
+        duplicates = e[0].metadata.get("duplicates", [])
+        pages = [d["page_number"] for d in duplicates if "page_number" in d]
+        if pages:
+            location += f" (repeated on pages {', '.join(map(str, pages))})"
         print()
-        print(f"Similarity score {e[1]} for:")
+        print(f"Similarity score {e[1]} for {location}:")
         print()
         print(e[0].page_content)
         print()
 
 
-def remove_empty(extracts: Extractions) -> Extractions:
+def remove_empty(
+    extracts: Extractions, image_filter: ImageFilter | None = None
+) -> Extractions:
+    images = extracts.images
+    duplicates: list[Extraction] = []
+    if image_filter is not None:
+        images, duplicates = image_filter.filter(images)
+
     return Extractions(
         texts=[e for e in extracts.texts if e.content != ""],
         tables=[e for e in extracts.tables if e.content != ""],
-        images=extracts.images,
+        images=images,
+        duplicates=duplicates,
     )
 
 
+@dataclass
+class Source:
+    """
+    PDF document of the index and the state of its ingestion.
+
+    Attributes:
+    filepath:
+        Path to the PDF file. It is the source in the metadata of its documents.
+    extraction_key:
+        Cache key of its extractions.
+    image_summary_key:
+        Cache key of the summaries of its images.
+    text_summary_key:
+        Cache key of the summaries of its texts and tables.
+    """
+
+    filepath: str
+    extraction_key: str
+    image_summary_key: str
+    text_summary_key: str
+
+    def __post_init__(self) -> None:
+        self.cached_extractions: Extractions | None = None
+        self.cached_image_summaries: list[str] | None = None
+        self.cached_text_summaries: dict[str, list[str]] | None = None
+        # set once all windows of the document were extracted
+        self.complete = False
+
+        # only the extracted strings are accumulated, they are needed for the cache
+        self.extracted = Extractions(texts=[], tables=[], images=[])
+        self.summaries: dict[str, list[str]] = {"images": [], "texts": [], "tables": []}
+        self.ids: dict[str, list[str]] = {"images": [], "texts": [], "tables": []}
+
+        # numbers of chunks compared to the previous index
+        self.added = 0
+        self.removed = 0
+        self.unchanged = 0
+
+
 def get_retriever(
-    filepath: str,
+    filepaths: str | list[str],
     max_characters: int,
     new_after_n_chars: int,
     combine_text_under_n_chars: int,
@@ -59,98 +161,1052 @@ def get_retriever(
     summarize_texts=False,
     txt_summary_num_words: int = 50,
     num_predict_summaries: int = 1000,
+    cache: ArtifactCache | None = None,
+    extract_workers: int = 1,
+    route_pages: bool = False,
+    stream: bool = False,
+    max_memory_mb: int | None = None,
+    summary_cache: TieredCache | None = None,
+    pack_texts: bool = False,
+    indexer: BackgroundIndexer | None = None,
+    image_index: str = "llm",
+    image_filter: ImageFilter | None = None,
+    payloads: ImagePayloadStore | None = None,
+    vector_backend: str = "chroma",
+    embeddings: CachedEmbeddings | None = None,
+    collection_name: str = DEFAULT_COLLECTION,
+    index_workers: int = 4,
 ) -> Retriever:
+    """
+    Builds retriever over a PDF or a corpus of PDFs. With an indexer the retriever
+    is returned as soon as the documents are indexed by their raw text and image
+    proxies, and the indexer swaps in the summaries in the background.
+
+    A single PDF is extracted with its page ranges partitioned by `extract_workers`
+    processes, or streamed window by window with `stream`. Several PDFs are
+    extracted by `extract_workers` processes, one document per process, and the
+    extracted documents are summarized and indexed by `index_workers` threads
+    while the rest is still being extracted. Their summaries share one scheduler.
+    Every document carries its source file and page in its metadata, so the
+    retrieval can be restricted to some of the files.
+
+    A previous index built with the same parameters is updated, the numbers of
+    chunks added, removed and unchanged per source file are in `retriever.updates`.
+
+    Images are indexed by LLM summaries with `image_index` "llm", by OCR text,
+    captions and statistics with "ocr", and with "hybrid" LLM summaries are
+    generated only for the images where OCR finds little text. With an image filter
+    small images are dropped and only one image of each group of duplicates is
+    summarized, the pages of the others are listed in `metadata["duplicates"]` of
+    its retrieved document. Images summarized by LLM are downscaled and encoded into the
+    payload store by the extraction workers.
+    """
+
+    if image_index not in IMAGE_INDEX_MODES:
+        raise ValueError(
+            f"Unknown image index mode {image_index}, expected one of {IMAGE_INDEX_MODES}."
+        )
+
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    filepaths = list(dict.fromkeys(filepaths))
+    if len(filepaths) == 0:
+        raise ValueError("No PDF files to index.")
+
+    if cache is None:
+        cache = ArtifactCache(cache_dir=None)
+    if payloads is None:
+        payloads = ImagePayloadStore(cache_dir=None)
+    if embeddings is None:
+        embeddings = CachedEmbeddings(cache_dir=None)
+
     extractor = PdfExtractor(
         max_characters=max_characters,
         new_after_n_chars=new_after_n_chars,
         combine_text_under_n_chars=combine_text_under_n_chars,
+        num_workers=extract_workers,
+        router=PageRouter() if route_pages else None,
+        max_memory_mb=max_memory_mb,
+    )
+    scheduler = Scheduler()
+    timings = LlmTimings("Summaries")
+    image_summarizer: Summarizer | OcrSummarizer = Summarizer(
+        num_words=img_summary_num_words,
+        num_predict=num_predict_summaries,
+        cache=summary_cache,
+        scheduler=scheduler,
+        payloads=payloads,
+        timings=timings,
+    )
+    if image_index == "ocr":
+        image_summarizer = OcrSummarizer()
+    elif image_index == "hybrid":
+        image_summarizer = OcrSummarizer(fallback=image_summarizer)
+    text_summarizer = Summarizer(
+        num_words=txt_summary_num_words,
+        num_predict=num_predict_summaries,
+        cache=summary_cache,
+        scheduler=scheduler,
+        pack_texts=pack_texts,
+        timings=timings,
     )
-    extractions = extractor.extract(filepath)
-    extractions = remove_empty(extractions)
 
-    texts = [e.content for e in extractions.texts]
-    tables = [e.content for e in extractions.tables]
+    sources = make_sources(
+        filepaths,
+        extractor,
+        image_filter,
+        image_summarizer,
+        text_summarizer if summarize_texts else None,
+    )
+    index_params = [Retriever.cache_params(vector_backend, embeddings), collection_name]
+    # paths are part of the key, they are stored in the metadata of the documents
+    index_key = hash_params(
+        sorted((s.filepath, s.image_summary_key, s.text_summary_key) for s in sources),
+        *index_params,
+    )
+    retriever_params: dict[str, Any] = {
+        "backend": vector_backend,
+        "embeddings": embeddings,
+        "collection_name": collection_name,
+    }
 
-    logger.info("Started generating summaries for images.")
-    image_summarizer = Summarizer(num_words=img_summary_num_words, num_predict=num_predict_summaries)
-    image_summaries = image_summarizer.get_summary(extractions.images)
-    logger.info("Finished generating summaries for images.")
+    if cache.is_complete("index", index_key):
+        logger.info("Loading vector database for retrieval from cache.")
+        retriever = Retriever(
+            persist_directory=cache.path("index", index_key), **retriever_params
+        )
+        retriever.updates = {
+            filepath: {"added": 0, "removed": 0, "unchanged": len(ids)}
+            for filepath, ids in retriever.ids_by_source().items()
+        }
+        return retriever
 
-    retriever = Retriever()
+    load_cached(cache, sources, summarize_texts)
 
-    if summarize_texts:
-        text_summarizer = Summarizer(num_words=txt_summary_num_words, num_predict=num_predict_summaries)
-        logger.info("Started generating summaries for texts and tables.")
-        text_summaries = text_summarizer.get_summary(extractions.texts)
-        table_summaries = text_summarizer.get_summary(extractions.tables)
-        logger.info("Finished generating summaries for texts and tables.")
-    else:
-        text_summaries = texts
-        table_summaries = tables
+    if image_index != "ocr" or summarize_texts:
+        # the model loads while the documents are extracted
+        text_summarizer.warm_up()
+
+    lineage = lineage_key(
+        extractor,
+        image_filter,
+        image_summarizer,
+        text_summarizer if summarize_texts else None,
+        index_params,
+    )
+    retriever = open_index(cache, index_key, lineage, retriever_params)
+    previous_ids = retriever.ids_by_source()
 
-    logger.info("Started creating vector database for retrieval.")
-    retriever.add_docs_from_texts(text_summaries, texts)
-    retriever.add_docs_from_texts(table_summaries, tables)
-    retriever.add_imgs_from_extract(image_summaries, extractions.images)
+    num_index_workers = max(1, min(index_workers, len(sources)))
+    window_indexer = WindowIndexer(
+        retriever=retriever,
+        image_summarizer=image_summarizer,
+        text_summarizer=text_summarizer,
+        summarize_texts=summarize_texts,
+        payloads=payloads if image_index != "ocr" else None,
+        prefetch_workers=max(1, extract_workers // num_index_workers),
+        indexer=indexer,
+    )
+
+    logger.info(
+        f"Started creating vector database for retrieval of {len(sources)} documents."
+    )
+    # image and text summaries go through separate lanes of the shared scheduler,
+    # so they are generated side by side, for several documents at once
+    with ThreadPoolExecutor(
+        max_workers=3 * num_index_workers
+    ) as executor, ThreadPoolExecutor(max_workers=num_index_workers) as documents:
+        # windows of one document are indexed in order, the cached summaries are
+        # sliced by the number of its extractions indexed so far
+        last_window: dict[str, Future] = {}
+        for source, window in iter_windows(sources, extractor, image_filter, stream):
+            previous = last_window.get(source.filepath)
+            if previous is not None:
+                previous.result()
+            last_window[source.filepath] = documents.submit(
+                window_indexer.index, source, window, executor
+            )
+        for future in last_window.values():
+            future.result()
     logger.info("Finished creating vector database for retrieval.")
 
+    remove_stale(retriever, sources, previous_ids)
+    retriever.failed_sources = [s.filepath for s in sources if not s.complete]
+
+    for source in sources:
+        if source.complete and source.cached_extractions is None:
+            cache.save("extractions", source.extraction_key, source.extracted.to_dict())
+
+    report = partial(log_stats, scheduler, summary_cache, payloads, timings, embeddings)
+    finish = partial(
+        save_index,
+        cache,
+        retriever,
+        sources,
+        summarize_texts,
+        index_key,
+        lineage,
+        report,
+        indexer,
+    )
+    if indexer is not None:
+        indexer.start(retriever, on_finish=finish)
+    else:
+        finish()
+
     return retriever
 
 
-def retrieval_only(pdf_path: str) -> None:
+def make_sources(
+    filepaths: list[str],
+    extractor: PdfExtractor,
+    image_filter: ImageFilter | None,
+    image_summarizer: Summarizer | OcrSummarizer,
+    text_summarizer: Summarizer | None,
+) -> list[Source]:
+    """
+    Sources of the PDF files with the keys of their stages. The keys are chained, so
+    a changed parameter invalidates only the stages which depend on it. Texts are
+    not summarized without `text_summarizer`.
+    """
+
+    sources = []
+    for filepath in filepaths:
+        extraction_key = hash_params(
+            hash_file(filepath),
+            extractor.cache_params(),
+            image_filter.cache_params() if image_filter else None,
+        )
+        image_summary_key = hash_params(extraction_key, image_summarizer.cache_params())
+        text_summary_key = hash_params(
+            extraction_key, text_summarizer.cache_params() if text_summarizer else None
+        )
+        sources.append(
+            Source(filepath, extraction_key, image_summary_key, text_summary_key)
+        )
+
+    return sources
+
+
+def lineage_key(
+    extractor: PdfExtractor,
+    image_filter: ImageFilter | None,
+    image_summarizer: Summarizer | OcrSummarizer,
+    text_summarizer: Summarizer | None,
+    index_params: list[Any],
+) -> str:
+    """
+    Key of the indexes built with the same parameters from any revision of the
+    documents, the latest of them is updated instead of building a new one.
+    """
+
+    return hash_params(
+        extractor.cache_params(),
+        image_filter.cache_params() if image_filter else None,
+        image_summarizer.cache_params(),
+        text_summarizer.cache_params() if text_summarizer else None,
+        *index_params,
+    )
+
+
+def load_cached(
+    cache: ArtifactCache, sources: list[Source], summarize_texts: bool
+) -> None:
+    """Loads the cached extractions of the sources and their summaries."""
+
+    # summaries are aligned with the cached extractions, a fresh extraction can
+    # order the images differently
+    for source in sources:
+        source.cached_extractions = load_extractions(cache, source.extraction_key)
+        if source.cached_extractions is None:
+            continue
+        source.cached_image_summaries = cache.load(
+            "image_summaries", source.image_summary_key
+        )
+        if summarize_texts:
+            source.cached_text_summaries = cache.load(
+                "text_summaries", source.text_summary_key
+            )
+
+
+def open_index(
+    cache: ArtifactCache,
+    index_key: str,
+    lineage: str,
+    retriever_params: dict[str, Any],
+) -> Retriever:
+    """
+    Opens the retriever of a new index. It starts from a copy of the latest complete
+    index of the lineage, e.g. of the previous revision of the documents.
+    """
+
+    latest = cache.load("latest_index", lineage)
+    base_key = latest["index_key"] if latest else None
+    if base_key is not None and cache.is_complete("index", base_key):
+        logger.info("Updating the previous vector database for retrieval.")
+
+    return Retriever(
+        persist_directory=cache.stage_dir("index", index_key, base_key),
+        **retriever_params,
+    )
+
+
+@dataclass
+class Chunks:
+    """
+    Chunks of one kind of a window with their ids, and which of them are not in the
+    index yet.
+
+    Attributes:
+    kind:
+        "images", "texts" or "tables".
+    extractions:
+        Extractions of the chunks.
+    summarizer:
+        Summarizer of the kind.
+    summarized:
+        Whether the chunks are indexed by summaries or by their content.
+    cached:
+        Cached summaries of the chunks, None without cache.
+    metadatas:
+        Metadata of the documents of the chunks.
+    ids:
+        Ids of the chunks.
+    indexed:
+        Metadata of the chunks already in the index by their ids.
+    new:
+        Positions of the chunks which are not in the index yet.
+    """
+
+    kind: str
+    extractions: list[Extraction]
+    summarizer: Summarizer | OcrSummarizer
+    summarized: bool
+    cached: list[str] | None
+    metadatas: list[dict[str, Any]]
+    ids: list[str]
+    indexed: dict[str, dict[str, Any]]
+    new: list[int]
+
+    def new_ids(self) -> list[str]:
+        return [self.ids[p] for p in self.new]
+
+    def new_metadatas(self) -> list[dict[str, Any]]:
+        return [self.metadatas[p] for p in self.new]
+
+    def new_extractions(self) -> list[Extraction]:
+        return [self.extractions[p] for p in self.new]
+
+
+@dataclass
+class WindowIndexer:
+    """
+    Indexes windows of extractions of the documents. Only the chunks which are not
+    in the index yet are summarized and embedded, chunks already in the index keep
+    their keys.
+
+    Attributes:
+    retriever:
+        Retriever of the index.
+    image_summarizer:
+        Summarizer of the images.
+    text_summarizer:
+        Summarizer of the texts and tables.
+    summarize_texts:
+        Whether texts and tables are indexed by summaries or by their content.
+    payloads:
+        Store the images summarized by LLM are encoded into ahead of the
+        summaries, None if they are not summarized by LLM.
+    prefetch_workers:
+        Number of processes encoding the images of a window.
+    indexer:
+        Background indexer generating the summaries. Without it the window is
+        summarized before it is indexed.
+    """
+
+    retriever: Retriever
+    image_summarizer: Summarizer | OcrSummarizer
+    text_summarizer: Summarizer
+    summarize_texts: bool
+    payloads: ImagePayloadStore | None = None
+    prefetch_workers: int = 1
+    indexer: BackgroundIndexer | None = None
+
+    def __post_init__(self) -> None:
+        # the index is not shared by threads, the embeddings serialize calls of the
+        # model themselves
+        self.lock = threading.Lock()
+
+    def index(
+        self, source: Source, window: Extractions, executor: ThreadPoolExecutor
+    ) -> None:
+        """Indexes the window of the document, its summaries run in `executor`."""
+
+        chunks = self.chunks(source, window)
+
+        if self.payloads is not None:
+            new_images = chunks["images"].new_extractions()
+            self.payloads.prefetch(
+                [e.content for e in new_images], self.prefetch_workers
+            )
+
+        summaries = self.summarize(chunks, executor)
+
+        with self.lock:
+            for kind_chunks in chunks.values():
+                self.add(source, kind_chunks, summaries[kind_chunks.kind])
+            self.add_duplicates(source, window)
+
+    def chunks(self, source: Source, window: Extractions) -> dict[str, Chunks]:
+        """Chunks of the window by their kind, compared to the index."""
+
+        cached_texts = source.cached_text_summaries or {}
+        kinds = {
+            "images": (window.images, self.image_summarizer, True),
+            "texts": (window.texts, self.text_summarizer, self.summarize_texts),
+            "tables": (window.tables, self.text_summarizer, self.summarize_texts),
+        }
+        cached = {
+            "images": source.cached_image_summaries,
+            "texts": cached_texts.get("texts"),
+            "tables": cached_texts.get("tables"),
+        }
+
+        chunks = {}
+        for kind, (extractions, summarizer, summarized) in kinds.items():
+            metadatas = source_metadatas(source.filepath, extractions)
+            ids = chunk_ids(kind, extractions, metadatas)
+            with self.lock:
+                indexed = self.retriever.get_metadatas(ids)
+            chunks[kind] = Chunks(
+                kind=kind,
+                extractions=extractions,
+                summarizer=summarizer,
+                summarized=summarized,
+                cached=cached_slice(
+                    cached[kind], len(getattr(source.extracted, kind)), extractions
+                ),
+                metadatas=metadatas,
+                ids=ids,
+                indexed=indexed,
+                new=new_positions(ids, indexed),
+            )
+
+        return chunks
+
+    def summarize(
+        self, chunks: dict[str, Chunks], executor: ThreadPoolExecutor
+    ) -> dict[str, list[str]]:
+        """Keys of the new chunks: cached or generated summaries, or cheap keys."""
+
+        futures = {}
+        summaries: dict[str, list[str]] = {}
+        for kind, c in chunks.items():
+            new_extractions = c.new_extractions()
+            if c.cached is not None:
+                summaries[kind] = [c.cached[p] for p in c.new]
+            elif not c.summarized:
+                summaries[kind] = [e.content for e in new_extractions]
+            elif self.indexer is not None:
+                # documents are indexed right away with cheap keys, the indexer
+                # swaps in the summaries later
+                summaries[kind] = [
+                    image_proxy(e) if kind == "images" else e.content
+                    for e in new_extractions
+                ]
+            else:
+                futures[kind] = executor.submit(
+                    summarize, c.summarizer, new_extractions, None
+                )
+        for kind, future in futures.items():
+            summaries[kind] = future.result()
+
+        return summaries
+
+    def add(self, source: Source, chunks: Chunks, summaries: list[str]) -> None:
+        """Adds the new chunks to the index and records the window in the source."""
+
+        new_ids = chunks.new_ids()
+        new_metadatas = chunks.new_metadatas()
+        new_extractions = chunks.new_extractions()
+        if chunks.kind == "images":
+            self.retriever.add_imgs_from_extract(
+                summaries, new_extractions, new_metadatas, new_ids
+            )
+        else:
+            self.retriever.add_docs_from_texts(
+                summaries,
+                [e.content for e in new_extractions],
+                new_metadatas,
+                new_ids,
+            )
+        if self.indexer is not None and chunks.summarized and chunks.cached is None:
+            self.indexer.submit(
+                chunks.summarizer, new_extractions, new_ids, new_metadatas
+            )
+
+        # chunks of a revised document can move to another page
+        moved = {
+            i: m
+            for i, m in zip(chunks.ids, chunks.metadatas)
+            if i in chunks.indexed
+            and any(chunks.indexed[i].get(key) != v for key, v in m.items())
+        }
+        self.retriever.update_metadata(list(moved), list(moved.values()))
+
+        keys = dict(zip(new_ids, summaries))
+        old_ids = [i for i in dict.fromkeys(chunks.ids) if i in chunks.indexed]
+        keys.update(zip(old_ids, self.retriever.get_keys(old_ids)))
+
+        getattr(source.extracted, chunks.kind).extend(chunks.extractions)
+        source.summaries[chunks.kind].extend(keys[i] for i in chunks.ids)
+        source.ids[chunks.kind].extend(chunks.ids)
+        source.added += len(new_ids)
+        source.unchanged += len(old_ids)
+
+    def add_duplicates(self, source: Source, window: Extractions) -> None:
+        """
+        Lists the duplicates of the window in the documents of their kept images. The
+        image a duplicate was dropped for may be indexed by an earlier window.
+        """
+
+        source.extracted.duplicates.extend(window.duplicates)
+        duplicates = duplicate_metadatas(
+            source.filepath, source.extracted.duplicates, window.duplicates
+        )
+        self.retriever.update_value_metadata(
+            list(duplicates), list(duplicates.values())
+        )
+
+
+def remove_stale(
+    retriever: Retriever, sources: list[Source], previous_ids: dict[str, set[str]]
+) -> None:
+    """
+    Removes chunks which disappeared from the revised documents, and documents
+    which are not in the corpus anymore, from the index. Records the numbers of
+    chunks added, removed and unchanged per source file in `retriever.updates`.
+    Incomplete documents keep their previous chunks.
+    """
+
+    paths = {s.filepath for s in sources}
+    for filepath, source_ids in previous_ids.items():
+        if filepath not in paths:
+            retriever.delete(list(source_ids))
+            retriever.updates[filepath] = {
+                "added": 0,
+                "removed": len(source_ids),
+                "unchanged": 0,
+            }
+            logger.info(f"Removed {len(source_ids)} chunks of {filepath}.")
+    for source in sources:
+        if not source.complete:
+            continue
+        kept = {i for kind_ids in source.ids.values() for i in kind_ids}
+        removed = previous_ids.get(source.filepath, set()) - kept
+        retriever.delete(list(removed))
+        source.removed = len(removed)
+        retriever.updates[source.filepath] = {
+            "added": source.added,
+            "removed": source.removed,
+            "unchanged": source.unchanged,
+        }
+        logger.info(
+            f"Indexed {source.filepath}: {source.added} chunks added, {source.removed} removed, {source.unchanged} unchanged."
+        )
+    logger.info(
+        f"Indexed {len(sources)} documents: {sum(s.added for s in sources)} chunks added, "
+        f"{sum(s.removed for s in sources)} removed, {sum(s.unchanged for s in sources)} unchanged."
+    )
+
+
+def log_stats(
+    scheduler: Scheduler,
+    summary_cache: TieredCache | None,
+    payloads: ImagePayloadStore,
+    timings: LlmTimings,
+    embeddings: CachedEmbeddings,
+) -> None:
+    """Logs the stats of the scheduler, the caches and the models of a build."""
+
+    for report in scheduler.report():
+        if report["completed"] or report["errors"]:
+            logger.info(format_report(report))
+    if summary_cache is not None:
+        logger.info(f"Summary cache stats: {summary_cache.stats()}")
+    logger.info(f"Image payload cache stats: {payloads.cache.stats()}")
+    if timings.responses:
+        logger.info(f"Summary LLM timings: {format_timing(timings.report())}")
+    logger.info(f"Embedding stats: {embeddings.stats()}")
+
+
+def save_index(
+    cache: ArtifactCache,
+    retriever: Retriever,
+    sources: list[Source],
+    summarize_texts: bool,
+    index_key: str,
+    lineage: str,
+    report: Callable[[], None],
+    indexer: BackgroundIndexer | None = None,
+    error: Exception | None = None,
+) -> None:
+    """
+    Caches the summaries of the complete documents and marks the index complete,
+    once the background indexer finished without `error`. An index with failed
+    documents is not saved, so the next run retries them. `report` logs the stats
+    of the build.
+    """
+
+    if indexer is not None and error is None:
+        # replace the cheap keys by the summaries generated in the background
+        for source in sources:
+            for kind in source.summaries:
+                source.summaries[kind] = [
+                    indexer.summaries.get(i, s)
+                    for i, s in zip(source.ids[kind], source.summaries[kind])
+                ]
+
+    report()
+
+    if error is not None:
+        # the cheap keys of the chunks left without summaries must not be cached
+        # as their summaries, the next run summarizes them again
+        logger.warning(
+            f"Summarization failed, the index is searched by cheap keys for "
+            f"{1 - indexer.completeness:.0%} of the chunks and is not saved."
+        )
+        return
+
+    for source in sources:
+        if not source.complete:
+            continue
+        if source.cached_image_summaries is None:
+            cache.save(
+                "image_summaries",
+                source.image_summary_key,
+                source.summaries["images"],
+            )
+        if summarize_texts and source.cached_text_summaries is None:
+            cache.save(
+                "text_summaries",
+                source.text_summary_key,
+                {
+                    "texts": source.summaries["texts"],
+                    "tables": source.summaries["tables"],
+                },
+            )
+
+    failed = retriever.failed_sources
+    if failed:
+        # the next run retries the failed documents instead of loading an index
+        # without them
+        logger.warning(
+            f"{len(failed)} documents failed to be extracted and are not indexed: {failed}"
+        )
+        return
+
+    if cache.enabled:
+        retriever.save()
+        cache.mark_complete("index", index_key)
+        cache.save("latest_index", lineage, {"index_key": index_key})
+
+
+def iter_windows(
+    sources: list[Source],
+    extractor: PdfExtractor,
+    image_filter: ImageFilter | None,
+    stream: bool,
+) -> Iterator[tuple[Source, Extractions]]:
+    """
+    Yields windows of extractions with their documents, the cached documents first.
+    A single document is extracted as a whole or streamed and its failure is raised.
+    Documents of a corpus are extracted in parallel and yielded in the order they
+    finish, the ones whose extraction fails are skipped and stay incomplete.
+    """
+
+    pending = []
+    for source in sources:
+        if source.cached_extractions is None:
+            pending.append(source)
+            continue
+        yield source, source.cached_extractions
+        source.complete = True
+
+    # duplicates are searched only within a document, so its cached extractions
+    # do not depend on the other documents
+    if len(sources) == 1 and pending:
+        source = pending[0]
+        if image_filter is not None:
+            image_filter.reset()
+        if stream:
+            for window in extractor.iter_extract(source.filepath):
+                yield source, remove_empty(window, image_filter)
+        else:
+            yield source, remove_empty(extractor.extract(source.filepath), image_filter)
+        source.complete = True
+        return
+
+    by_path = {s.filepath: s for s in pending}
+    for filepath, extractions in extractor.extract_many(list(by_path)):
+        if extractions is None:
+            continue
+        if image_filter is not None:
+            image_filter.reset()
+        yield by_path[filepath], remove_empty(extractions, image_filter)
+        by_path[filepath].complete = True
+
+
+def chunk_ids(
+    kind: str, extractions: list[Extraction], metadatas: list[dict[str, Any]]
+) -> list[str]:
+    if kind == "images":
+        return Retriever.image_ids(extractions, metadatas)
+    return Retriever.text_ids([e.content for e in extractions], metadatas, kind)
+
+
+def new_positions(ids: list[str], indexed: dict[str, Any]) -> list[int]:
+    """Positions of the first occurrences of the ids which are not indexed yet."""
+
+    seen = set(indexed)
+    positions = []
+    for position, i in enumerate(ids):
+        if i not in seen:
+            seen.add(i)
+            positions.append(position)
+
+    return positions
+
+
+def source_metadatas(
+    filepath: str, extractions: list[Extraction]
+) -> list[dict[str, Any]]:
+    """Metadata of the documents of the extractions, their source file and page."""
+
+    metadatas = []
+    for extraction in extractions:
+        metadata: dict[str, Any] = {"source": filepath}
+        if "page_number" in extraction.metadata:
+            metadata["page_number"] = extraction.metadata["page_number"]
+        metadatas.append(metadata)
+
+    return metadatas
+
+
+def duplicate_metadatas(
+    filepath: str, duplicates: list[Extraction], changed: list[Extraction]
+) -> dict[str, dict[str, Any]]:
+    """
+    Metadata listing the duplicates of the kept images which have some among
+    `changed`, keyed by the ids of the kept images.
+    """
+
+    originals = {e.metadata["duplicate_of"] for e in changed}
+    by_original: dict[str, list[dict[str, Any]]] = {}
+    for extraction in duplicates:
+        original = extraction.metadata["duplicate_of"]
+        if original not in originals:
+            continue
+        duplicate = {"img_path": extraction.content}
+        if "page_number" in extraction.metadata:
+            duplicate["page_number"] = extraction.metadata["page_number"]
+        by_original.setdefault(original, []).append(duplicate)
+
+    ids = Retriever.image_ids(
+        [Extraction(type=ExtractionType.IMAGE, content=p) for p in by_original],
+        [{"source": filepath} for _ in by_original],
+    )
+    return {i: {"duplicates": d} for i, d in zip(ids, by_original.values())}
+
+
+def cached_slice(
+    cached: list[str] | None, offset: int, extractions: list[Extraction]
+) -> list[str] | None:
+    """Takes summaries of the extractions from the cached ones, None without cache."""
+
+    if cached is None:
+        return None
+
+    return cached[offset : offset + len(extractions)]
+
+
+def summarize(
+    summarizer: Summarizer | OcrSummarizer,
+    extractions: list[Extraction],
+    cached: list[str] | None,
+) -> list[str]:
+    """Returns the cached summaries of the extractions or generates them."""
+
+    if cached is not None:
+        return cached
+
+    if len(extractions) > 0:
+        logger.info(
+            f"Generating summaries for {len(extractions)} {extractions[0].type.name.lower()} extractions."
+        )
+
+    return summarizer.get_summary(extractions)
+
+
+def load_extractions(cache: ArtifactCache, key: str) -> Extractions | None:
+    """Loads extractions from the cache. Returns None on a miss."""
+
+    data = cache.load("extractions", key)
+    if data is None:
+        return None
+
+    extractions = Extractions.from_dict(data)
+    # extracted images live outside of the cache and could have been removed
+    if not all(os.path.exists(e.content) for e in extractions.images):
+        logger.info("Some of the cached images are missing, extracting again.")
+        return None
+
+    return extractions
+
+
+def find_pdfs(path: str) -> list[str]:
+    """PDF files of a directory searched recursively or matching a glob, or the file."""
+
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "**", "*.pdf"), recursive=True))
+    if glob.has_magic(path):
+        return sorted(glob.glob(path, recursive=True))
+    return [path]
+
+
+def parse_query(query: str, filepaths: list[str]) -> tuple[str, list[str] | None]:
+    """
+    Splits the query into the question and the files it is restricted to. Files are
+    given by their path, name or name without the suffix.
+
+    Returns:
+    The question and the matching paths, None if the query is not restricted and
+    an empty list if no file matches.
+    """
+
+    if not query.startswith(SOURCES_PREFIX):
+        return query, None
+
+    names, _, question = query[len(SOURCES_PREFIX) :].partition(" ")
+    wanted = {n.strip() for n in names.split(",") if n.strip()}
+    sources = [f for f in filepaths if {f, os.path.basename(f), Path(f).stem} & wanted]
+
+    return question.strip(), sources
+
+
+def read_query(filepaths: list[str]) -> tuple[str, list[str] | None] | None:
+    """Reads queries until a valid one. Returns None when the user stops."""
+
+    while True:
+        query = input("Query: ")
+        if STOP_TOKEN in query:
+            return None
+
+        question, sources = parse_query(query, filepaths)
+        if sources is not None and len(sources) == 0:
+            print("None of the indexed PDFs matches the files of the query.")
+            continue
+
+        return question, sources
+
+
+def retrieval_only(filepaths: list[str], image_index: str = "llm") -> None:
+    payloads = ImagePayloadStore()
     retriever = get_retriever(
-        filepath=pdf_path,
+        filepaths=filepaths,
         max_characters=600,
         new_after_n_chars=550,
         combine_text_under_n_chars=500,
         img_summary_num_words=50,
         summarize_texts=False,
+        cache=ArtifactCache(),
+        summary_cache=TieredCache(),
+        extract_workers=EXTRACT_WORKERS,
+        route_pages=True,
+        image_index=image_index,
+        image_filter=ImageFilter(),
+        payloads=payloads,
+        vector_backend="numpy",
+        embeddings=CachedEmbeddings(),
+        collection_name=(
+            DEFAULT_COLLECTION if len(filepaths) == 1 else CORPUS_COLLECTION
+        ),
     )
 
     print(INTRO_RET_MSG)
-    while True:
-        query = input("Query: ")
-        if STOP_TOKEN in query:
-            break
+    while (query := read_query(filepaths)) is not None:
+        question, sources = query
+        print_relevant(retriever.retrieve(question, treshold=1.0, sources=sources))
 
-        print_relevant(retriever.retrieve(query, treshold=1.0))
 
+def rag_retriever(
+    filepaths: list[str],
+    image_index: str,
+    payloads: ImagePayloadStore,
+    indexer: BackgroundIndexer,
+) -> Retriever:
+    """Retriever of the chat, its documents are large chunks with summaries."""
 
-def rag(pdf_path: str) -> None:
-    retriever = get_retriever(
-        filepath=pdf_path,
+    return get_retriever(
+        filepaths=filepaths,
         max_characters=4000,
         new_after_n_chars=3800,
         combine_text_under_n_chars=2000,
         img_summary_num_words=50,
         summarize_texts=True,
         txt_summary_num_words=50,
+        pack_texts=True,
+        cache=ArtifactCache(),
+        summary_cache=TieredCache(),
+        extract_workers=EXTRACT_WORKERS,
+        route_pages=True,
+        indexer=indexer,
+        image_index=image_index,
+        image_filter=ImageFilter(),
+        payloads=payloads,
+        vector_backend="numpy",
+        embeddings=CachedEmbeddings(),
+        collection_name=(
+            DEFAULT_COLLECTION if len(filepaths) == 1 else CORPUS_COLLECTION
+        ),
     )
-    ai = Rag()
+
+
+def serve(filepaths: list[str], image_index: str = "llm") -> None:
+    payloads = ImagePayloadStore()
+    retriever = rag_retriever(filepaths, image_index, payloads, BackgroundIndexer())
+
+    QueryServer(
+        retriever=retriever, host=SERVER_HOST, port=SERVER_PORT, payloads=payloads
+    ).run()
+
+
+def serve_snapshot(path: str, reuse_port: bool = False) -> None:
+    retriever = Retriever.from_snapshot(path, embeddings=CachedEmbeddings())
+    payloads = SnapshotPayloadStore(cache_dir=None, snapshot=retriever.snapshot)
+
+    QueryServer(
+        retriever=retriever,
+        host=SERVER_HOST,
+        port=SERVER_PORT,
+        payloads=payloads,
+        reuse_port=reuse_port,
+    ).run()
+
+
+def serve_snapshot_processes(path: str, num_processes: int) -> None:
+    """
+    Serves the snapshot by several processes listening on the same port with
+    SO_REUSEPORT, the kernel spreads the connections among them. They map the same
+    snapshot file, so the index is in memory once. Conversations are kept by the
+    process which started them, a follow-up question which lands in another process
+    starts a new conversation with a new session id.
+    """
+
+    processes = [
+        multiprocessing.Process(
+            target=serve_snapshot, args=(path, True), name=f"server-{i}"
+        )
+        for i in range(num_processes)
+    ]
+    for process in processes:
+        process.start()
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # the processes got the interrupt too and stop on their own
+        for process in processes:
+            process.join()
+
+
+def export_snapshot(filepaths: list[str], image_index: str = "llm") -> None:
+    indexer = BackgroundIndexer()
+    payloads = ImagePayloadStore()
+    retriever = rag_retriever(filepaths, image_index, payloads, indexer)
+
+    # the snapshot is immutable, so it waits for the summaries
+    indexer.join()
+    if retriever.failed_sources:
+        raise RuntimeError(
+            f"{len(retriever.failed_sources)} documents failed to be indexed, the "
+            f"snapshot was not exported: {retriever.failed_sources}"
+        )
+    if indexer.error is not None:
+        raise RuntimeError(
+            "Summarization failed, the snapshot was not exported."
+        ) from indexer.error
+
+    retriever.export_snapshot(SNAPSHOT_PATH, payloads)
+    print(f"Snapshot exported to {SNAPSHOT_PATH}.")
+
+
+def rag(filepaths: list[str], image_index: str = "llm") -> None:
+    indexer = BackgroundIndexer()
+    payloads = ImagePayloadStore()
+    ai = Rag(payloads=payloads)
+    ai.warm_up()
+
+    retriever = rag_retriever(filepaths, image_index, payloads, indexer)
 
     print(INTRO_CHAT_MSG)
-    while True:
-        query = input("Query: ")
-        if STOP_TOKEN in query:
-            break
-        answer = ai.answer(query, retriever)
-        print(answer)
+    while (query := read_query(filepaths)) is not None:
+        question, sources = query
+        if indexer.error is not None:
+            print(
+                f"(Summarization failed: {indexer.error}, {indexer.completeness:.0%} of the chunks are indexed by summaries, the rest by cheap keys.)"
+            )
+        elif indexer.completeness < 1.0:
+            print(
+                f"(Summaries are still generated, {indexer.completeness:.0%} of the chunks are indexed by them.)"
+            )
+        # Ctrl+C stops the generation of the answer, not the chat
+        stream = ai.stream_answer(question, retriever, sources=sources)
+        try:
+            for token in stream:
+                print(token, end="", flush=True)
+        except KeyboardInterrupt:
+            stream.close()
+            print(" (cancelled)", end="")
+        print()
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (3, 4):
         print(USAGE, file=sys.stderr)
         sys.exit(1)
 
-    filepath = sys.argv[1]
-
     try:
         mode = int(sys.argv[2])
     except ValueError:
         print(USAGE, file=sys.stderr)
         sys.exit(1)
 
+    if sys.argv[1].endswith(SNAPSHOT_SUFFIX):
+        if mode != 2:
+            print(USAGE, file=sys.stderr)
+            sys.exit(1)
+        if SERVER_PROCESSES > 1:
+            serve_snapshot_processes(sys.argv[1], SERVER_PROCESSES)
+        else:
+            serve_snapshot(sys.argv[1])
+        sys.exit(0)
+
+    filepaths = find_pdfs(sys.argv[1])
+    if len(filepaths) == 0:
+        print(f"No PDF files found in {sys.argv[1]}.", file=sys.stderr)
+        sys.exit(1)
+    image_index = sys.argv[3] if len(sys.argv) == 4 else "llm"
+    if image_index not in IMAGE_INDEX_MODES:
+        print(USAGE, file=sys.stderr)
+        sys.exit(1)
+
     if mode == 0:
-        retrieval_only(filepath)
+        retrieval_only(filepaths, image_index)
+    elif mode == 2:
+        serve(filepaths, image_index)
+    elif mode == 3:
+        export_snapshot(filepaths, image_index)
     else:
-        rag(filepath)
+        rag(filepaths, image_index)
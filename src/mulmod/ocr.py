@@ -0,0 +1,116 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+import unstructured_pytesseract
+from PIL import Image
+
+from mulmod.extract import Extraction, ExtractionType
+from mulmod.img import describe_img_stats, get_img_stats
+from mulmod.logger import get_logger
+from mulmod.summary import Summarizer
+
+logger = get_logger(__name__)
+
+
+def ocr_workers() -> int:
+    """
+    Number of images recognized in parallel, `MULMOD_OCR_WORKERS` or at most 4.
+    Every Tesseract process takes its own memory and threads, more of them mostly
+    compete for the same cores.
+    """
+
+    return int(os.environ.get("MULMOD_OCR_WORKERS", min(4, os.cpu_count() or 1)))
+
+
+@dataclass
+class OcrSummarizer:
+    """
+    Builds retrieval keys of images without LLM. The key consists of the caption of
+    the image from the PDF, text recognized in the image by Tesseract OCR and simple
+    image statistics. It can be used in place of `Summarizer` for images.
+
+    Attributes:
+    languages:
+        Tesseract languages used for OCR.
+    max_ocr_chars:
+        Maximum number of recognized characters kept in the key.
+    min_ocr_words:
+        Images with fewer recognized words are summarized by the fallback.
+    fallback:
+        LLM summarizer for images where OCR yields too little text. If None no LLM
+        is used at all.
+    num_workers:
+        Number of images recognized in parallel, `MULMOD_OCR_WORKERS` or at most 4
+        by default.
+    """
+
+    languages: str = "eng"
+    max_ocr_chars: int = 1000
+    min_ocr_words: int = 5
+    fallback: Summarizer | None = None
+    num_workers: int = field(default_factory=ocr_workers)
+
+    def cache_params(self) -> dict[str, Any]:
+        """Parameters which influence the generated keys."""
+
+        return {
+            "ocr": self.languages,
+            "max_ocr_chars": self.max_ocr_chars,
+            "min_ocr_words": self.min_ocr_words,
+            "fallback": (
+                self.fallback.cache_params([ExtractionType.IMAGE])
+                if self.fallback
+                else None
+            ),
+        }
+
+    def get_summary(self, extractions: list[Extraction]) -> list[str]:
+        """Generates list of retrieval keys of the image extractions."""
+
+        if len(extractions) == 0:
+            return []
+
+        paths = [e.content for e in extractions]
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            ocr_texts = list(executor.map(self.ocr, paths))
+            stats = list(executor.map(get_img_stats, paths))
+
+        keys = [
+            get_key(e.metadata.get("caption", ""), text, describe_img_stats(s))
+            for e, text, s in zip(extractions, ocr_texts, stats)
+        ]
+
+        if self.fallback is not None:
+            sparse = [
+                i for i, text in enumerate(ocr_texts) if len(text.split()) < self.min_ocr_words
+            ]
+            logger.info(
+                f"OCR found too little text in {len(sparse)} of {len(extractions)} images, summarizing them with LLM."
+            )
+
+            summaries = self.fallback.get_summary([extractions[i] for i in sparse])
+            for i, summary in zip(sparse, summaries):
+                keys[i] = f"{summary}\n{keys[i]}"
+
+        return keys
+
+    def ocr(self, filepath: str) -> str:
+        with Image.open(filepath) as pil_image:
+            text = unstructured_pytesseract.image_to_string(
+                pil_image, lang=self.languages
+            )
+
+        return " ".join(text.split())[: self.max_ocr_chars]
+
+
+def get_key(caption: str, ocr_text: str, stats: str) -> str:
+    parts = []
+    if caption:
+        parts.append(f"Image caption: {caption}")
+    if ocr_text:
+        parts.append(f"Text in the image: {ocr_text}")
+    parts.append(stats)
+
+    return "\n".join(parts)
@@ -1,6 +1,7 @@
 from abc import abstractmethod
 from typing import Any, Optional
 
+import numpy as np
 from langchain.retrievers.multi_vector import (
     MultiVectorRetriever,
     SearchType,
@@ -12,23 +13,30 @@ from langchain_core.callbacks import (
 from langchain_core.documents import Document
 from langchain_core.load.dump import dumpd
 from langchain_core.retrievers import BaseRetriever
+from langchain_community.vectorstores.chroma import Chroma
+
+from mulmod.retrieve.numpy_store import NumpyVectorStore, mmr, normalize
 
 
 class MyBaseRetriever(BaseRetriever):
     """
     Copied from langchain_core.retrievers and slightly modified so it
-    returns also similarities scores in similarity search. In mmr it returns
-    dummy zeroes.
+    returns also similarities scores.
     """
 
     @abstractmethod
     def _get_relevant_documents_with_score(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        filter: Optional[dict[str, Any]] = None,
     ) -> list[tuple[Document, float]]:
         """Get documents relevant to a query with their score.
         Args:
             query: String to find relevant documents for
             run_manager: The callbacks handler to use
+            filter: Metadata filter of the searched documents
         Returns:
             List of relevant documents and their score.
         """
@@ -41,11 +49,14 @@ class MyBaseRetriever(BaseRetriever):
         tags: Optional[list[str]] = None,
         metadata: Optional[dict[str, Any]] = None,
         run_name: Optional[str] = None,
+        filter: Optional[dict[str, Any]] = None,
         **kwargs: Any,
     ) -> list[tuple[Document, float]]:
         """Retrieve documents relevant to a query with their score.
         Args:
             query: string to find relevant documents for
+            filter: Metadata filter of the searched documents, e.g.
+                {"source": {"$in": [...]}}. Defaults to None
             callbacks: Callback manager or list of callbacks
             tags: Optional list of tags associated with the retriever. Defaults to None
                 These tags will be associated with each call to this retriever,
@@ -76,10 +87,12 @@ class MyBaseRetriever(BaseRetriever):
             _kwargs = kwargs if self._expects_other_args else {}
             if self._new_arg_supported:
                 result = self._get_relevant_documents_with_score(
-                    query, run_manager=run_manager, **_kwargs
+                    query, run_manager=run_manager, filter=filter, **_kwargs
                 )
             else:
-                result = self._get_relevant_documents_with_score(query, **_kwargs)
+                result = self._get_relevant_documents_with_score(
+                    query, filter=filter, **_kwargs
+                )
         except Exception as e:
             run_manager.on_retriever_error(e)
             raise e
@@ -93,28 +106,36 @@ class MyBaseRetriever(BaseRetriever):
 class MyMultiVectorRetriever(MultiVectorRetriever, MyBaseRetriever):
     """
     Copied from langchain.retrievers.multi_vector._get_relevant_documents and
-    slightly modified so it returns also similarities scores in similarity search.
-    In mmr it returns dummy zeroes.
+    slightly modified so it returns also similarities scores. Also in mmr, where the
+    diversity selection runs over vectors of the candidates fetched by one search.
     """
 
     def _get_relevant_documents_with_score(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        filter: Optional[dict[str, Any]] = None,
     ) -> list[tuple[Document, float]]:
         """Get documents relevant to a query.
         Args:
             query: String to find relevant documents for
             run_manager: The callbacks handler to use
+            filter: Metadata filter of the searched documents
         Returns:
             List of relevant documents with their scores
         """
+        search_kwargs = dict(self.search_kwargs)
+        if filter is not None:
+            search_kwargs["filter"] = filter
+
         if self.search_type == SearchType.mmr:
-            sub_docs = self.vectorstore.max_marginal_relevance_search(
-                query, **self.search_kwargs
+            sub_docs_with_sims = self.max_marginal_relevance_with_score(
+                self.vectorstore.embeddings.embed_query(query), **search_kwargs
             )
-            sub_docs_with_sims = [(d, 0) for d in sub_docs]  # add dummy sim
         else:
             sub_docs_with_sims = self.vectorstore.similarity_search_with_score(
-                query, **self.search_kwargs
+                query, **search_kwargs
             )
 
         # We do this to maintain the order of the ids that are returned
@@ -126,3 +147,132 @@ class MyMultiVectorRetriever(MultiVectorRetriever, MyBaseRetriever):
                 sims.append(sim)
         docs = self.docstore.mget(ids)
         return [(d, s) for d, s in zip(docs, sims) if d is not None]
+
+    def get_relevant_documents_with_score_many(
+        self,
+        queries: list[str],
+        query_vectors: list[list[float]],
+        k: int,
+        filter: Optional[dict[str, Any]] = None,
+    ) -> list[list[tuple[Document, float]]]:
+        """Get documents relevant to many queries at once, without callbacks.
+        Args:
+            queries: Strings to find relevant documents for
+            query_vectors: Embeddings of the queries
+            k: Number of searched keys per query
+            filter: Metadata filter of the searched documents
+        Returns:
+            List of relevant documents with their scores for every query, the
+            documents are read from the docstore by a single call
+        """
+        if self.search_type == SearchType.mmr:
+            search_kwargs = {**self.search_kwargs, "k": k, "filter": filter}
+            sub_results = [
+                self.max_marginal_relevance_with_score(v, **search_kwargs)
+                for v in query_vectors
+            ]
+        elif isinstance(self.vectorstore, NumpyVectorStore):
+            vectors = normalize(np.asarray(query_vectors, dtype=np.float32))
+            sub_results = self.vectorstore.similarity_search_by_vectors_with_score(
+                vectors, k, filter
+            )
+        elif isinstance(self.vectorstore, Chroma):
+            results = self.vectorstore._collection.query(
+                query_embeddings=query_vectors,
+                n_results=k,
+                where=filter,
+                include=["documents", "metadatas", "distances"],
+            )
+            sub_results = [
+                [
+                    (Document(page_content=d, metadata=m or {}), s)
+                    for d, m, s in zip(docs, metadatas, distances)
+                ]
+                for docs, metadatas, distances in zip(
+                    results["documents"], results["metadatas"], results["distances"]
+                )
+            ]
+        else:
+            sub_results = [
+                self.vectorstore.similarity_search_with_score(query, k=k, filter=filter)
+                for query in queries
+            ]
+
+        # We do this to maintain the order of the ids that are returned
+        ids_with_sims = []
+        for sub_docs_with_sims in sub_results:
+            sims: dict[str, float] = {}
+            for d, sim in sub_docs_with_sims:
+                if self.id_key in d.metadata:
+                    sims.setdefault(d.metadata[self.id_key], sim)
+            ids_with_sims.append(sims)
+
+        ids = list(dict.fromkeys(i for sims in ids_with_sims for i in sims))
+        docs = dict(zip(ids, self.docstore.mget(ids)))
+        return [
+            [(docs[i], s) for i, s in sims.items() if docs[i] is not None]
+            for sims in ids_with_sims
+        ]
+
+    def max_marginal_relevance_with_score(
+        self,
+        query_vector: list[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: Optional[dict[str, Any]] = None,
+    ) -> list[tuple[Document, float]]:
+        """Select documents by maximal marginal relevance with their distances.
+        Args:
+            query_vector: Embedding of the query
+            k: Number of selected documents
+            fetch_k: Number of the most similar documents selected from
+            lambda_mult: 1 for the most similar documents, 0 for the most diverse
+            filter: Metadata filter of the searched documents
+        Returns:
+            List of selected documents and their cosine distance to the query
+        """
+        if isinstance(self.vectorstore, NumpyVectorStore):
+            vector = normalize(np.asarray([query_vector], dtype=np.float32))[0]
+            return self.vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                vector, k, fetch_k, lambda_mult, filter
+            )
+        if isinstance(self.vectorstore, Chroma):
+            return chroma_max_marginal_relevance_with_score(
+                self.vectorstore, query_vector, k, fetch_k, lambda_mult, filter
+            )
+        raise ValueError(
+            f"Scored mmr is not supported by {type(self.vectorstore).__name__}."
+        )
+
+
+def chroma_max_marginal_relevance_with_score(
+    vectorstore: Chroma,
+    query_vector: list[float],
+    k: int = 4,
+    fetch_k: int = 20,
+    lambda_mult: float = 0.5,
+    filter: Optional[dict[str, Any]] = None,
+) -> list[tuple[Document, float]]:
+    """Mmr over Chroma, the candidates are fetched with their embeddings by one query."""
+    results = vectorstore._collection.query(
+        query_embeddings=[query_vector],
+        n_results=max(k, fetch_k),
+        where=filter,
+        include=["documents", "metadatas", "distances", "embeddings"],
+    )
+    if len(results["ids"][0]) == 0:
+        return []
+
+    distances = np.asarray(results["distances"][0], dtype=np.float32)
+    vectors = normalize(np.asarray(results["embeddings"][0], dtype=np.float32))
+    return [
+        (
+            Document(
+                page_content=results["documents"][0][i],
+                metadata=results["metadatas"][0][i] or {},
+            ),
+            float(distances[i]),
+        )
+        for i in mmr(1.0 - distances, vectors, k, lambda_mult)
+    ]
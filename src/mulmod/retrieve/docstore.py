@@ -0,0 +1,193 @@
+import json
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Iterator, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.stores import BaseStore
+
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+DOCSTORE_DB = "docstore.sqlite"
+
+# number of ids bound to a single query, older SQLite allows at most 999 variables
+QUERY_BATCH = 500
+
+
+class SqliteDocStore(BaseStore[str, Document]):
+    """
+    Docstore keeping the parent documents zlib-compressed in a single SQLite file.
+    Documents are decompressed only when they are requested, and the most recently
+    used of them are kept in an in-process LRU, so the resident memory does not
+    grow with the corpus. The source file of every document is kept in an indexed
+    column, so the documents of a source are found without decompressing the
+    others. Every write is committed right away, so the store persists across runs
+    without an explicit save. It is safe to use from multiple threads.
+
+    Attributes:
+    path:
+        Path to the database file. If None the database is kept in memory, still
+        compressed.
+    max_items:
+        Maximum number of documents in the in-process LRU.
+    compression_level:
+        zlib compression level of the stored documents.
+    """
+
+    def __init__(
+        self,
+        path: str | None = None,
+        max_items: int = 256,
+        compression_level: int = 6,
+    ) -> None:
+        self.path = path
+        self.max_items = max_items
+        self.compression_level = compression_level
+
+        self.lock = threading.Lock()
+        self.memory: OrderedDict[str, Document] = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+        self.connection = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, source TEXT, data BLOB NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS documents_source ON documents (source)"
+        )
+        self.connection.commit()
+
+    def __len__(self) -> int:
+        with self.lock:
+            row = self.connection.execute("SELECT COUNT(*) FROM documents").fetchone()
+        return row[0]
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "memory_items": len(self.memory),
+            }
+
+    def mget(self, keys: Sequence[str]) -> list[Document | None]:
+        found: dict[str, Document] = {}
+
+        with self.lock:
+            missing = []
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+                    self.memory_hits += 1
+                elif key not in found:
+                    missing.append(key)
+
+            for batch in batches(list(dict.fromkeys(missing))):
+                rows = self.connection.execute(
+                    f"SELECT id, data FROM documents WHERE id IN ({placeholders(batch)})",
+                    batch,
+                ).fetchall()
+                for key, data in rows:
+                    found[key] = self.decode(data)
+                    self.remember(key, found[key])
+                self.disk_hits += len(rows)
+
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, Document]]) -> None:
+        rows = [
+            (key, doc.metadata.get("source"), self.encode(doc))
+            for key, doc in key_value_pairs
+        ]
+
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO documents (id, source, data) VALUES (?, ?, ?)",
+                rows,
+            )
+            self.connection.commit()
+            for key, doc in key_value_pairs:
+                if key in self.memory:
+                    self.memory[key] = doc
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self.lock:
+            for batch in batches(list(keys)):
+                self.connection.execute(
+                    f"DELETE FROM documents WHERE id IN ({placeholders(batch)})", batch
+                )
+                for key in batch:
+                    self.memory.pop(key, None)
+            self.connection.commit()
+
+    def yield_keys(self, prefix: str | None = None) -> Iterator[str]:
+        with self.lock:
+            if prefix is None:
+                keys = self.connection.execute("SELECT id FROM documents").fetchall()
+            else:
+                # GLOB is case sensitive like the prefix match of InMemoryStore
+                keys = self.connection.execute(
+                    "SELECT id FROM documents WHERE id GLOB ?",
+                    (escape_glob(prefix) + "*",),
+                ).fetchall()
+
+        for (key,) in keys:
+            yield key
+
+    def ids_by_source(self) -> dict[str, set[str]]:
+        """Returns ids of the documents grouped by their source file."""
+
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT source, id FROM documents WHERE source IS NOT NULL"
+            ).fetchall()
+
+        sources: dict[str, set[str]] = {}
+        for source, key in rows:
+            sources.setdefault(source, set()).add(key)
+        return sources
+
+    def remember(self, key: str, doc: Document) -> None:
+        self.memory[key] = doc
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def encode(self, doc: Document) -> bytes:
+        return encode_document(doc, self.compression_level)
+
+    @staticmethod
+    def decode(data: bytes) -> Document:
+        return decode_document(data)
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+def encode_document(doc: Document, compression_level: int = 6) -> bytes:
+    data = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata})
+    return zlib.compress(data.encode("utf-8"), compression_level)
+
+
+def decode_document(data: bytes) -> Document:
+    return Document(**json.loads(zlib.decompress(data).decode("utf-8")))
+
+
+def batches(keys: list[str]) -> Iterator[list[str]]:
+    for start in range(0, len(keys), QUERY_BATCH):
+        yield keys[start : start + QUERY_BATCH]
+
+
+def placeholders(batch: list[str]) -> str:
+    return ", ".join("?" for _ in batch)
+
+
+def escape_glob(prefix: str) -> str:
+    return "".join(f"[{c}]" if c in "*?[" else c for c in prefix)
@@ -0,0 +1,242 @@
+import base64
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import numpy as np
+from langchain_community.embeddings import GPT4AllEmbeddings
+from langchain_core.embeddings import Embeddings
+from langchain_core.pydantic_v1 import BaseModel
+
+from mulmod.cache import TieredCache, hash_params
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+worker_embeddings: Embeddings | None = None
+
+
+def init_worker(model: Embeddings | Callable[[], Embeddings], model_key: str) -> None:
+    """
+    Loads the embedding model once in every worker process and checks it is the
+    model whose key the vectors are cached under.
+    """
+
+    global worker_embeddings
+    worker_embeddings = model if isinstance(model, Embeddings) else model()
+    if hash_params(model_params(worker_embeddings)) != model_key:
+        raise ValueError(
+            "Embedding model of the worker differs from the configured one, pass "
+            "model_factory building the configured model."
+        )
+
+
+def embed_in_worker(texts: list[str]) -> list[list[float]]:
+    assert worker_embeddings is not None
+    return worker_embeddings.embed_documents(texts)
+
+
+def model_params(embeddings: Embeddings) -> dict[str, Any]:
+    """
+    Parameters which determine the vectors of the model: its class, its settings
+    or plain attributes, and the model file of GPT4All, whose LangChain wrapper has
+    no settings.
+    """
+
+    # spawned workers import the main script as __mp_main__
+    module = type(embeddings).__module__.replace("__mp_main__", "__main__")
+    params: dict[str, Any] = {"class": f"{module}.{type(embeddings).__qualname__}"}
+    if isinstance(embeddings, BaseModel):
+        params.update(embeddings.dict(exclude={"client"}))
+    else:
+        params.update(
+            (name, value)
+            for name, value in vars(embeddings).items()
+            if isinstance(value, (str, int, float, bool, type(None)))
+        )
+
+    gpt4all = getattr(getattr(embeddings, "client", None), "gpt4all", None)
+    config = getattr(gpt4all, "config", None)
+    if isinstance(config, dict):
+        params["model"] = config.get("filename") or config.get("path")
+
+    return params
+
+
+@dataclass
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings which are computed in batches, optionally by several worker
+    processes, and cached by a hash of the model parameters and the text in an
+    in-process LRU backed by files on disk. Both documents and queries are cached,
+    so restarts and repeated queries do not run the model again. The model is not
+    safe to call from several threads, so its calls are serialized and only the
+    cache lookups run in parallel.
+
+    Attributes:
+    embeddings:
+        Embedding model which computes the missing embeddings. If None it is built
+        by `model_factory`.
+    model_factory:
+        Picklable callable building the model, e.g. a class or a functools.partial,
+        which every worker process calls to load its own copy. If None the workers
+        get a pickled copy of `embeddings`. GPT4All can not be pickled, so the
+        workers build it by its class and fail if its model file differs.
+    batch_size:
+        Number of texts embedded by one call of the model.
+    num_workers:
+        Number of worker processes embedding batches in parallel, each of them
+        loads its own model.
+    cache_dir:
+        Directory of the disk tier. If None only the in-process tier is used.
+    max_items:
+        Maximum number of embeddings in the in-process tier.
+    max_disk_mb:
+        Size cap of the disk tier.
+    """
+
+    embeddings: Embeddings | None = None
+    model_factory: Callable[[], Embeddings] | None = None
+    batch_size: int = 32
+    num_workers: int = 1
+    cache_dir: str | None = "./resources/cache/embeddings"
+    max_items: int = 16384
+    max_disk_mb: float = 512
+
+    def __post_init__(self) -> None:
+        if self.embeddings is None:
+            self.embeddings = (self.model_factory or GPT4AllEmbeddings)()
+        self.model: Embeddings = self.embeddings
+        self.model_key = hash_params(model_params(self.model))
+
+        self.cache = TieredCache(
+            label="embeddings",
+            cache_dir=self.cache_dir,
+            max_items=self.max_items,
+            max_disk_mb=self.max_disk_mb,
+        )
+        self.lock = threading.Lock()
+        self.model_lock = threading.Lock()
+        self.embedded = 0
+        self.embedding_time = 0.0
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                **self.cache.stats(),
+                "embedded": self.embedded,
+                "embeddings_per_second": (
+                    self.embedded / self.embedding_time if self.embedding_time else 0.0
+                ),
+            }
+
+    def key(self, kind: str, text: str) -> str:
+        return hash_params(self.model_key, kind, text)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embed_cached("document", texts)
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds many queries in batches. They share the cache with `embed_query`, but
+        the missing ones are computed like documents, GPT4All embeds both alike.
+        """
+
+        return self.embed_cached("query", texts)
+
+    def embed_cached(self, kind: str, texts: list[str]) -> list[list[float]]:
+        keys = [self.key(kind, t) for t in texts]
+        vectors = [self.load(k) for k in keys]
+
+        missing: dict[str, str] = {}
+        for key, text, vector in zip(keys, texts, vectors):
+            if vector is None:
+                missing.setdefault(key, text)
+
+        computed = dict(zip(missing, self.compute(list(missing.values()))))
+        for key, vector in computed.items():
+            self.store(key, vector)
+
+        if len(missing) > 0:
+            logger.info(
+                f"Embedded {len(missing)} texts, reused {len(texts) - len(missing)}. {self.stats()['embeddings_per_second']:.1f} embeddings/s."
+            )
+
+        return [v if v is not None else computed[k] for k, v in zip(keys, vectors)]
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.key("query", text)
+        vector = self.load(key)
+        if vector is not None:
+            return vector
+
+        with self.model_lock:
+            # another thread may have embedded the same query meanwhile
+            vector = self.load(key)
+            if vector is not None:
+                return vector
+
+            start = time.monotonic()
+            vector = self.model.embed_query(text)
+            self.record(1, time.monotonic() - start)
+        self.store(key, vector)
+
+        return vector
+
+    def compute(self, texts: list[str]) -> list[list[float]]:
+        """Embeds the texts in batches, by worker processes if there are more of them."""
+
+        if len(texts) == 0:
+            return []
+
+        batches = [
+            texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)
+        ]
+
+        start = time.monotonic()
+        if self.num_workers > 1 and len(batches) > 1:
+            with self.get_executor(min(self.num_workers, len(batches))) as executor:
+                results = list(executor.map(embed_in_worker, batches))
+        else:
+            results = [self.embed_batch(b) for b in batches]
+        self.record(len(texts), time.monotonic() - start)
+
+        return [vector for batch in results for vector in batch]
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]]:
+        with self.model_lock:
+            return self.model.embed_documents(texts)
+
+    def get_executor(self, num_workers: int) -> ProcessPoolExecutor:
+        model: Embeddings | Callable[[], Embeddings] | None = self.model_factory
+        if model is None:
+            model = (
+                GPT4AllEmbeddings
+                if isinstance(self.model, GPT4AllEmbeddings)
+                else self.model
+            )
+
+        return ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(model, self.model_key),
+        )
+
+    def record(self, count: int, seconds: float) -> None:
+        with self.lock:
+            self.embedded += count
+            self.embedding_time += seconds
+
+    def load(self, key: str) -> list[float] | None:
+        encoded = self.cache.get(key)
+        if encoded is None:
+            return None
+        return np.frombuffer(base64.b64decode(encoded), dtype=np.float32).tolist()
+
+    def store(self, key: str, vector: list[float]) -> None:
+        encoded = base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes())
+        self.cache.put(key, encoded.decode("ascii"))
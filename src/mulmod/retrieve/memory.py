@@ -0,0 +1,177 @@
+from dataclasses import dataclass
+from typing import Any
+
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.messages.base import BaseMessage
+
+from mulmod.llm import OllamaChat, estimate_tokens
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+# llava encodes an image into 576 tokens regardless of its size
+IMAGE_TOKENS = 576
+
+SUMMARY_PROMPT = """Update the summary of a conversation about a research paper with \
+the new turns below. Keep the facts the user asked about and the answers given, in at \
+most {num_words} words. Answer only with the updated summary.
+Current summary: {summary}
+New turns:
+{turns}"""
+
+SUMMARY_INTRO = "Summary of the earlier conversation:"
+
+
+@dataclass
+class Turn:
+    """
+    Single question and answer of the conversation.
+
+    Attributes:
+    query:
+        Question as asked by the user.
+    message:
+        Message sent to the LLM, with the retrieved texts and images.
+    answer:
+        Answer of the LLM.
+    """
+
+    query: str
+    message: HumanMessage
+    answer: AIMessage
+
+
+@dataclass
+class ConversationMemory:
+    """
+    Conversation history of `Rag` within a token budget. The system message and the
+    last `keep_turns` turns are sent verbatim. Older turns are sent without their
+    images, and when the prompt would exceed the budget the oldest of them are
+    compressed into a running summary which follows the system message. The system
+    message itself never changes, so the backend can reuse its evaluated context.
+
+    Attributes:
+    sys_msg:
+        System message introducing the LLMs role.
+    token_budget:
+        Estimated number of prompt tokens of a single request.
+    keep_turns:
+        Number of the last turns which are kept verbatim.
+    model:
+        Name of the Ollama model compressing the old turns.
+    summary_num_words:
+        Target length of the running summary.
+    summary_prompt:
+        Prompt template for updating the running summary.
+    """
+
+    sys_msg: str
+    token_budget: int = 4000
+    keep_turns: int = 2
+    model: str = "llava"
+    summary_num_words: int = 150
+    summary_prompt: str = SUMMARY_PROMPT
+
+    def __post_init__(self) -> None:
+        self.turns: list[Turn] = []
+        self.summary = ""
+        self.prompt_tokens: list[int] = []
+
+    def add_turn(self, query: str, message: HumanMessage, answer: AIMessage) -> None:
+        self.turns.append(Turn(query=query, message=message, answer=answer))
+
+    def messages(self, message: HumanMessage) -> list[BaseMessage]:
+        """
+        Returns the messages of the next request ending with `message`. Old turns are
+        compressed first if the request would not fit the token budget.
+        """
+
+        msgs = self.build(message)
+        tokens = count_tokens(msgs)
+
+        num_old = max(0, len(self.turns) - self.keep_turns)
+        if tokens > self.token_budget and num_old > 0:
+            self.compress(num_old)
+            msgs = self.build(message)
+            tokens = count_tokens(msgs)
+
+        if tokens > self.token_budget:
+            logger.warning(
+                f"Prompt of about {tokens} tokens exceeds the budget of {self.token_budget} tokens."
+            )
+
+        self.prompt_tokens.append(tokens)
+        logger.info(
+            f"Prompt of turn {len(self.prompt_tokens)} has about {tokens} tokens, {len(self.turns)} turns in the history."
+        )
+
+        return msgs
+
+    def build(self, message: HumanMessage) -> list[BaseMessage]:
+        msgs: list[BaseMessage] = [SystemMessage(content=self.sys_msg)]
+        if self.summary:
+            msgs.append(SystemMessage(content=f"{SUMMARY_INTRO} {self.summary}"))
+
+        num_old = max(0, len(self.turns) - self.keep_turns)
+        for i, turn in enumerate(self.turns):
+            msgs.append(without_images(turn.message) if i < num_old else turn.message)
+            msgs.append(turn.answer)
+
+        msgs.append(message)
+
+        return msgs
+
+    def compress(self, num_turns: int) -> None:
+        """Folds the oldest turns into the running summary and drops them."""
+
+        turns = "\n".join(
+            f"User: {t.query}\nAssistant: {t.answer.content}"
+            for t in self.turns[:num_turns]
+        )
+        prompt = self.summary_prompt.format(
+            num_words=self.summary_num_words,
+            summary=self.summary or "(empty)",
+            turns=turns,
+        )
+
+        llm = OllamaChat(model=self.model, num_predict=2 * self.summary_num_words)
+        self.summary = str(llm.invoke([HumanMessage(content=prompt)]).content).strip()
+        self.turns = self.turns[num_turns:]
+
+        logger.info(f"Compressed {num_turns} old turns into the conversation summary.")
+
+
+def without_images(message: HumanMessage) -> HumanMessage:
+    """Copy of a multimodal message with only its text parts."""
+
+    if isinstance(message.content, str):
+        return message
+
+    parts: list[str | dict[str, Any]] = [
+        p for p in message.content if not is_image_part(p)
+    ]
+    return HumanMessage(content=parts)
+
+
+def is_image_part(part: str | dict[str, Any]) -> bool:
+    return isinstance(part, dict) and part.get("type") == "image_url"
+
+
+def count_tokens(msgs: list[BaseMessage]) -> int:
+    """Rough number of prompt tokens of the messages, images count as a fixed cost."""
+
+    tokens = 0
+    for msg in msgs:
+        if isinstance(msg.content, str):
+            tokens += estimate_tokens(msg.content)
+            continue
+
+        for part in msg.content:
+            if is_image_part(part):
+                tokens += IMAGE_TOKENS
+            elif isinstance(part, dict):
+                tokens += estimate_tokens(str(part.get("text", "")))
+            else:
+                tokens += estimate_tokens(part)
+
+    return tokens
@@ -0,0 +1,764 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import zlib
+from typing import Any, Iterable, Iterator, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+VECTORS_FILE = "vectors.f16"
+ROWS_FILE = "rows.json"
+ROWS_DB = "rows.sqlite"
+
+# rows converted to float32 at once by a query, small blocks stay in the CPU cache
+SEARCH_BLOCK = 512
+# queries scored at once by a batched search, bounds the matrix of similarities
+QUERY_BLOCK = 64
+# number of rows bound to a single query, older SQLite allows at most 999 variables
+ROWS_BATCH = 500
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Vector store with exact cosine search. Normalized embeddings are kept in a float16
+    matrix, memory-mapped from the persist directory if there is one, and a query is
+    scored against all of them with one matrix product per block of rows.
+
+    Converting float16 to float32 costs more than the product itself, so a float32
+    copy of the matrix is kept in memory while it fits `max_float32_mb`. Larger
+    matrices are converted block by block on every query.
+
+    Scores are cosine distances like the ones of Chroma with cosine space, so lower
+    is more similar. Searches can be restricted by a metadata filter in the syntax of
+    Chroma, either `{key: value}` or `{key: {"$in": [values]}}`.
+
+    Texts and metadata of the rows are kept in a SQLite file next to the matrix, the
+    texts zlib-compressed, and are read only for the found rows. Metadata of the
+    `filter_keys` is also kept in memory as columns of int32 codes, so filters on
+    them do not read the file. In memory stay just the ids, the columns and the
+    float32 copy of the matrix.
+
+    Attributes:
+    embedding:
+        Embeddings of the texts and queries.
+    persist_directory:
+        Directory of the memory-mapped matrix and of the texts. If it already
+        contains a store then it is loaded from it. If None everything is kept only
+        in memory, the texts still compressed.
+    initial_capacity:
+        Number of rows allocated at first, the capacity doubles when it is full.
+    max_float32_mb:
+        Size cap of the float32 copy of the matrix.
+    filter_keys:
+        Metadata keys kept in memory for filtering, filters on other keys read the
+        metadata of all rows from the file.
+    compact_fraction:
+        Fraction of deleted and replaced rows at which the matrix and the texts are
+        rewritten without them. They are also dropped when the store is persisted.
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: str | None = None,
+        initial_capacity: int = 1024,
+        max_float32_mb: float = 256,
+        filter_keys: tuple[str, ...] = ("source",),
+        compact_fraction: float = 0.25,
+    ) -> None:
+        self.embedding = embedding
+        self.persist_directory = persist_directory
+        self.initial_capacity = initial_capacity
+        self.max_float32_mb = max_float32_mb
+        self.filter_keys = filter_keys
+        self.compact_fraction = compact_fraction
+
+        self.lock = threading.Lock()
+
+        self.ids: list[str] = []
+        self.alive = np.zeros(0, dtype=bool)
+        self.rows: dict[str, int] = {}
+        self.dim = 0
+        self.vectors = np.zeros((0, 0), dtype=np.float16)
+        self.vectors32: np.ndarray | None = None
+        # codes of the values of the filter keys per row
+        self.column_values: dict[str, dict[Any, int]] = {k: {} for k in filter_keys}
+        self.column_codes = {k: np.zeros(0, dtype=np.int32) for k in filter_keys}
+
+        if persist_directory is not None:
+            os.makedirs(persist_directory, exist_ok=True)
+        self.connection = sqlite3.connect(
+            (
+                os.path.join(persist_directory, ROWS_DB)
+                if persist_directory is not None
+                else ":memory:"
+            ),
+            check_same_thread=False,
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rows "
+            "(row INTEGER PRIMARY KEY, text BLOB NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self.connection.commit()
+
+        if persist_directory is not None:
+            self.load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    @property
+    def size(self) -> int:
+        return len(self.ids)
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: list[dict] | None = None,
+        ids: list[str] | None = None,
+        **kwargs: Any,
+    ) -> list[str]:
+        texts = list(texts)
+        if len(texts) == 0:
+            return []
+
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self.embed(texts)
+
+        with self.lock:
+            self.reserve(self.size + len(texts), vectors.shape[1])
+
+            start = self.size
+            rows = np.arange(start, start + len(texts))
+            self.vectors[start : start + len(texts)] = vectors
+            self.write_rows(rows, texts, metadatas)
+            for row, i in zip(rows, ids):
+                if i in self.rows:
+                    self.alive[self.rows[i]] = False
+                self.rows[i] = int(row)
+                self.ids.append(i)
+            self.alive[start : start + len(texts)] = True
+            self.rows_changed(rows)
+            self.compact_if_sparse()
+
+        return ids
+
+    def update_documents(self, ids: list[str], documents: list[Document]) -> None:
+        """Replaces texts and vectors of the documents in place."""
+
+        vectors = self.embed([d.page_content for d in documents])
+
+        with self.lock:
+            rows = np.asarray([self.rows[i] for i in ids], dtype=np.int64)
+            self.vectors[rows] = vectors
+            self.write_rows(
+                rows,
+                [d.page_content for d in documents],
+                [d.metadata for d in documents],
+            )
+            self.rows_changed(rows)
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        if ids is None:
+            return False
+
+        with self.lock:
+            rows = np.asarray(
+                [r for r in (self.rows.pop(i, None) for i in ids) if r is not None],
+                dtype=np.int64,
+            )
+            self.alive[rows] = False
+            self.vectors[rows] = 0
+            self.rows_changed(rows)
+            self.compact_if_sparse()
+
+        return True
+
+    def rows_changed(self, rows: np.ndarray) -> None:
+        """Keeps the float32 copy in sync with changed rows of the matrix."""
+
+        if self.vectors32 is None:
+            return
+        if len(rows) and rows.max() >= len(self.vectors32):
+            self.vectors32 = None
+            return
+        self.vectors32[rows] = self.vectors[rows]
+
+    def compact_if_sparse(self) -> None:
+        dead = self.size - len(self.rows)
+        if dead > 0 and dead >= self.compact_fraction * self.size:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Moves the live rows to the front of the matrix and of the texts, in their
+        order, and drops the deleted and replaced ones. A memory-mapped matrix is
+        copied into a new file of the capacity the live rows need, so the file
+        shrinks. Must be called with the lock held.
+        """
+
+        live = np.flatnonzero(self.alive[: self.size])
+        if len(live) == self.size:
+            return
+
+        capacity = self.initial_capacity
+        while capacity < len(live):
+            capacity *= 2
+
+        if self.persist_directory is None:
+            vectors = np.zeros((capacity, self.dim), dtype=np.float16)
+            vectors[: len(live)] = self.vectors[live]
+            self.vectors = vectors
+        else:
+            path = os.path.join(self.persist_directory, VECTORS_FILE)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            vectors = np.memmap(
+                tmp_path, dtype=np.float16, mode="w+", shape=(capacity, self.dim)
+            )
+            # copied block by block, the matrix is never read into memory at once
+            for start in range(0, len(live), SEARCH_BLOCK):
+                block = live[start : start + SEARCH_BLOCK]
+                vectors[start : start + len(block)] = self.vectors[block]
+            vectors.flush()
+            del vectors
+            if isinstance(self.vectors, np.memmap):
+                self.vectors.flush()
+            os.replace(tmp_path, path)
+            self.vectors = np.memmap(
+                path, dtype=np.float16, mode="r+", shape=(capacity, self.dim)
+            )
+
+        with self.connection:
+            self.connection.execute("BEGIN")
+            self.connection.execute(
+                "CREATE TEMP TABLE moved (old INTEGER, new INTEGER)"
+            )
+            self.connection.executemany(
+                "INSERT INTO moved (old, new) VALUES (?, ?)",
+                zip(live.tolist(), range(len(live))),
+            )
+            self.connection.execute(
+                "CREATE TABLE compacted "
+                "(row INTEGER PRIMARY KEY, text BLOB NOT NULL, metadata TEXT NOT NULL)"
+            )
+            self.connection.execute(
+                "INSERT INTO compacted (row, text, metadata) "
+                "SELECT moved.new, rows.text, rows.metadata "
+                "FROM rows JOIN moved ON rows.row = moved.old"
+            )
+            self.connection.execute("DROP TABLE rows")
+            self.connection.execute("ALTER TABLE compacted RENAME TO rows")
+            self.connection.execute("DROP TABLE moved")
+        # returns the pages of the dropped rows to the file system
+        self.connection.execute("VACUUM")
+
+        self.ids = [self.ids[r] for r in live]
+        self.rows = {i: r for r, i in enumerate(self.ids)}
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.alive[: len(live)] = True
+        for key, codes in self.column_codes.items():
+            self.column_codes[key] = np.zeros(capacity, dtype=np.int32)
+            self.column_codes[key][: len(live)] = codes[live]
+        self.rows_compacted(live)
+
+        logger.info(f"Compacted the vector store to {len(live)} rows.")
+
+        if self.persist_directory is not None:
+            # the ids on disk have to match the rewritten matrix
+            self.write_ids()
+
+    def rows_compacted(self, live: np.ndarray) -> None:
+        """Moves the live rows of the float32 copy to its front."""
+
+        if self.vectors32 is not None:
+            self.vectors32 = self.vectors32[live]
+
+    def write_rows(
+        self, rows: np.ndarray, texts: list[str], metadatas: list[dict[str, Any]]
+    ) -> None:
+        """Stores texts and metadata of the rows and codes of their filter keys."""
+
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO rows (row, text, metadata) VALUES (?, ?, ?)",
+            [
+                (int(r), zlib.compress(t.encode("utf-8")), json.dumps(m))
+                for r, t, m in zip(rows, texts, metadatas)
+            ],
+        )
+        self.connection.commit()
+        self.set_codes(rows, metadatas)
+
+    def set_codes(
+        self, rows: Iterable[int], metadatas: Iterable[dict[str, Any]]
+    ) -> None:
+        for row, metadata in zip(rows, metadatas):
+            for key, values in self.column_values.items():
+                self.column_codes[key][row] = values.setdefault(
+                    metadata.get(key), len(values)
+                )
+
+    def row_documents(self, rows: Sequence[int]) -> list[Document]:
+        """Texts and metadata of the rows read from the file."""
+
+        rows = [int(r) for r in rows]
+        found = {}
+        for start in range(0, len(rows), ROWS_BATCH):
+            batch = rows[start : start + ROWS_BATCH]
+            for row, text, metadata in self.connection.execute(
+                "SELECT row, text, metadata FROM rows "
+                f"WHERE row IN ({', '.join('?' * len(batch))})",
+                batch,
+            ):
+                found[row] = Document(
+                    page_content=zlib.decompress(text).decode("utf-8"),
+                    metadata=json.loads(metadata),
+                )
+
+        return [found[r] for r in rows]
+
+    def scan_metadatas(self) -> Iterator[dict[str, Any]]:
+        """Metadata of all rows in their order, rows without any have none."""
+
+        cursor = self.connection.execute(
+            "SELECT row, metadata FROM rows WHERE row < ? ORDER BY row", (self.size,)
+        )
+        expected = 0
+        for row, metadata in cursor:
+            for _ in range(expected, row):
+                yield {}
+            yield json.loads(metadata)
+            expected = row + 1
+        for _ in range(expected, self.size):
+            yield {}
+
+    def scored_documents(
+        self, rows: np.ndarray, similarities: np.ndarray
+    ) -> list[tuple[Document, float]]:
+        return [
+            (d, float(1.0 - s)) for d, s in zip(self.row_documents(rows), similarities)
+        ]
+
+    def get(self, ids: list[str] | None = None) -> dict[str, list[Any]]:
+        """
+        Returns ids, texts and metadatas of the stored documents like Chroma, only of
+        the given ids which are stored if there are some.
+        """
+
+        with self.lock:
+            if ids is None:
+                rows = sorted(self.rows.values())
+            else:
+                rows = [self.rows[i] for i in ids if i in self.rows]
+            docs = self.row_documents(rows)
+            return {
+                "ids": [self.ids[r] for r in rows],
+                "documents": [d.page_content for d in docs],
+                "metadatas": [d.metadata for d in docs],
+            }
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> list[Document]:
+        return [d for d, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[tuple[Document, float]]:
+        query_vector = self.embed_query(query)
+        return self.similarity_search_by_vector_with_score(query_vector, k, filter)
+
+    def similarity_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        vector = normalize(np.asarray([embedding], dtype=np.float32))[0]
+        return [
+            d for d, _ in self.similarity_search_by_vector_with_score(vector, k, filter)
+        ]
+
+    def similarity_search_by_vector_with_score(
+        self,
+        query_vector: np.ndarray,
+        k: int,
+        filter: dict[str, Any] | None = None,
+    ) -> list[tuple[Document, float]]:
+        with self.lock:
+            mask = self.alive[: self.size]
+            if filter is not None:
+                mask = mask & self.matching(filter)
+            top, similarities = self.search_rows(query_vector, k, mask)
+
+            return self.scored_documents(top, similarities)
+
+    def similarity_search_by_vectors_with_score(
+        self,
+        query_vectors: np.ndarray,
+        k: int,
+        filter: dict[str, Any] | None = None,
+    ) -> list[list[tuple[Document, float]]]:
+        """
+        Searches many normalized query vectors at once, the filter is evaluated only
+        once and blocks of queries are scored by one matrix product.
+        """
+
+        with self.lock:
+            mask = self.alive[: self.size]
+            if filter is not None:
+                mask = mask & self.matching(filter)
+
+            return [
+                self.scored_documents(top, similarities)
+                for top, similarities in self.search_rows_many(query_vectors, k, mask)
+            ]
+
+    def max_marginal_relevance_search(
+        self,
+        query: str,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        query_vector = self.embed_query(query)
+        return [
+            d
+            for d, _ in self.max_marginal_relevance_search_with_score_by_vector(
+                query_vector, k, fetch_k, lambda_mult, filter
+            )
+        ]
+
+    def max_marginal_relevance_search_by_vector(
+        self,
+        embedding: list[float],
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict[str, Any] | None = None,
+        **kwargs: Any,
+    ) -> list[Document]:
+        vector = normalize(np.asarray([embedding], dtype=np.float32))[0]
+        return [
+            d
+            for d, _ in self.max_marginal_relevance_search_with_score_by_vector(
+                vector, k, fetch_k, lambda_mult, filter
+            )
+        ]
+
+    def max_marginal_relevance_search_with_score_by_vector(
+        self,
+        query_vector: np.ndarray,
+        k: int = 4,
+        fetch_k: int = 20,
+        lambda_mult: float = 0.5,
+        filter: dict[str, Any] | None = None,
+    ) -> list[tuple[Document, float]]:
+        """
+        Selects k of the `fetch_k` documents most similar to a normalized query
+        vector by maximal marginal relevance, so they are relevant but not alike.
+        Vectors of the candidates are read from the matrix, nothing is embedded
+        again. Scores are cosine distances to the query like of the similarity search.
+        """
+
+        with self.lock:
+            mask = self.alive[: self.size]
+            if filter is not None:
+                mask = mask & self.matching(filter)
+            candidates, similarities = self.search_rows(
+                query_vector, max(k, fetch_k), mask
+            )
+            vectors = self.vectors[candidates].astype(np.float32)
+
+            selected = mmr(similarities, vectors, k, lambda_mult)
+            return self.scored_documents(candidates[selected], similarities[selected])
+
+    def matching(self, filter: dict[str, Any]) -> np.ndarray:
+        """Mask of the rows whose metadata match the filter."""
+
+        conditions = filter_conditions(filter)
+        if any(key not in self.column_values for key, _ in conditions):
+            return np.fromiter(
+                (
+                    all(m.get(key) in values for key, values in conditions)
+                    for m in self.scan_metadatas()
+                ),
+                dtype=bool,
+                count=self.size,
+            )
+
+        mask = np.ones(self.size, dtype=bool)
+        for key, values in conditions:
+            codes = [c for v, c in self.column_values[key].items() if v in values]
+            mask &= np.isin(self.column_codes[key][: self.size], codes)
+
+        return mask
+
+    def search_rows(
+        self, query_vector: np.ndarray, k: int, mask: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns rows of the k most similar vectors and their cosine similarities.
+        Only the rows in `mask` are searched, all live rows without it.
+        """
+
+        if mask is None:
+            mask = self.alive[: self.size]
+
+        k = min(k, int(mask.sum()))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        similarities = self.cosine_similarities(query_vector)
+        similarities[~mask] = -np.inf
+
+        top = top_k(similarities, k)
+        return top, similarities[top]
+
+    def search_rows_many(
+        self, query_vectors: np.ndarray, k: int, mask: np.ndarray | None = None
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        `search_rows` of many query vectors, scored by one matrix product per block
+        of `QUERY_BLOCK` queries.
+        """
+
+        if mask is None:
+            mask = self.alive[: self.size]
+
+        k = min(k, int(mask.sum()))
+        if k == 0:
+            empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+            return [empty for _ in query_vectors]
+
+        results = []
+        for start in range(0, len(query_vectors), QUERY_BLOCK):
+            block = query_vectors[start : start + QUERY_BLOCK]
+            similarities = self.cosine_similarities(block.T)
+            similarities[~mask] = -np.inf
+
+            top = top_k_columns(similarities, k)
+            top_similarities = np.take_along_axis(similarities, top, axis=0)
+            results += [(t, s) for t, s in zip(top.T, top_similarities.T)]
+
+        return results
+
+    def cosine_similarities(self, query_vector: np.ndarray) -> np.ndarray:
+        """
+        Similarities of all rows to a query vector, or to the columns of a matrix of
+        query vectors.
+        """
+
+        float32_mb = self.size * self.dim * 4 / 2**20
+        if self.vectors32 is None and float32_mb <= self.max_float32_mb:
+            self.vectors32 = self.vectors[: self.size].astype(np.float32)
+        if self.vectors32 is not None:
+            return self.vectors32 @ query_vector
+
+        similarities = np.empty((self.size, *query_vector.shape[1:]), dtype=np.float32)
+        for start in range(0, self.size, SEARCH_BLOCK):
+            end = min(start + SEARCH_BLOCK, self.size)
+            block = self.vectors[start:end].astype(np.float32)
+            similarities[start:end] = block @ query_vector
+        return similarities
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.asarray(self.embedding.embed_documents(texts), dtype=np.float32)
+        return normalize(vectors).astype(np.float16)
+
+    def embed_query(self, query: str) -> np.ndarray:
+        vector = np.asarray([self.embedding.embed_query(query)], dtype=np.float32)
+        return normalize(vector)[0]
+
+    def reserve(self, num_rows: int, dim: int) -> None:
+        """Grows the matrix, in the file when memory-mapped, to fit `num_rows` rows."""
+
+        if self.dim and dim != self.dim:
+            raise ValueError(f"Expected embeddings of dimension {self.dim}, got {dim}.")
+
+        capacity = len(self.vectors) if self.dim else 0
+        if num_rows <= capacity:
+            return
+
+        new_capacity = max(self.initial_capacity, capacity)
+        while new_capacity < num_rows:
+            new_capacity *= 2
+
+        alive = np.zeros(new_capacity, dtype=bool)
+        alive[:capacity] = self.alive[:capacity]
+        self.alive = alive
+        for key, codes in self.column_codes.items():
+            self.column_codes[key] = np.zeros(new_capacity, dtype=np.int32)
+            self.column_codes[key][:capacity] = codes[:capacity]
+
+        if self.persist_directory is None:
+            vectors = np.zeros((new_capacity, dim), dtype=np.float16)
+            if capacity:
+                vectors[:capacity] = self.vectors[:capacity]
+        else:
+            if isinstance(self.vectors, np.memmap):
+                self.vectors.flush()
+            path = os.path.join(self.persist_directory, VECTORS_FILE)
+            # growing the file keeps the rows, the new ones read as zeros
+            with open(path, "ab") as f:
+                f.truncate(new_capacity * dim * np.dtype(np.float16).itemsize)
+            vectors = np.memmap(
+                path, dtype=np.float16, mode="r+", shape=(new_capacity, dim)
+            )
+
+        self.vectors = vectors
+        self.dim = dim
+
+    def persist(self) -> None:
+        """
+        Drops the deleted rows, flushes the matrix and writes the ids into the persist
+        directory.
+        """
+
+        if self.persist_directory is None:
+            raise RuntimeError("Vector store without persist_directory can not be saved.")
+
+        with self.lock:
+            self.compact()
+            if isinstance(self.vectors, np.memmap):
+                self.vectors.flush()
+            self.write_ids()
+
+    def write_ids(self) -> None:
+        data = {
+            "dim": self.dim,
+            "capacity": len(self.vectors) if self.dim else 0,
+            "ids": self.ids,
+            "alive": self.alive[: self.size].tolist(),
+        }
+
+        path = os.path.join(str(self.persist_directory), ROWS_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def load(self) -> None:
+        path = os.path.join(str(self.persist_directory), ROWS_FILE)
+        if not os.path.exists(path):
+            return
+
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+
+        self.ids = data["ids"]
+        self.rows = {i: r for r, i in enumerate(self.ids) if data["alive"][r]}
+        self.dim = data["dim"]
+        self.alive = np.zeros(data["capacity"], dtype=bool)
+        self.alive[: len(self.ids)] = data["alive"]
+        self.column_codes = {
+            k: np.zeros(data["capacity"], dtype=np.int32) for k in self.filter_keys
+        }
+        self.set_codes(range(self.size), self.scan_metadatas())
+
+        if self.dim:
+            self.vectors = np.memmap(
+                os.path.join(str(self.persist_directory), VECTORS_FILE),
+                dtype=np.float16,
+                mode="r+",
+                shape=(data["capacity"], self.dim),
+            )
+
+        logger.info(f"Loaded {len(self.rows)} vectors from {self.persist_directory}.")
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: list[dict] | None = None,
+        **kwargs: Any,
+    ) -> "NumpyVectorStore":
+        ids = kwargs.pop("ids", None)
+        store = cls(embedding=embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
+
+
+def filter_conditions(filter: dict[str, Any]) -> list[tuple[str, set[Any]]]:
+    """Metadata keys of a filter with the values they have to match."""
+
+    conditions = []
+    for key, condition in filter.items():
+        if isinstance(condition, dict):
+            if set(condition) != {"$in"}:
+                raise ValueError(f"Unsupported filter condition {condition}.")
+            conditions.append((key, set(condition["$in"])))
+        else:
+            conditions.append((key, {condition}))
+
+    return conditions
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, from the highest."""
+
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def top_k_columns(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores in every column, from the highest."""
+
+    top = np.argpartition(-scores, k - 1, axis=0)[:k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=0), axis=0)
+    return np.take_along_axis(top, order, axis=0)
+
+
+def mmr(
+    similarities: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.5
+) -> list[int]:
+    """
+    Indices of k candidates selected by maximal marginal relevance, from the first
+    selected. `similarities` are cosine similarities of the normalized candidate
+    `vectors` to the query. Every step scores all candidates at once, their
+    similarity to the closest selected candidate is updated by one row of the
+    pairwise similarities.
+    """
+
+    k = min(k, len(similarities))
+    if k == 0:
+        return []
+
+    pairwise = vectors @ vectors.T
+    selected = [int(np.argmax(similarities))]
+    redundancy = pairwise[selected[0]].copy()
+    available = np.ones(len(similarities), dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * similarities - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, pairwise[best], out=redundancy)
+
+    return selected
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
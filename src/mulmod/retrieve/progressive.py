@@ -0,0 +1,150 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from mulmod.extract import Extraction
+from mulmod.logger import get_logger
+from mulmod.ocr import OcrSummarizer
+from mulmod.retrieve.retriever import Retriever
+from mulmod.summary import Summarizer
+
+logger = get_logger(__name__)
+
+
+def image_proxy(extraction: Extraction) -> str:
+    """Cheap key of an image used until its summary is generated."""
+
+    proxy = f"Image {Path(extraction.content).stem} from the document."
+    caption = extraction.metadata.get("caption")
+    return f"{proxy} {caption}" if caption else proxy
+
+
+@dataclass
+class BackgroundIndexer:
+    """
+    Generates summaries in a background thread and swaps them in place of the cheap
+    keys the documents were first indexed with, so the retriever can be queried
+    while the summaries are still being generated.
+
+    Attributes:
+    batch_size:
+        Number of chunks summarized and swapped at once.
+    num_workers:
+        Number of jobs summarized side by side. Jobs are submitted per document
+        and kind of extraction, so a corpus can have hundreds of them.
+    """
+
+    batch_size: int = 16
+    num_workers: int = 8
+
+    def __post_init__(self) -> None:
+        self.retriever: Retriever | None = None
+        self.jobs: list[
+            tuple[
+                Summarizer | OcrSummarizer,
+                list[Extraction],
+                list[str],
+                list[dict[str, Any]] | None,
+            ]
+        ] = []
+        self.summaries: dict[str, str] = {}
+        self.total = 0
+        self.error: Exception | None = None
+
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+    @property
+    def completeness(self) -> float:
+        """Fraction of the submitted chunks whose summaries are already indexed."""
+
+        with self.lock:
+            return len(self.summaries) / self.total if self.total else 1.0
+
+    @property
+    def finished(self) -> bool:
+        return self.thread is not None and not self.thread.is_alive()
+
+    def submit(
+        self,
+        summarizer: Summarizer | OcrSummarizer,
+        extractions: list[Extraction],
+        ids: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+    ) -> None:
+        """
+        Registers chunks indexed with cheap keys to be summarized. Must be called
+        before `start`. The metadata the chunks were indexed with are kept with the
+        summaries.
+        """
+
+        if len(extractions) == 0:
+            return
+
+        self.jobs.append((summarizer, extractions, ids, metadatas))
+        self.total += len(extractions)
+
+    def start(
+        self,
+        retriever: Retriever,
+        on_finish: Callable[[Exception | None], None] | None = None,
+    ) -> None:
+        """
+        Starts the background thread swapping keys in the retriever. `on_finish` is
+        called from it once all summaries are indexed or the summarization failed,
+        with the error of the failure.
+        """
+
+        self.retriever = retriever
+        self.thread = threading.Thread(
+            target=self.run, args=(on_finish,), name="background-indexer", daemon=True
+        )
+        self.thread.start()
+
+    def join(self, timeout: float | None = None) -> bool:
+        """Waits for the background thread, returns whether it finished."""
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+        return self.finished
+
+    def run(self, on_finish: Callable[[Exception | None], None] | None) -> None:
+        logger.info(f"Started summarizing {self.total} chunks in the background.")
+
+        try:
+            # jobs of different lanes of the scheduler are summarized side by side
+            num_workers = max(1, min(self.num_workers, len(self.jobs)))
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                for future in [executor.submit(self.run_job, *job) for job in self.jobs]:
+                    future.result()
+            logger.info("Finished summarizing chunks in the background.")
+        except Exception as e:
+            self.error = e
+            logger.exception("Background summarization failed.")
+        finally:
+            if on_finish is not None:
+                on_finish(self.error)
+
+    def run_job(
+        self,
+        summarizer: Summarizer | OcrSummarizer,
+        extractions: list[Extraction],
+        ids: list[str],
+        metadatas: list[dict[str, Any]] | None,
+    ) -> None:
+        for start in range(0, len(extractions), self.batch_size):
+            batch_ids = ids[start : start + self.batch_size]
+            summaries = summarizer.get_summary(
+                extractions[start : start + self.batch_size]
+            )
+            batch_metadatas = (
+                metadatas[start : start + self.batch_size] if metadatas else None
+            )
+
+            assert self.retriever is not None
+            self.retriever.update_keys(batch_ids, summaries, batch_metadatas)
+
+            with self.lock:
+                self.summaries.update(zip(batch_ids, summaries))
@@ -0,0 +1,212 @@
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from mulmod.logger import get_logger
+from mulmod.retrieve.numpy_store import SEARCH_BLOCK, NumpyVectorStore, top_k
+
+logger = get_logger(__name__)
+
+INT8 = "int8"
+BINARY = "binary"
+
+CODES_FILE = "codes.npy"
+SCALES_FILE = "scales.npy"
+
+
+class QuantizedVectorStore(NumpyVectorStore):
+    """
+    Vector store searching compact codes of the embeddings in memory and re-ranking
+    the best candidates exactly against the float16 vectors, which stay memory-mapped
+    on disk and are read only for the candidates.
+
+    With int8 quantization every vector is scaled to its largest component and
+    rounded to 8 bits, candidates are ranked by the product of the codes with the
+    query. With binary quantization only signs of the components are kept, packed in
+    bits, and candidates are ranked by their Hamming distance to the signs of the
+    query. An embedding of 384 dimensions takes 388 bytes of memory as int8 codes
+    and 48 bytes as binary codes, instead of 1536 bytes in float32.
+
+    Attributes:
+    quantization:
+        "int8" or "binary".
+    rerank_factor:
+        Number of candidates re-ranked exactly per requested result.
+    """
+
+    def __init__(
+        self,
+        embedding: Embeddings,
+        persist_directory: str | None = None,
+        quantization: str = INT8,
+        rerank_factor: int = 10,
+        initial_capacity: int = 1024,
+        compact_fraction: float = 0.25,
+    ) -> None:
+        if quantization not in (INT8, BINARY):
+            raise ValueError(f"Unknown quantization {quantization}.")
+
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+        code_type = np.int8 if quantization == INT8 else np.uint8
+        self.codes = np.zeros((0, 0), dtype=code_type)
+        self.scales = np.zeros(0, dtype=np.float32)
+
+        # the full precision vectors are never copied to memory
+        super().__init__(
+            embedding,
+            persist_directory=persist_directory,
+            initial_capacity=initial_capacity,
+            max_float32_mb=0,
+            compact_fraction=compact_fraction,
+        )
+
+    def rows_changed(self, rows: np.ndarray) -> None:
+        """Quantizes changed rows of the matrix."""
+
+        if len(rows) == 0:
+            return
+
+        if len(self.codes) < len(self.vectors):
+            # binary codes are padded to whole 64 bit words
+            width = self.dim if self.quantization == INT8 else (self.dim + 63) // 64 * 8
+            codes = np.zeros((len(self.vectors), width), dtype=self.codes.dtype)
+            if len(self.codes):
+                codes[: len(self.codes)] = self.codes
+            scales = np.zeros(len(self.vectors), dtype=np.float32)
+            scales[: len(self.scales)] = self.scales
+            self.codes, self.scales = codes, scales
+
+        codes, scales = self.quantize(self.vectors[rows].astype(np.float32))
+        self.codes[rows] = codes
+        self.scales[rows] = scales
+
+    def rows_compacted(self, live: np.ndarray) -> None:
+        """Moves the codes of the live rows to the front."""
+
+        super().rows_compacted(live)
+
+        codes = np.zeros((len(self.vectors), self.codes.shape[1]), self.codes.dtype)
+        codes[: len(live)] = self.codes[live]
+        scales = np.zeros(len(self.vectors), dtype=np.float32)
+        scales[: len(live)] = self.scales[live]
+        self.codes, self.scales = codes, scales
+
+    def quantize(self, vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        if self.quantization == BINARY:
+            return self.sign_bits(vectors), np.ones(len(vectors), np.float32)
+
+        max_abs = np.maximum(np.abs(vectors).max(axis=1), 1e-12)
+        codes = np.round(vectors / max_abs[:, None] * 127).astype(np.int8)
+        return codes, (max_abs / 127).astype(np.float32)
+
+    def search_rows(
+        self, query_vector: np.ndarray, k: int, mask: np.ndarray | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Ranks the rows in `mask` by their codes and re-ranks the best candidates by
+        the cosine similarity of their full precision vectors.
+        """
+
+        if mask is None:
+            mask = self.alive[: self.size]
+
+        num_rows = int(mask.sum())
+        k = min(k, num_rows)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        scores = self.approximate_scores(query_vector)
+        scores[~mask] = -np.inf
+
+        candidates = top_k(scores, min(num_rows, k * self.rerank_factor))
+        # sorted rows read the memory-mapped file sequentially
+        candidates = np.sort(candidates)
+        similarities = self.vectors[candidates].astype(np.float32) @ query_vector
+
+        top = top_k(similarities, k)
+        return candidates[top], similarities[top]
+
+    def search_rows_many(
+        self, query_vectors: np.ndarray, k: int, mask: np.ndarray | None = None
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """Ranks the codes and re-ranks the candidates query by query."""
+
+        return [self.search_rows(q, k, mask) for q in query_vectors]
+
+    def approximate_scores(self, query_vector: np.ndarray) -> np.ndarray:
+        if self.quantization == BINARY:
+            words = self.codes[: self.size].view(np.uint64)
+            query_words = self.sign_bits(query_vector[None, :]).view(np.uint64)
+            return -popcount(words ^ query_words).astype(np.float32)
+
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, SEARCH_BLOCK):
+            end = min(start + SEARCH_BLOCK, self.size)
+            block = self.codes[start:end].astype(np.float32)
+            scores[start:end] = (block @ query_vector) * self.scales[start:end]
+        return scores
+
+    def evaluate_recall(self, queries: list[str], k: int = 3) -> float:
+        """
+        Measures recall@k of the quantized search against the exact search over the
+        full precision vectors.
+        """
+
+        found = 0
+        expected = 0
+        for query in queries:
+            query_vector = self.embed_query(query)
+            with self.lock:
+                exact, _ = NumpyVectorStore.search_rows(self, query_vector, k)
+                approximate, _ = self.search_rows(query_vector, k)
+            found += len(set(exact.tolist()) & set(approximate.tolist()))
+            expected += len(exact)
+
+        recall = found / expected if expected else 1.0
+        logger.info(
+            f"Recall@{k} of the {self.quantization} index over {len(queries)} queries is {recall:.3f}."
+        )
+
+        return recall
+
+    def sign_bits(self, vectors: np.ndarray) -> np.ndarray:
+        bits = np.packbits(vectors > 0, axis=1)
+        padded = np.zeros((len(bits), self.codes.shape[1]), dtype=np.uint8)
+        padded[:, : bits.shape[1]] = bits
+        return padded
+
+    def persist(self) -> None:
+        super().persist()
+
+        with self.lock:
+            directory = str(self.persist_directory)
+            np.save(os.path.join(directory, CODES_FILE), self.codes[: self.size])
+            np.save(os.path.join(directory, SCALES_FILE), self.scales[: self.size])
+
+    def load(self) -> None:
+        super().load()
+
+        codes_path = os.path.join(str(self.persist_directory), CODES_FILE)
+        if not self.dim:
+            return
+        if not os.path.exists(codes_path):
+            self.rows_changed(np.arange(self.size))
+            return
+
+        codes = np.load(codes_path)
+        scales = np.load(os.path.join(str(self.persist_directory), SCALES_FILE))
+        self.codes = np.zeros((len(self.vectors), codes.shape[1]), dtype=codes.dtype)
+        self.codes[: len(codes)] = codes
+        self.scales = np.zeros(len(self.vectors), dtype=np.float32)
+        self.scales[: len(scales)] = scales
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Number of set bits in the rows of 64 bit words, counted in parallel per word."""
+
+    words = words - ((words >> 1) & 0x5555555555555555)
+    words = (words & 0x3333333333333333) + ((words >> 2) & 0x3333333333333333)
+    words = (words + (words >> 4)) & 0x0F0F0F0F0F0F0F0F
+    return ((words * 0x0101010101010101) >> 56).sum(axis=1)
@@ -0,0 +1,100 @@
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from langchain_core.documents import Document
+
+from mulmod.cache import hash_params
+
+Results = list[tuple[Document, float]]
+
+
+@dataclass
+class QueryCache:
+    """
+    In-process LRU of retrieval results keyed by the normalized query and the search
+    parameters. Every entry remembers the generation of the index it was retrieved
+    from, and entries of an older generation are dropped on access, so any change of
+    the index invalidates the cache without scanning it. Entries also expire after
+    `ttl_s`. It is safe to use from multiple threads.
+
+    Attributes:
+    max_items:
+        Maximum number of cached results.
+    ttl_s:
+        Seconds after which a result expires. If None results do not expire.
+    """
+
+    max_items: int = 1024
+    ttl_s: float | None = 600
+
+    def __post_init__(self) -> None:
+        self.entries: OrderedDict[str, tuple[int, float, Results]] = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+                "items": len(self.entries),
+            }
+
+    @staticmethod
+    def key(query: str, **params: Any) -> str:
+        return hash_params(normalize_query(query), params)
+
+    def get(self, key: str, generation: int) -> Results | None:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            entry_generation, expires, results = entry
+            if entry_generation != generation or time.monotonic() > expires:
+                if entry_generation != generation:
+                    self.invalidated += 1
+                else:
+                    self.expired += 1
+                del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(results)
+
+    def put(self, key: str, generation: int, results: Results) -> None:
+        expires = (
+            time.monotonic() + self.ttl_s if self.ttl_s is not None else float("inf")
+        )
+
+        with self.lock:
+            self.entries[key] = (generation, expires, list(results))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+def normalize_query(query: str) -> str:
+    """Query without differences of case, whitespace and trailing punctuation."""
+
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return " ".join(query.split()).rstrip("?!. ")
@@ -1,11 +1,19 @@
-from langchain_community.chat_models import ChatOllama
-from langchain_core.messages.base import BaseMessage
-from langchain_core.messages import HumanMessage, SystemMessage
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterator
+
+from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import HumanMessagePromptTemplate
 
-from mulmod.img import get_img_base64
+from mulmod.img import ImagePayloadStore
+from mulmod.llm import LlmTimings, OllamaChat
+from mulmod.logger import get_logger
+from mulmod.retrieve.memory import ConversationMemory
 from mulmod.retrieve.retriever import RetrievalResult, Retriever
 
+logger = get_logger(__name__)
 
 SYS_MSG = (
     "You are machine learning expert on large language models. You are very good \
@@ -22,46 +30,136 @@ This is the provided text and images: {rel_text}"""
 class Rag:
     sys_msg: str = ""
     model: str = "llava"
-    msg_history: list[BaseMessage] = []
 
     def __init__(
         self,
         sys_msg: str = SYS_MSG,
         question_msg: str = QUESTION_MSG,
         model: str = "llava",
+        payloads: ImagePayloadStore | None = None,
+        memory: ConversationMemory | None = None,
     ) -> None:
         self.sys_msg = sys_msg
         self.model = model
         self.question_msg = question_msg
+        self.payloads = payloads or ImagePayloadStore(cache_dir=None)
 
-        self.llm = ChatOllama(model=self.model)
-        self.msg_history = [SystemMessage(content=self.sys_msg)]
+        self.memory = memory or ConversationMemory(
+            sys_msg=self.sys_msg, model=self.model
+        )
 
-    def answer(self, query: str, retriever: Retriever) -> str:
-        retrieved = retriever.retrieve(query, 1.0)
+        self.timings = LlmTimings("Answer", log_each=True)
+        self.llm = OllamaChat(model=self.model, callbacks=[self.timings])
 
-        self.msg_history.append(self.process_retrieval(retrieved, query))
+    def warm_up(self) -> threading.Thread:
+        """Loads the model and evaluates the system message in the background."""
 
-        answer = self.llm.invoke(self.msg_history)
+        return self.llm.warm_up_in_background(self.sys_msg)
 
-        self.msg_history.append(answer)
+    def answer(
+        self, query: str, retriever: Retriever, sources: list[str] | None = None
+    ) -> str:
+        return "".join(self.stream_answer(query, retriever, sources=sources))
 
-        return answer.content
+    def stream_answer(
+        self,
+        query: str,
+        retriever: Retriever,
+        cancel: threading.Event | None = None,
+        sources: list[str] | None = None,
+    ) -> Iterator[str]:
+        """
+        Yields the answer token by token as it is generated. The generation stops
+        when `cancel` is set or the iterator is closed, the partial answer is kept in
+        the conversation memory. With `sources` only their documents are retrieved.
+        """
+
+        start = time.monotonic()
+
+        retrieved = retriever.retrieve(query, 1.0, sources)
+        message = self.process_retrieval(retrieved, query)
+
+        tokens: list[str] = []
+        try:
+            for chunk in self.llm.stream(self.memory.messages(message)):
+                if cancel is not None and cancel.is_set():
+                    logger.info("Generation of the answer was cancelled.")
+                    break
+                if not tokens:
+                    logger.info(f"First token after {time.monotonic() - start:.2f}s.")
+                tokens.append(str(chunk.content))
+                yield tokens[-1]
+        finally:
+            if tokens:
+                self.memory.add_turn(query, message, AIMessage(content="".join(tokens)))
+            logger.info(f"Answer generated in {time.monotonic() - start:.2f}s.")
+
+    async def astream_answer(
+        self,
+        query: str,
+        retriever: Retriever,
+        cancel: asyncio.Event | None = None,
+        sources: list[str] | None = None,
+    ) -> AsyncIterator[str]:
+        """
+        Async variant of `stream_answer`. Retrieval and preparation of the image
+        payloads run in worker threads, so the event loop keeps serving other
+        requests meanwhile.
+        """
+
+        start = time.monotonic()
+
+        retrieved = await asyncio.to_thread(retriever.retrieve, query, 1.0, sources)
+        message = await asyncio.to_thread(self.process_retrieval, retrieved, query)
+        messages = await asyncio.to_thread(self.memory.messages, message)
+
+        # the client may have gone while the retrieval ran
+        if cancel is not None and cancel.is_set():
+            logger.info("Generation of the answer was cancelled.")
+            return
+
+        stream = self.llm.astream(messages)
+        tokens: list[str] = []
+        try:
+            async for chunk in stream:
+                if cancel is not None and cancel.is_set():
+                    logger.info("Generation of the answer was cancelled.")
+                    break
+                if not tokens:
+                    logger.info(f"First token after {time.monotonic() - start:.2f}s.")
+                tokens.append(str(chunk.content))
+                yield tokens[-1]
+        finally:
+            # closes the request to Ollama right away, not when the generator is
+            # collected, so a cancelled answer stops generating
+            await stream.aclose()  # type: ignore[attr-defined]
+            if tokens:
+                self.memory.add_turn(query, message, AIMessage(content="".join(tokens)))
+            logger.info(f"Answer generated in {time.monotonic() - start:.2f}s.")
 
     def process_retrieval(self, retrieval: RetrievalResult, query: str) -> HumanMessage:
         content_parts = []
         texts = []
 
+        img_paths = [
+            doc.metadata["img_path"]
+            for doc, _ in retrieval
+            if "img_path" in doc.metadata
+        ]
+        # payloads which are not cached yet are encoded side by side
+        with ThreadPoolExecutor(max_workers=max(1, len(img_paths))) as executor:
+            images_b64 = list(executor.map(self.payloads.get_base64, img_paths))
+
+        for image_b64 in images_b64:
+            content_parts.append(
+                {
+                    "type": "image_url",
+                    "image_url": f"data:image/jpeg;base64,{image_b64}",
+                }
+            )
+
         for doc, _ in retrieval:
-            if "img_path" in doc.metadata:
-                image_b64 = get_img_base64(doc.metadata["img_path"])
-                content_parts.append(
-                    {
-                        "type": "image_url",
-                        "image_url": f"data:image/jpeg;base64,{image_b64}",
-                    }
-                )
-            else:
+            if "img_path" not in doc.metadata:
                 texts.append(doc.page_content)
 
         temp = HumanMessagePromptTemplate.from_template(self.question_msg)
@@ -1,53 +1,228 @@
-import uuid
-from dataclasses import dataclass
-from typing import ClassVar
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Any, ClassVar
 
-from langchain.storage import InMemoryStore
+from langchain.retrievers.multi_vector import SearchType
 from langchain_community.embeddings import GPT4AllEmbeddings
 from langchain_community.vectorstores.chroma import Chroma
 from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from mulmod.cache import hash_file, hash_params
 from mulmod.extract import Extraction
+from mulmod.img import ImagePayloadStore
 from mulmod.retrieve.custom_vector import (
     MyMultiVectorRetriever,
 )
+from mulmod.retrieve.docstore import DOCSTORE_DB, SqliteDocStore
+from mulmod.retrieve.embeddings import CachedEmbeddings
+from mulmod.retrieve.numpy_store import ROWS_DB, NumpyVectorStore
+from mulmod.retrieve.query_cache import QueryCache
+from mulmod.retrieve.quantized_store import BINARY, INT8, QuantizedVectorStore
+from mulmod.retrieve.snapshot import (
+    Snapshot,
+    SnapshotDocStore,
+    SnapshotVectorStore,
+    write_snapshot,
+)
 
 RetrievalResult = list[tuple[Document, float]]
 
+CHROMA = "chroma"
+NUMPY = "numpy"
+
+DEFAULT_COLLECTION = "single-doc-retriever"
+
 
 @dataclass
 class Retriever:
     """
     Retriever class responsible for retrieving relevant extractions.
 
+    Ids of the documents are hashes of their source file and content, so the same
+    chunk of a revised document keeps its id and an index can be updated by adding
+    and deleting only the chunks which changed.
+
     Attributes:
     top_k (int):
         Number of top documents to retrieve.
     id_key (ClassVar[str]):
         Class variable representing the key keyword for document IDs.
+    persist_directory (str | None):
+        Directory where the vector db and docstore are persisted. If it already
+        contains a saved retriever then it is loaded from it. If None everything is
+        kept only in memory. The parent documents are kept compressed in SQLite
+        and loaded when they are retrieved.
+    backend (str):
+        Vector store, "chroma" for approximate HNSW search of Chroma, "numpy" for
+        exact search over a memory-mapped float16 matrix, "int8" or "binary" for
+        search over quantized codes in memory with exact re-ranking from the
+        memory-mapped matrix.
+    embeddings (CachedEmbeddings):
+        Batched and cached embeddings of the keys and queries.
+    collection_name (str):
+        Name of the Chroma collection.
+    snapshot (Snapshot | None):
+        Snapshot the retriever is loaded from instead of the persist directory. The
+        retriever is then read-only and searches exactly like the "numpy" backend.
+    search_type (str):
+        "similarity" for the most similar documents, "mmr" for documents selected
+        by maximal marginal relevance among the `fetch_k` most similar ones.
+    fetch_k (int):
+        Number of candidates of mmr.
+    lambda_mult (float):
+        Diversity of mmr, 1 for the most similar documents, 0 for the most diverse.
+    query_cache (QueryCache | None):
+        Cache of retrieval results. Adding, updating or deleting documents
+        increments the generation of the index, which invalidates it. If None
+        results are not cached.
     """
 
     top_k: int = 3
     id_key: ClassVar[str] = "doc_id"
+    persist_directory: str | None = None
+    backend: str = CHROMA
+    embeddings: CachedEmbeddings = field(
+        default_factory=lambda: CachedEmbeddings(cache_dir=None)
+    )
+    collection_name: str = DEFAULT_COLLECTION
+    snapshot: Snapshot | None = None
+    search_type: str = SearchType.similarity.value
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    query_cache: QueryCache | None = field(default_factory=QueryCache)
 
     def __post_init__(self) -> None:
         """
-        Create chroma vector db with cosine distance and multivector retriver.
+        Create vector db with cosine distance and multivector retriver.
         """
 
-        vectorstore = Chroma(
-            collection_name="single-doc-retriever",
-            embedding_function=GPT4AllEmbeddings(),
-            collection_metadata={"hnsw:space": "cosine"},
-        )
+        self.generation = 0
+        self.generation_lock = threading.Lock()
+        # numbers of chunks added, removed and unchanged by the last update of the
+        # index, by source file
+        self.updates: dict[str, dict[str, int]] = {}
+        # source files which failed to be indexed by the last update, their chunks of
+        # the previous index are kept
+        self.failed_sources: list[str] = []
+
+        search_kwargs: dict[str, Any] = {"k": self.top_k}
+        if self.search_type == SearchType.mmr:
+            search_kwargs.update(fetch_k=self.fetch_k, lambda_mult=self.lambda_mult)
 
         self.retriever = MyMultiVectorRetriever(
-            vectorstore=vectorstore,
-            docstore=InMemoryStore(),
+            vectorstore=self.get_vectorstore(),
+            docstore=self.get_docstore(),
             id_key=Retriever.id_key,
-            search_kwargs={"k": self.top_k},
+            search_type=SearchType(self.search_type),
+            search_kwargs=search_kwargs,
         )
 
-    def add_docs_from_texts(self, keys: list[str], values: list[str]) -> None:
+    def get_docstore(self) -> SqliteDocStore | SnapshotDocStore:
+        if self.snapshot is not None:
+            return SnapshotDocStore(self.snapshot)
+        if self.persist_directory is None:
+            return SqliteDocStore()
+
+        return SqliteDocStore(os.path.join(self.persist_directory, DOCSTORE_DB))
+
+    def get_vectorstore(self) -> VectorStore:
+        if self.snapshot is not None:
+            return SnapshotVectorStore(self.snapshot, self.embeddings)
+        if self.backend in (INT8, BINARY):
+            return QuantizedVectorStore(
+                embedding=self.embeddings,
+                persist_directory=self.persist_directory,
+                quantization=self.backend,
+            )
+        if self.backend == NUMPY:
+            return NumpyVectorStore(
+                embedding=self.embeddings, persist_directory=self.persist_directory
+            )
+        if self.backend == CHROMA:
+            return Chroma(
+                collection_name=self.collection_name,
+                embedding_function=self.embeddings,
+                collection_metadata={"hnsw:space": "cosine"},
+                persist_directory=self.persist_directory,
+            )
+        raise ValueError(f"Unknown vector backend {self.backend}.")
+
+    @staticmethod
+    def cache_params(
+        backend: str = CHROMA, embeddings: CachedEmbeddings | None = None
+    ) -> dict[str, Any]:
+        """Parameters which influence the stored embeddings."""
+
+        params = {
+            "embeddings": (
+                embeddings.model_key
+                if embeddings is not None
+                else GPT4AllEmbeddings.__name__
+            ),
+            "space": "cosine",
+            "backend": backend,
+        }
+        if backend != CHROMA:
+            # texts and metadata of the rows are stored in a SQLite file
+            params["rows"] = ROWS_DB
+        # the docstore has an indexed column of the source files
+        params["docstore_sources"] = True
+        return params
+
+    def save(self) -> None:
+        """
+        Persists the vectors of the NumPy backends into the persist directory. Chroma
+        and the docstore persist every write on their own.
+        """
+
+        if self.persist_directory is None:
+            raise RuntimeError("Retriever without persist_directory can not be saved.")
+
+        vectorstore = self.retriever.vectorstore
+        if isinstance(vectorstore, NumpyVectorStore):
+            vectorstore.persist()
+
+    def export_snapshot(self, path: str, payloads: ImagePayloadStore) -> None:
+        """
+        Writes the whole retriever, with payloads of its images, into a single
+        snapshot file, which worker processes can map with `Retriever.from_snapshot`.
+        """
+
+        write_snapshot(
+            path,
+            self.retriever.vectorstore,
+            self.retriever.docstore,
+            payloads,
+            Retriever.cache_params(self.backend, self.embeddings),
+        )
+
+    @classmethod
+    def from_snapshot(
+        cls, path: str, embeddings: CachedEmbeddings | None = None, top_k: int = 3
+    ) -> "Retriever":
+        """Loads a read-only retriever memory-mapped from a snapshot file."""
+
+        snapshot = Snapshot(path)
+        embeddings = embeddings or CachedEmbeddings(cache_dir=None)
+        # queries have to be embedded by the model of the stored vectors
+        if snapshot.params["embeddings"] != embeddings.model_key:
+            raise ValueError(f"Snapshot {path} was built with another embedding model.")
+
+        return cls(
+            top_k=top_k,
+            backend=snapshot.params["backend"],
+            embeddings=embeddings,
+            snapshot=snapshot,
+        )
+
+    def add_docs_from_texts(
+        self,
+        keys: list[str],
+        values: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+        ids: list[str] | None = None,
+    ) -> list[str]:
         """
         Adds documents from text content to the retriever.
 
@@ -56,22 +231,34 @@ class Retriever:
             List of keys (e.g., summaries).
         values (List[str]):
             List of text content corresponding to the keys.
+        metadatas (List[dict] | None):
+            Metadata of the documents, e.g. their source file and page.
+        ids (List[str] | None):
+            IDs of the documents, by default `text_ids` of the values.
+
+        Returns:
+            List[str]: IDs of the added documents.
         """
 
         if len(values) == 0:
-            return
+            return []
+
+        ids = ids or Retriever.text_ids(values, metadatas)
 
-        ids = [str(uuid.uuid4()) for _ in values]
+        doc_keys = Retriever.text2doc(keys, ids, metadatas)
+        doc_values = Retriever.text2doc(values, ids, metadatas)
 
-        doc_keys = Retriever.text2doc(keys, ids)
-        doc_values = Retriever.text2doc(values, ids)
+        self.add(ids, doc_keys, doc_values)
 
-        self.retriever.vectorstore.add_documents(doc_keys)
-        self.retriever.docstore.mset(list(zip(ids, doc_values)))
+        return ids
 
     def add_imgs_from_extract(
-        self, summaries: list[str], paths: list[Extraction]
-    ) -> None:
+        self,
+        summaries: list[str],
+        paths: list[Extraction],
+        metadatas: list[dict[str, Any]] | None = None,
+        ids: list[str] | None = None,
+    ) -> list[str]:
         """
         Adds documents from image extractions to the retriever.
 
@@ -80,20 +267,153 @@ class Retriever:
             List of text summaries corresponding to the images.
         paths (List[Extraction]):
             List of Extraction objects with image paths.
+        metadatas (List[dict] | None):
+            Metadata of the documents, e.g. their source file and page.
+        ids (List[str] | None):
+            IDs of the documents, by default `image_ids` of the images.
+
+        Returns:
+            List[str]: IDs of the added documents.
         """
 
         if len(paths) == 0:
+            return []
+
+        ids = ids or Retriever.image_ids(paths, metadatas)
+
+        doc_keys = Retriever.text2doc(summaries, ids, metadatas)
+        doc_values = Retriever.extr_img2doc(paths, ids, metadatas)
+
+        self.add(ids, doc_keys, doc_values)
+
+        return ids
+
+    def add(self, ids: list[str], keys: list[Document], values: list[Document]) -> None:
+        """Adds documents, a repeated id is added only once."""
+
+        unique = {i: (k, v) for i, k, v in zip(ids, keys, values)}
+        self.retriever.vectorstore.add_documents(
+            [k for k, _ in unique.values()], ids=list(unique)
+        )
+        self.retriever.docstore.mset([(i, v) for i, (_, v) in unique.items()])
+        self.index_changed()
+
+    def update_keys(
+        self,
+        ids: list[str],
+        keys: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+    ) -> None:
+        """
+        Replaces keys of already added documents, e.g. a cheap proxy by a summary.
+        The vectors are replaced in a single update of the collection, so a
+        concurrent retrieval sees either the old or the new keys.
+
+        Args:
+        ids (List[str]):
+            IDs of the documents.
+        keys (List[str]):
+            New keys of the documents.
+        metadatas (List[dict] | None):
+            Metadata of the documents, they have to be passed again, the old keys
+            are replaced together with their metadata.
+        """
+
+        if len(ids) == 0:
+            return
+
+        self.retriever.vectorstore.update_documents(
+            ids, Retriever.text2doc(keys, ids, metadatas)
+        )
+        self.index_changed()
+
+    def update_metadata(self, ids: list[str], metadatas: list[dict[str, Any]]) -> None:
+        """
+        Replaces metadata of already added documents, e.g. the page of a chunk which
+        moved in a revised document. Their keys stay the same.
+        """
+
+        if len(ids) == 0:
+            return
+
+        self.update_keys(ids, self.get_keys(ids), metadatas)
+        self.update_value_metadata(ids, metadatas)
+
+    def update_value_metadata(
+        self, ids: list[str], metadatas: list[dict[str, Any]]
+    ) -> None:
+        """
+        Merges metadata into the retrieved documents only, e.g. pages of the
+        duplicates of an image. Their keys and the metadata of the vector store stay
+        the same.
+        """
+
+        if len(ids) == 0:
             return
 
-        ids = [str(uuid.uuid4()) for _ in paths]
+        docs = self.retriever.docstore.mget(ids)
+        self.retriever.docstore.mset(
+            [
+                (i, Document(page_content=d.page_content, metadata={**d.metadata, **m}))
+                for i, d, m in zip(ids, docs, metadatas)
+                if d is not None
+            ]
+        )
+        self.index_changed()
+
+    def get_keys(self, ids: list[str]) -> list[str]:
+        """Returns keys of already added documents, e.g. their summaries."""
 
-        doc_keys = Retriever.text2doc(summaries, ids)
-        doc_values = Retriever.extr_img2doc(paths, ids)
+        data = self.retriever.vectorstore.get(ids=ids)
+        keys = dict(zip(data["ids"], data["documents"]))
+        return [keys[i] for i in ids]
 
-        self.retriever.vectorstore.add_documents(doc_keys)
-        self.retriever.docstore.mset(list(zip(ids, doc_values)))
+    def get_metadatas(self, ids: list[str]) -> dict[str, dict[str, Any]]:
+        """Returns metadata of the added documents among the ids."""
 
-    def retrieve(self, query: str, treshold: float = 0.65) -> RetrievalResult:
+        docs = self.retriever.docstore.mget(ids)
+        return {i: d.metadata for i, d in zip(ids, docs) if d is not None}
+
+    def ids_by_source(self) -> dict[str, set[str]]:
+        """Returns ids of the added documents grouped by their source file."""
+
+        docstore = self.retriever.docstore
+        if not isinstance(docstore, SqliteDocStore):
+            raise RuntimeError("Snapshot is read-only, it can not be updated.")
+
+        return docstore.ids_by_source()
+
+    def delete(self, ids: list[str]) -> None:
+        """Deletes documents from the vector db and the docstore."""
+
+        if len(ids) == 0:
+            return
+
+        self.retriever.vectorstore.delete(ids)
+        self.retriever.docstore.mdelete(ids)
+        self.index_changed()
+
+    def index_changed(self) -> None:
+        """Increments the generation of the index, cached results become stale."""
+
+        with self.generation_lock:
+            self.generation += 1
+
+    def cache_key(self, query: str, sources: list[str] | None, top_k: int) -> str:
+        # the threshold is applied to the cached results, so it is not in the key
+        return QueryCache.key(
+            query,
+            search_kwargs={**self.retriever.search_kwargs, "k": top_k},
+            search_type=self.search_type,
+            sources=sorted(sources) if sources else None,
+        )
+
+    def retrieve(
+        self,
+        query: str,
+        treshold: float = 0.65,
+        sources: list[str] | None = None,
+    ) -> RetrievalResult:
         """
         Retrieves relevant documents based on a text query.
 
@@ -102,30 +422,142 @@ class Retriever:
             Query string to retrieve relevant documents.
         treshold (float):
             Threshold value for document relevance. If higher then do not return it.
+        sources (List[str] | None):
+            Source files the documents are retrieved from. If None the whole
+            corpus is searched.
 
         Returns:
             RetrievalResult: List of tuples containing Document objects and their similarity scores.
         """
 
-        rel_docs = self.retriever.get_relevant_documents_with_score(query)
+        generation = self.generation
+        key = self.cache_key(query, sources, self.top_k)
+        rel_docs = self.query_cache.get(key, generation) if self.query_cache else None
+
+        if rel_docs is None:
+            rel_docs = self.retriever.get_relevant_documents_with_score(
+                query, filter={"source": {"$in": sources}} if sources else None
+            )
+            if self.query_cache is not None:
+                self.query_cache.put(key, generation, rel_docs)
 
         rel_docs = [e for e in rel_docs if e[1] <= treshold]
 
         return rel_docs
 
+    def retrieve_many(
+        self,
+        queries: list[str],
+        treshold: float = 0.65,
+        sources: list[str] | None = None,
+        top_k: int | None = None,
+    ) -> list[RetrievalResult]:
+        """
+        Retrieves relevant documents of many queries, e.g. of an evaluation set, with
+        the same results as `retrieve` of every query. The queries are embedded in
+        batches, searched together by the vector store and their documents are read
+        from the docstore at once. Scores of a batched matrix product can differ from
+        single queries by float32 rounding, so documents with equal scores may swap.
+
+        Args:
+        queries (List[str]):
+            Query strings to retrieve relevant documents for.
+        treshold (float):
+            Threshold value for document relevance. If higher then do not return it.
+        sources (List[str] | None):
+            Source files the documents are retrieved from. If None the whole
+            corpus is searched.
+        top_k (int | None):
+            Number of documents to retrieve per query, `top_k` of the retriever if
+            None.
+
+        Returns:
+            List[RetrievalResult]: Retrieved documents of every query.
+        """
+
+        if len(queries) == 0:
+            return []
+
+        top_k = top_k or self.top_k
+        generation = self.generation
+        keys = [self.cache_key(q, sources, top_k) for q in queries]
+        results = [
+            self.query_cache.get(k, generation) if self.query_cache else None
+            for k in keys
+        ]
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if len(missing) > 0:
+            missing_queries = [queries[i] for i in missing]
+            retrieved = self.retriever.get_relevant_documents_with_score_many(
+                missing_queries,
+                self.embeddings.embed_queries(missing_queries),
+                k=top_k,
+                filter={"source": {"$in": sources}} if sources else None,
+            )
+            for i, rel_docs in zip(missing, retrieved):
+                results[i] = rel_docs
+                if self.query_cache is not None:
+                    self.query_cache.put(keys[i], generation, rel_docs)
+
+        return [
+            [e for e in rel_docs if e[1] <= treshold]
+            for rel_docs in results
+            if rel_docs is not None
+        ]
+
+    @staticmethod
+    def text_ids(
+        texts: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+        kind: str = "texts",
+    ) -> list[str]:
+        """Ids of text documents, hashes of their source, kind (e.g. tables) and content."""
+
+        metadatas = metadatas or [{} for _ in texts]
+        return [hash_params(m.get("source"), kind, t) for t, m in zip(texts, metadatas)]
+
+    @staticmethod
+    def image_ids(
+        imgs: list[Extraction], metadatas: list[dict[str, Any]] | None = None
+    ) -> list[str]:
+        """
+        Ids of image documents, hashes of their source and image bytes. A repeated
+        extraction writes the images to the same paths, so the paths do not tell
+        whether an image changed.
+        """
+
+        metadatas = metadatas or [{} for _ in imgs]
+        return [
+            hash_params(m.get("source"), "images", hash_file(e.content))
+            for e, m in zip(imgs, metadatas)
+        ]
+
     @classmethod
-    def extr_img2doc(cls, imgs: list[Extraction], ids: list[str]) -> list[Document]:
+    def extr_img2doc(
+        cls,
+        imgs: list[Extraction],
+        ids: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+    ) -> list[Document]:
+        metadatas = metadatas or [{} for _ in imgs]
         return [
             Document(
                 page_content=e.content,
-                metadata={"img_path": e.content, cls.id_key: ids[i]},
+                metadata={**metadatas[i], "img_path": e.content, cls.id_key: ids[i]},
             )
             for i, e in enumerate(imgs)
         ]
 
     @classmethod
-    def text2doc(cls, texts: list[str], ids: list[str]) -> list[Document]:
+    def text2doc(
+        cls,
+        texts: list[str],
+        ids: list[str],
+        metadatas: list[dict[str, Any]] | None = None,
+    ) -> list[Document]:
+        metadatas = metadatas or [{} for _ in texts]
         return [
-            Document(page_content=s, metadata={cls.id_key: ids[i]})
+            Document(page_content=s, metadata={**metadatas[i], cls.id_key: ids[i]})
             for i, s in enumerate(texts)
         ]
@@ -0,0 +1,480 @@
+import base64
+import json
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.stores import BaseStore
+from langchain_core.vectorstores import VectorStore
+
+from mulmod.img import ImagePayloadStore
+from mulmod.logger import get_logger
+from mulmod.retrieve.docstore import decode_document, encode_document
+from mulmod.retrieve.numpy_store import NumpyVectorStore, filter_conditions, normalize
+
+logger = get_logger(__name__)
+
+MAGIC = b"MMSNAP01"
+# sections start at page boundaries, so the vectors are mapped page by page
+ALIGNMENT = mmap.PAGESIZE
+# documents read from the docstore at once while exporting
+EXPORT_BATCH = 1024
+# metadata keys with at most this many values are stored as columns for filtering
+MAX_COLUMN_VALUES = 4096
+
+
+class Snapshot:
+    """
+    Immutable index in a single file, memory-mapped read-only. Processes which map
+    the same file share its physical pages in the page cache, so loading is a mmap
+    and a parse of a small header instead of re-indexing, and an additional worker
+    process costs almost no private memory.
+
+    The file holds the float16 vectors with the keys and metadata of their rows,
+    the compressed parent documents and the JPEG payloads of the images. Nothing is
+    parsed into Python objects up front: ids are looked up by binary search in
+    sorted fixed-width arrays, texts and documents are decoded when they are read,
+    and metadata used by filters is stored as columns of value codes.
+
+    The file starts with `MAGIC` and ends with a json header, its length and `MAGIC`
+    again. The header has locations of the sections and values of the columns.
+
+    Attributes:
+    path:
+        Path to the snapshot file.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        tail = len(self.mm) - len(MAGIC) - 8
+        if (
+            len(self.mm) < 2 * len(MAGIC) + 8
+            or self.mm[: len(MAGIC)] != MAGIC
+            or self.mm[tail + 8 :] != MAGIC
+        ):
+            raise ValueError(f"{path} is not an index snapshot.")
+
+        (header_size,) = struct.unpack("<Q", self.mm[tail : tail + 8])
+        self.header: dict[str, Any] = json.loads(
+            self.mm[tail - header_size : tail].decode("utf-8")
+        )
+        self.image_rows = {p: r for r, p in enumerate(self.header["images"])}
+
+        self.row_ids = SortedIds(self, "row_ids")
+        self.doc_ids = SortedIds(self, "doc_ids")
+
+        logger.info(
+            f"Mapped snapshot {path} with {self.size} vectors and {len(self.doc_ids)} documents."
+        )
+
+    @property
+    def size(self) -> int:
+        return self.header["size"]
+
+    @property
+    def dim(self) -> int:
+        return self.header["dim"]
+
+    @property
+    def params(self) -> dict[str, Any]:
+        """Parameters of the retriever the snapshot was exported from."""
+
+        return self.header["params"]
+
+    @property
+    def columns(self) -> dict[str, list[Any]]:
+        """Values of the metadata stored as columns, rows hold indices into them."""
+
+        return self.header["columns"]
+
+    def array(self, name: str) -> np.ndarray:
+        """Read-only view of a section, no data is copied."""
+
+        offset, dtype, shape = self.header["sections"][name]
+        count = int(np.prod(shape))
+        return np.frombuffer(self.mm, dtype=dtype, count=count, offset=offset).reshape(
+            shape
+        )
+
+    def vectors(self) -> np.ndarray:
+        return self.array("vectors")
+
+    def column(self, key: str) -> np.ndarray:
+        return self.array(f"column_{key}")
+
+    def blob(self, name: str, row: int) -> bytes:
+        offsets = self.array(f"{name}_offsets")
+        start = self.header["sections"][name][0]
+        return self.mm[start + int(offsets[row]) : start + int(offsets[row + 1])]
+
+    def blobs(self, name: str, decode: Callable[[bytes], Any]) -> "SnapshotBlobs":
+        return SnapshotBlobs(self, name, decode)
+
+    def document(self, doc_id: str) -> Document | None:
+        row = self.doc_ids.index(doc_id)
+        return None if row is None else decode_document(self.blob("docs", row))
+
+    def payload(self, img_path: str) -> str | None:
+        """Base64 JPEG of an image, None if it is not in the snapshot."""
+
+        row = self.image_rows.get(img_path)
+        if row is None:
+            return None
+        return base64.b64encode(self.blob("images", row)).decode("ascii")
+
+
+class SnapshotBlobs(Sequence[Any]):
+    """Blobs of a section decoded only when they are accessed."""
+
+    def __init__(
+        self, snapshot: Snapshot, name: str, decode: Callable[[bytes], Any]
+    ) -> None:
+        self.snapshot = snapshot
+        self.name = name
+        self.decode = decode
+
+    def __len__(self) -> int:
+        return len(self.snapshot.array(f"{self.name}_offsets")) - 1
+
+    def __getitem__(self, row: Any) -> Any:
+        if isinstance(row, slice):
+            return [self[r] for r in range(*row.indices(len(self)))]
+        return self.decode(self.snapshot.blob(self.name, row))
+
+
+class SortedIds(Sequence[str]):
+    """
+    Ids in their order and sorted with their positions, so an id is found by binary
+    search in the mapped file instead of in a dict built by every process.
+    """
+
+    def __init__(self, snapshot: Snapshot, name: str) -> None:
+        self.ids = snapshot.array(name)
+        self.sorted = snapshot.array(f"{name}_sorted")
+        self.positions = snapshot.array(f"{name}_positions")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, position: Any) -> Any:
+        if isinstance(position, slice):
+            return [self[p] for p in range(*position.indices(len(self)))]
+        return self.ids[position].decode("utf-8")
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and self.index(key) is not None
+
+    def index(self, key: str) -> int | None:  # type: ignore[override]
+        """Position of the id, None if it is not in the snapshot."""
+
+        encoded = key.encode("utf-8")
+        i = int(np.searchsorted(self.sorted, encoded))
+        if i < len(self.sorted) and self.sorted[i] == encoded:
+            return int(self.positions[i])
+        return None
+
+
+class SnapshotRows:
+    """Mapping of row ids to rows of a snapshot, read-only."""
+
+    def __init__(self, ids: SortedIds) -> None:
+        self.ids = ids
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.ids
+
+    def __getitem__(self, key: str) -> int:
+        row = self.ids.index(key)
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def values(self) -> Iterable[int]:
+        return range(len(self.ids))
+
+
+class SnapshotVectorStore(NumpyVectorStore):
+    """
+    Read-only vector store searching the vectors of a snapshot exactly. The matrix
+    is converted to float32 block by block on every query, a float32 copy would be
+    private to the process.
+    """
+
+    def __init__(self, snapshot: Snapshot, embedding: Embeddings) -> None:
+        super().__init__(embedding, max_float32_mb=0, filter_keys=())
+
+        self.snapshot = snapshot
+        self.ids = snapshot.row_ids  # type: ignore[assignment]
+        self.texts = snapshot.blobs("keys", lambda b: b.decode("utf-8"))
+        self.metadatas = snapshot.blobs("metadatas", json.loads)
+        self.rows = SnapshotRows(snapshot.row_ids)  # type: ignore[assignment]
+        self.alive = np.ones(snapshot.size, dtype=bool)
+        self.dim = snapshot.dim
+        self.vectors = snapshot.vectors()
+
+    def row_documents(self, rows: Sequence[int]) -> list[Document]:
+        return [
+            Document(page_content=self.texts[r], metadata=self.metadatas[r])
+            for r in rows
+        ]
+
+    def scan_metadatas(self) -> Iterator[dict[str, Any]]:
+        return iter(self.metadatas)
+
+    def matching(self, filter: dict[str, Any]) -> np.ndarray:
+        """Mask of the rows matching the filter, computed from the metadata columns."""
+
+        conditions = filter_conditions(filter)
+        if any(key not in self.snapshot.columns for key, _ in conditions):
+            return super().matching(filter)
+
+        mask = np.ones(self.size, dtype=bool)
+        for key, values in conditions:
+            codes = [
+                code
+                for code, value in enumerate(self.snapshot.columns[key])
+                if value in values
+            ]
+            mask &= np.isin(self.snapshot.column(key), codes)
+
+        return mask
+
+    def add_texts(self, texts: Iterable[str], *args: Any, **kwargs: Any) -> list[str]:
+        raise RuntimeError("Snapshot is read-only.")
+
+    def update_documents(self, ids: list[str], documents: list[Document]) -> None:
+        raise RuntimeError("Snapshot is read-only.")
+
+    def delete(self, ids: list[str] | None = None, **kwargs: Any) -> bool | None:
+        raise RuntimeError("Snapshot is read-only.")
+
+    def persist(self) -> None:
+        raise RuntimeError("Snapshot is read-only.")
+
+
+class SnapshotDocStore(BaseStore[str, Document]):
+    """Read-only docstore decompressing documents of a snapshot when requested."""
+
+    def __init__(self, snapshot: Snapshot) -> None:
+        self.snapshot = snapshot
+
+    def __len__(self) -> int:
+        return len(self.snapshot.doc_ids)
+
+    def mget(self, keys: Sequence[str]) -> list[Document | None]:
+        return [self.snapshot.document(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[tuple[str, Document]]) -> None:
+        raise RuntimeError("Snapshot is read-only.")
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        raise RuntimeError("Snapshot is read-only.")
+
+    def yield_keys(self, prefix: str | None = None) -> Iterator[str]:
+        for key in self.snapshot.doc_ids:
+            if prefix is None or key.startswith(prefix):
+                yield key
+
+
+@dataclass
+class SnapshotPayloadStore(ImagePayloadStore):
+    """
+    Image payload store serving the payloads of a snapshot, so the images do not
+    have to be on disk. Images which are not in it are encoded as usual.
+
+    Attributes:
+    snapshot:
+        Snapshot with the payloads.
+    """
+
+    snapshot: Snapshot | None = None
+
+    def get_base64(self, filepath: str) -> str:
+        if self.snapshot is not None:
+            payload = self.snapshot.payload(filepath)
+            if payload is not None:
+                return payload
+
+        return super().get_base64(filepath)
+
+    def prefetch(self, filepaths: list[str], num_workers: int = 1) -> None:
+        if self.snapshot is not None:
+            filepaths = [f for f in filepaths if f not in self.snapshot.image_rows]
+
+        super().prefetch(filepaths, num_workers)
+
+
+@dataclass
+class SnapshotWriter:
+    """
+    Writes sections of a snapshot one after another and collects their locations.
+
+    Attributes:
+    f:
+        File the snapshot is written to.
+    """
+
+    f: BinaryIO
+
+    def __post_init__(self) -> None:
+        self.sections: dict[str, tuple[int, str, tuple[int, ...]]] = {}
+        self.f.write(MAGIC)
+
+    def align(self) -> int:
+        """Pads the file to the next section boundary and returns its position."""
+
+        position = self.f.tell()
+        padding = -position % ALIGNMENT
+        self.f.write(b"\0" * padding)
+        return position + padding
+
+    def write_array(self, name: str, array: np.ndarray) -> None:
+        start = self.align()
+        array = np.ascontiguousarray(array)
+        self.f.write(array.tobytes())
+        self.sections[name] = (start, array.dtype.str, array.shape)
+
+    def write_blobs(self, name: str, blobs: Iterable[bytes]) -> None:
+        """Writes blobs into one section and their offsets into another one."""
+
+        start = self.align()
+        offsets = [0]
+        for blob in blobs:
+            self.f.write(blob)
+            offsets.append(offsets[-1] + len(blob))
+        self.sections[name] = (start, "|u1", (offsets[-1],))
+
+        self.write_array(f"{name}_offsets", np.asarray(offsets, dtype=np.int64))
+
+    def write_ids(self, name: str, ids: list[str]) -> None:
+        """Writes ids as fixed-width bytes in their order and sorted for lookups."""
+
+        encoded = np.asarray([i.encode("utf-8") for i in ids], dtype=np.bytes_)
+        order = np.argsort(encoded, kind="stable")
+        self.write_array(name, encoded)
+        self.write_array(f"{name}_sorted", encoded[order])
+        self.write_array(f"{name}_positions", order.astype(np.int64))
+
+    def write_columns(self, metadatas: list[dict[str, Any]]) -> dict[str, list[Any]]:
+        """
+        Writes codes of the metadata values which can be filtered by, i.e. keys with
+        few distinct scalar values. Returns the values of the codes.
+        """
+
+        columns = {}
+        for key in dict.fromkeys(k for m in metadatas for k in m):
+            values: dict[Any, int] = {}
+            codes = np.empty(len(metadatas), dtype=np.int32)
+            for row, metadata in enumerate(metadatas):
+                value = metadata.get(key)
+                if not isinstance(value, (str, int, float, bool, type(None))):
+                    break
+                codes[row] = values.setdefault(value, len(values))
+                if len(values) > MAX_COLUMN_VALUES:
+                    break
+            else:
+                self.write_array(f"column_{key}", codes)
+                columns[key] = list(values)
+
+        return columns
+
+    def finish(self, header: dict[str, Any]) -> None:
+        data = json.dumps({**header, "sections": self.sections}).encode("utf-8")
+        self.f.write(data)
+        self.f.write(struct.pack("<Q", len(data)))
+        self.f.write(MAGIC)
+
+
+def write_snapshot(
+    path: str,
+    vectorstore: VectorStore,
+    docstore: BaseStore[str, Document],
+    payloads: ImagePayloadStore,
+    params: dict[str, Any],
+) -> None:
+    """
+    Writes vectors, docstore and image payloads into a snapshot file. The file is
+    written aside and moved into place, so a running process never maps a partial
+    snapshot.
+    """
+
+    ids, keys, metadatas, vectors = vector_rows(vectorstore)
+    doc_ids = list(docstore.yield_keys())
+    img_paths: list[str] = []
+
+    def documents() -> Iterator[bytes]:
+        for start in range(0, len(doc_ids), EXPORT_BATCH):
+            batch = doc_ids[start : start + EXPORT_BATCH]
+            for doc_id, doc in zip(batch, docstore.mget(batch)):
+                if doc is None:
+                    raise KeyError(f"Document {doc_id} is missing in the docstore.")
+                if "img_path" in doc.metadata:
+                    img_paths.append(doc.metadata["img_path"])
+                yield encode_document(doc)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    with open(tmp_path, "wb") as f:
+        writer = SnapshotWriter(f)
+        writer.write_array("vectors", vectors)
+        writer.write_ids("row_ids", ids)
+        writer.write_blobs("keys", (k.encode("utf-8") for k in keys))
+        writer.write_blobs(
+            "metadatas", (json.dumps(m).encode("utf-8") for m in metadatas)
+        )
+        columns = writer.write_columns(metadatas)
+
+        writer.write_ids("doc_ids", doc_ids)
+        writer.write_blobs("docs", documents())
+
+        img_paths = list(dict.fromkeys(img_paths))
+        writer.write_blobs(
+            "images", (base64.b64decode(payloads.get_base64(p)) for p in img_paths)
+        )
+
+        writer.finish(
+            {
+                "size": len(ids),
+                "dim": vectors.shape[1],
+                "params": params,
+                "columns": columns,
+                "images": img_paths,
+            }
+        )
+
+    os.replace(tmp_path, path)
+
+    logger.info(
+        f"Exported snapshot {path} of {os.path.getsize(path) / 2**20:.1f} MB with {len(ids)} vectors, {len(doc_ids)} documents and {len(img_paths)} images."
+    )
+
+
+def vector_rows(
+    vectorstore: VectorStore,
+) -> tuple[list[str], list[str], list[dict[str, Any]], np.ndarray]:
+    """Ids, keys, metadata and normalized float16 vectors of the stored documents."""
+
+    if isinstance(vectorstore, NumpyVectorStore):
+        data = vectorstore.get()
+        with vectorstore.lock:
+            rows = np.asarray([vectorstore.rows[i] for i in data["ids"]], np.int64)
+            vectors = np.asarray(vectorstore.vectors[rows], dtype=np.float16)
+    else:
+        data = vectorstore.get(include=["documents", "metadatas", "embeddings"])  # type: ignore[attr-defined]
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        vectors = normalize(vectors).astype(np.float16)
+
+    if len(data["ids"]) == 0:
+        raise ValueError("Can not export a snapshot of an empty index.")
+
+    return data["ids"], data["documents"], data["metadatas"], vectors
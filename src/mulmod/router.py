@@ -0,0 +1,131 @@
+from dataclasses import dataclass
+from typing import Iterator
+
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import LTChar, LTContainer, LTCurve, LTImage, LTItem, LTPage
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfpage import PDFPage
+
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+FAST = "fast"
+HI_RES = "hi_res"
+
+
+@dataclass
+class PageStats:
+    """
+    Cheap statistics of a PDF page computed from its text layer and drawing operators.
+
+    Attributes:
+    num_chars:
+        Number of characters in the text layer.
+    image_coverage:
+        Fraction of the page area covered by embedded images.
+    num_rulings:
+        Number of drawn lines, rectangles and curves, a signal of tables and vector
+        figures.
+    """
+
+    num_chars: int
+    image_coverage: float
+    num_rulings: int
+
+
+@dataclass
+class PageRouter:
+    """
+    Decides per page whether it needs the hi_res layout detection and OCR or if the
+    text layer can be used with the fast strategy.
+
+    Attributes:
+    min_chars:
+        Pages with fewer characters in the text layer are treated as scanned.
+    max_image_coverage:
+        Pages with a larger fraction covered by images are treated as having figures.
+    min_rulings:
+        Pages with at least this many drawn lines, rectangles and curves are treated
+        as having tables or vector figures.
+    """
+
+    min_chars: int = 200
+    max_image_coverage: float = 0.05
+    min_rulings: int = 12
+
+    def cache_params(self) -> dict[str, float]:
+        return {
+            "min_chars": self.min_chars,
+            "max_image_coverage": self.max_image_coverage,
+            "min_rulings": self.min_rulings,
+        }
+
+    def route(self, filepath: str) -> list[str]:
+        """Returns the partitioning strategy for every page of the document."""
+
+        strategies = [self.strategy(stats) for stats in iter_page_stats(filepath)]
+
+        num_hi_res = strategies.count(HI_RES)
+        logger.info(
+            f"Routed {len(strategies) - num_hi_res} pages to {FAST} and {num_hi_res} pages to {HI_RES}."
+        )
+
+        return strategies
+
+    def strategy(self, stats: PageStats) -> str:
+        if (
+            stats.num_chars < self.min_chars
+            or stats.image_coverage > self.max_image_coverage
+            or stats.num_rulings >= self.min_rulings
+        ):
+            return HI_RES
+        return FAST
+
+
+def iter_page_stats(filepath: str) -> Iterator[PageStats]:
+    """
+    Yields statistics of every page. Layout analysis is turned off because only
+    the raw layout objects are counted.
+    """
+
+    with open(filepath, "rb") as f:
+        resource_manager = PDFResourceManager(caching=True)
+        device = PDFPageAggregator(resource_manager, laparams=None)
+        interpreter = PDFPageInterpreter(resource_manager, device)
+
+        for page in PDFPage.get_pages(f, caching=True):
+            interpreter.process_page(page)
+            yield page_stats(device.get_result())
+
+
+def page_stats(page: LTPage) -> PageStats:
+    num_chars = 0
+    image_area = 0.0
+    num_rulings = 0
+
+    def visit(item: LTItem) -> None:
+        nonlocal num_chars, image_area, num_rulings
+
+        if isinstance(item, LTChar):
+            num_chars += 1
+        elif isinstance(item, LTImage):
+            image_area += item.width * item.height
+        elif isinstance(item, LTCurve):
+            # LTLine and LTRect are subclasses of LTCurve
+            num_rulings += 1
+
+        if isinstance(item, LTContainer):
+            for child in item:
+                visit(child)
+
+    for item in page:
+        visit(item)
+
+    page_area = max(page.width * page.height, 1.0)
+
+    return PageStats(
+        num_chars=num_chars,
+        image_coverage=min(image_area / page_area, 1.0),
+        num_rulings=num_rulings,
+    )
@@ -0,0 +1,257 @@
+import random
+import statistics
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, TypeVar
+
+from mulmod.logger import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+IMAGE_LANE = "image"
+TEXT_LANE = "text"
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Connection errors, timeouts and server side errors of the backend are worth
+    retrying. Ollama reports non-200 responses as ValueError with the status code
+    in the message.
+    """
+
+    if isinstance(error, (OSError, TimeoutError)):
+        return True
+    if isinstance(error, ValueError):
+        message = str(error)
+        return "status code 5" in message or "status code 429" in message
+    return False
+
+
+@dataclass
+class Lane:
+    """
+    Lane of requests with its own adaptive concurrency limit. The limit grows by one
+    per round of fast successful requests and shrinks multiplicatively on errors or
+    when the latency rises well above the best latency recently observed, which
+    means the backend is queueing the requests. Latencies are compared per unit of
+    request size, so a packed request of several chunks is not mistaken for
+    congestion next to requests of a single chunk.
+
+    Attributes:
+    name:
+        Name of the lane used in the reports.
+    min_concurrency:
+        Lower bound of the limit.
+    max_concurrency:
+        Upper bound of the limit.
+    initial_concurrency:
+        Limit at the start.
+    latency_tolerance:
+        Request slower per unit of size than this multiple of the baseline latency is
+        a sign of overload.
+    decrease_factor:
+        Multiplier of the limit on overload or error.
+    """
+
+    name: str
+    min_concurrency: int = 1
+    max_concurrency: int = 8
+    initial_concurrency: int = 2
+    latency_tolerance: float = 2.0
+    decrease_factor: float = 0.7
+
+    def __post_init__(self) -> None:
+        self.limit = float(self.initial_concurrency)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+        self.recent_latencies: deque[float] = deque(maxlen=50)
+        self.latencies: list[float] = []
+        self.completed = 0
+        self.errors = 0
+        self.retried = 0
+        self.busy_since: float | None = None
+        self.busy_time = 0.0
+
+    def acquire(self) -> None:
+        """Blocks until a request fits under the current limit."""
+
+        with self.condition:
+            while self.in_flight >= max(1, int(self.limit)):
+                self.condition.wait()
+            if self.in_flight == 0:
+                self.busy_since = time.monotonic()
+            self.in_flight += 1
+
+    def release(self, latency: float, failed: bool, size: float = 1.0) -> None:
+        """
+        Frees the slot of a finished request and adapts the limit. `size` is the
+        amount of work in the request, e.g. the number of packed chunks.
+        """
+
+        with self.condition:
+            self.in_flight -= 1
+            if self.in_flight == 0 and self.busy_since is not None:
+                self.busy_time += time.monotonic() - self.busy_since
+                self.busy_since = None
+
+            if failed:
+                self.errors += 1
+                self.decrease()
+            else:
+                self.completed += 1
+                self.latencies.append(latency)
+
+                unit_latency = latency / max(size, 1e-9)
+                self.recent_latencies.append(unit_latency)
+
+                baseline = min(self.recent_latencies)
+                if unit_latency > self.latency_tolerance * baseline:
+                    self.decrease()
+                else:
+                    self.limit = min(
+                        float(self.max_concurrency), self.limit + 1 / self.limit
+                    )
+
+            self.condition.notify_all()
+
+    def decrease(self) -> None:
+        self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+
+    def report(self) -> dict[str, Any]:
+        with self.condition:
+            latencies = sorted(self.latencies)
+            busy_time = self.busy_time
+            if self.busy_since is not None:
+                busy_time += time.monotonic() - self.busy_since
+
+            return {
+                "lane": self.name,
+                "completed": self.completed,
+                "errors": self.errors,
+                "retried": self.retried,
+                "items_per_second": self.completed / busy_time if busy_time else 0.0,
+                "latency_mean": statistics.fmean(latencies) if latencies else 0.0,
+                "latency_p50": percentile(latencies, 0.5),
+                "latency_p95": percentile(latencies, 0.95),
+                "concurrency_limit": int(self.limit),
+            }
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def default_lanes() -> dict[str, Lane]:
+    return {
+        IMAGE_LANE: Lane(name=IMAGE_LANE, max_concurrency=4, initial_concurrency=1),
+        TEXT_LANE: Lane(name=TEXT_LANE, max_concurrency=8, initial_concurrency=2),
+    }
+
+
+@dataclass
+class Scheduler:
+    """
+    Runs calls to a shared LLM backend in lanes with adaptive concurrency limits.
+    New requests are started only when the lane has room, so a slow backend applies
+    backpressure instead of accumulating queued requests. Transient failures are
+    retried with exponential backoff and full jitter.
+
+    Attributes:
+    lanes:
+        Lanes by name, e.g. slow multimodal image requests and text requests.
+    max_retries:
+        Maximum number of retries of a failed call.
+    backoff_base:
+        Base of the exponential backoff in seconds.
+    backoff_max:
+        Upper bound of a single backoff in seconds.
+    """
+
+    lanes: dict[str, Lane] = field(default_factory=default_lanes)
+    max_retries: int = 3
+    backoff_base: float = 1.0
+    backoff_max: float = 30.0
+
+    def map(
+        self,
+        lane_name: str,
+        fn: Callable[[T], R],
+        items: list[T],
+        size: Callable[[T], float] | None = None,
+    ) -> list[R]:
+        """
+        Calls `fn` on every item in the lane and returns the results in order.
+        `size` gives the amount of work of an item, latencies of the lane are
+        normalized by it.
+        """
+
+        if len(items) == 0:
+            return []
+
+        lane = self.lanes[lane_name]
+
+        with ThreadPoolExecutor(max_workers=lane.max_concurrency) as executor:
+            futures = []
+            for item in items:
+                lane.acquire()
+                futures.append(
+                    executor.submit(
+                        self.call, lane, fn, item, 1.0 if size is None else size(item)
+                    )
+                )
+            results = [f.result() for f in futures]
+
+        logger.info(format_report(lane.report()))
+
+        return results
+
+    def call(self, lane: Lane, fn: Callable[[T], R], item: T, size: float = 1.0) -> R:
+        """Calls `fn` holding an already acquired slot of the lane."""
+
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                result = fn(item)
+            except Exception as e:
+                lane.release(time.monotonic() - start, failed=True, size=size)
+                if attempt >= self.max_retries or not is_transient(e):
+                    raise
+
+                delay = random.uniform(
+                    0, min(self.backoff_max, self.backoff_base * 2**attempt)
+                )
+                logger.warning(
+                    f"Retrying request in lane {lane.name} in {delay:.1f}s after: {e}"
+                )
+                with lane.condition:
+                    lane.retried += 1
+                time.sleep(delay)
+
+                attempt += 1
+                lane.acquire()
+                continue
+
+            lane.release(time.monotonic() - start, failed=False, size=size)
+            return result
+
+    def report(self) -> list[dict[str, Any]]:
+        return [lane.report() for lane in self.lanes.values()]
+
+
+def format_report(report: dict[str, Any]) -> str:
+    return (
+        f"Lane {report['lane']}: {report['completed']} done, {report['errors']} errors, "
+        f"{report['items_per_second']:.2f} items/s, latency mean {report['latency_mean']:.2f}s "
+        f"p50 {report['latency_p50']:.2f}s p95 {report['latency_p95']:.2f}s, "
+        f"concurrency limit {report['concurrency_limit']}."
+    )
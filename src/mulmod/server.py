@@ -0,0 +1,371 @@
+import asyncio
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any
+
+from mulmod.img import ImagePayloadStore
+from mulmod.logger import get_logger
+from mulmod.retrieve.rag import Rag
+from mulmod.retrieve.retriever import Retriever
+
+logger = get_logger(__name__)
+
+MAX_BODY_BYTES = 1 << 20
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class Session:
+    """
+    Conversation of a single client.
+
+    Attributes:
+    rag:
+        Rag holding the conversation memory.
+    last_used:
+        Monotonic time of the last request of the session.
+    """
+
+    rag: Rag
+    last_used: float = field(default_factory=time.monotonic)
+
+    def __post_init__(self) -> None:
+        # answers of one conversation are generated one after another
+        self.lock = asyncio.Lock()
+
+
+@dataclass
+class QueryServer:
+    """
+    HTTP server answering queries of concurrent clients over an index loaded once.
+    It is a plain asyncio server without dependencies and its endpoints are:
+
+    - `POST /retrieve` with `{"query": ..., "sources": [...], "treshold": ...}`
+      returns the relevant documents as json.
+    - `POST /answer` with `{"query": ..., "session_id": ..., "sources": [...]}`
+      streams the answer as chunked plain text. The id of the session is in the
+      `X-Session-Id` header of the response, a request without it starts a new
+      conversation. A client which disconnects cancels its answer. An error after
+      the answer started streaming is reported in the `X-Error` trailer.
+    - `GET /health` returns the number of sessions, hit rates of the query cache and
+      the numbers of chunks the last update of the index changed per source file.
+
+    Embedding of the queries, vector search and encoding of the images run in a
+    thread pool, so the event loop only moves bytes. Sessions idle for longer than
+    `session_ttl_s` are evicted, and so are the least recently used ones when there
+    are more than `max_sessions`. A new session is refused with 503 when all of them
+    are answering.
+
+    Attributes:
+    retriever:
+        Retriever over the prebuilt index.
+    host:
+        Interface the server listens on.
+    port:
+        Port the server listens on.
+    num_workers:
+        Number of threads running the retrievals.
+    session_ttl_s:
+        Seconds after which an idle session is evicted.
+    max_sessions:
+        Maximum number of kept sessions.
+    model:
+        Name of the Ollama model answering the queries.
+    payloads:
+        Store of the image payloads shared by the sessions.
+    reuse_port:
+        Whether to listen with SO_REUSEPORT, so several server processes share
+        the port.
+    """
+
+    retriever: Retriever
+    host: str = "127.0.0.1"
+    port: int = 8000
+    num_workers: int = 8
+    session_ttl_s: float = 1800
+    max_sessions: int = 256
+    model: str = "llava"
+    payloads: ImagePayloadStore = field(
+        default_factory=lambda: ImagePayloadStore(cache_dir=None)
+    )
+    reuse_port: bool = False
+
+    def __post_init__(self) -> None:
+        self.sessions: dict[str, Session] = {}
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.num_workers, thread_name_prefix="query"
+        )
+
+    async def serve(self) -> None:
+        loop = asyncio.get_running_loop()
+        # the retrievals of Rag run in asyncio.to_thread, which uses this pool
+        loop.set_default_executor(self.executor)
+
+        # the first session does not pay for loading the model
+        Rag(model=self.model, payloads=self.payloads).warm_up()
+
+        server = await asyncio.start_server(
+            self.handle, self.host, self.port, reuse_port=self.reuse_port
+        )
+        evictor = asyncio.create_task(self.evict_idle())
+        logger.info(f"Serving queries on http://{self.host}:{self.port}.")
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            evictor.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            logger.info("Server stopped.")
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            method, path, body = await read_request(reader)
+            if path == "/health" and method == "GET":
+                await send_json(writer, 200, self.health())
+            elif path == "/retrieve" and method == "POST":
+                await send_json(writer, 200, await self.retrieve(parse_json(body)))
+            elif path == "/answer" and method == "POST":
+                await self.answer(writer, parse_json(body))
+            elif path in ("/health", "/retrieve", "/answer"):
+                raise HttpError(405, f"Method {method} is not allowed on {path}.")
+            else:
+                raise HttpError(404, f"Unknown path {path}.")
+        except HttpError as e:
+            await send_json(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            logger.exception("Request failed.")
+            try:
+                await send_json(writer, 500, {"error": "Internal server error."})
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def health(self) -> dict[str, Any]:
+        cache = self.retriever.query_cache
+        return {
+            "sessions": len(self.sessions),
+            "query_cache": cache.stats() if cache is not None else None,
+            "index_updates": self.retriever.updates,
+        }
+
+    async def retrieve(self, request: dict[str, Any]) -> dict[str, Any]:
+        query = require_query(request)
+        try:
+            treshold = float(request.get("treshold", 1.0))
+        except (TypeError, ValueError):
+            raise HttpError(400, "Treshold has to be a number.")
+
+        retrieved = await asyncio.to_thread(
+            self.retriever.retrieve, query, treshold, request.get("sources")
+        )
+
+        return {
+            "results": [
+                {
+                    "content": doc.page_content,
+                    "metadata": doc.metadata,
+                    "score": float(score),
+                }
+                for doc, score in retrieved
+            ]
+        }
+
+    async def answer(
+        self, writer: asyncio.StreamWriter, request: dict[str, Any]
+    ) -> None:
+        query = require_query(request)
+        session_id, session = self.get_session(request.get("session_id"))
+
+        async with session.lock:
+            session.last_used = time.monotonic()
+            cancel = asyncio.Event()
+            stream = session.rag.astream_answer(
+                query, self.retriever, cancel, request.get("sources")
+            )
+            head_sent = False
+            try:
+                # the retrieval runs until the first token, so its errors are still
+                # answered by a status
+                token = await anext(stream, None)
+                writer.write(
+                    response_head(
+                        200,
+                        {
+                            "Content-Type": "text/plain; charset=utf-8",
+                            "Transfer-Encoding": "chunked",
+                            "Trailer": "X-Error",
+                            "X-Session-Id": session_id,
+                        },
+                    )
+                )
+                head_sent = True
+                while token is not None:
+                    data = token.encode("utf-8")
+                    if data:
+                        writer.write(b"%X\r\n%s\r\n" % (len(data), data))
+                        await writer.drain()
+                    token = await anext(stream, None)
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+            except ConnectionError:
+                cancel.set()
+                logger.info(f"Client of session {session_id} disconnected.")
+            except Exception:
+                if not head_sent:
+                    raise
+                # the status is sent already, the error ends the chunked body
+                logger.exception(f"Answer of session {session_id} failed.")
+                writer.write(b"0\r\nX-Error: Internal server error.\r\n\r\n")
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+            finally:
+                await stream.aclose()
+                session.last_used = time.monotonic()
+
+    def get_session(self, session_id: str | None) -> tuple[str, Session]:
+        if session_id is not None and session_id in self.sessions:
+            return session_id, self.sessions[session_id]
+
+        if len(self.sessions) >= self.max_sessions and self.evict(1) == 0:
+            raise HttpError(503, "All sessions are answering, try again later.")
+
+        session_id = uuid.uuid4().hex
+        self.sessions[session_id] = Session(
+            rag=Rag(model=self.model, payloads=self.payloads)
+        )
+        logger.info(f"Started session {session_id}, {len(self.sessions)} sessions.")
+
+        return session_id, self.sessions[session_id]
+
+    def evict(self, count: int) -> int:
+        """
+        Evicts the least recently used sessions which are not answering and returns
+        how many of them were evicted.
+        """
+
+        idle = sorted(
+            (s.last_used, i) for i, s in self.sessions.items() if not s.lock.locked()
+        )
+        for _, session_id in idle[:count]:
+            del self.sessions[session_id]
+        return len(idle[:count])
+
+    async def evict_idle(self) -> None:
+        while True:
+            await asyncio.sleep(max(1.0, self.session_ttl_s / 4))
+
+            now = time.monotonic()
+            expired = [
+                i
+                for i, s in self.sessions.items()
+                if now - s.last_used > self.session_ttl_s and not s.lock.locked()
+            ]
+            for session_id in expired:
+                del self.sessions[session_id]
+            if expired:
+                logger.info(
+                    f"Evicted {len(expired)} idle sessions, {len(self.sessions)} left."
+                )
+
+
+async def read_request(reader: asyncio.StreamReader) -> tuple[str, str, bytes]:
+    """Reads method, path and body of a HTTP/1.1 request."""
+
+    request_line = await reader.readline()
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise HttpError(400, "Malformed request line.")
+    method, target, _ = parts
+
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length.")
+    if length > MAX_BODY_BYTES:
+        raise HttpError(413, f"Request body is larger than {MAX_BODY_BYTES} bytes.")
+
+    body = await reader.readexactly(length) if length else b""
+
+    return method, target.split("?", 1)[0], body
+
+
+def parse_json(body: bytes) -> dict[str, Any]:
+    try:
+        data = json.loads(body or b"{}")
+    except ValueError:
+        raise HttpError(400, "Request body is not valid json.")
+    if not isinstance(data, dict):
+        raise HttpError(400, "Request body has to be a json object.")
+    return data
+
+
+def require_query(request: dict[str, Any]) -> str:
+    query = request.get("query")
+    if not isinstance(query, str) or not query.strip():
+        raise HttpError(400, "Missing query.")
+
+    sources = request.get("sources")
+    if sources is not None and not (
+        isinstance(sources, list) and all(isinstance(s, str) for s in sources)
+    ):
+        raise HttpError(400, "Sources have to be a list of file paths.")
+
+    return query
+
+
+def response_head(status: int, headers: dict[str, str]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {REASONS[status]}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer: asyncio.StreamWriter, status: int, data: Any) -> None:
+    body = json.dumps(data).encode("utf-8")
+    writer.write(
+        response_head(
+            status,
+            {"Content-Type": "application/json", "Content-Length": str(len(body))},
+        )
+        + body
+    )
+    await writer.drain()
@@ -1,7 +1,10 @@
-from dataclasses import dataclass
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from typing import Any
 
-from langchain_community.chat_models import ChatOllama
 from langchain_core.messages import HumanMessage
 from langchain_core.messages.base import BaseMessage
 from langchain_core.output_parsers import StrOutputParser
@@ -9,9 +12,16 @@ from langchain_core.prompts import (
     HumanMessagePromptTemplate,
     SystemMessagePromptTemplate,
 )
+from langchain_core.runnables import Runnable
 
+from mulmod.cache import TieredCache, hash_file, hash_params
 from mulmod.extract import Extraction, ExtractionType
-from mulmod.img import get_img_base64
+from mulmod.img import ImagePayloadStore
+from mulmod.llm import KEEP_ALIVE, NUM_CTX, LlmTimings, OllamaChat, estimate_tokens
+from mulmod.logger import get_logger
+from mulmod.scheduler import IMAGE_LANE, TEXT_LANE, Scheduler
+
+logger = get_logger(__name__)
 
 SUMMARY_PROMPT_TEXT = """In the context of machine learning, summarize the following text \
 chunk in {num_words} words, highlighting the most important information which can be \
@@ -24,6 +34,12 @@ Table: {extraction_content}"""
 SUMMARY_PROMPT_IMAGE = """In the context of machine learning, summarize the following image in \
 {num_words} words, highlighting the most important information which can be extracted from it."""
 
+SUMMARY_PROMPT_PACKED = """In the context of machine learning, summarize each of the following \
+numbered text chunks and tables in {num_words} words, highlighting the most important information \
+which can be extracted from it. Answer with a JSON object with key "summaries" holding a list of \
+objects with keys "id" (the number of the chunk) and "summary", one for every chunk. \
+Chunks: {extraction_content}"""
+
 SYSTEM_PROMPT = """In the field of machine learning and large language models, you excel at \
 summarizing research papers. You can analyze text excerpts, tables, or images and extract the \
 key points in a clear and concise way."""
@@ -51,6 +67,32 @@ class Summarizer:
         Name of the LLM model to be used for summarization from Ollama.
     num_words: 
         Target number of words for the generated summary.
+    num_predict:
+        Maximum number of tokens generated for a summary.
+    cache:
+        Cache of already generated summaries.
+    scheduler:
+        Scheduler of the LLM requests, can be shared between summarizers using the
+        same backend.
+    packed_prompt:
+        Prompt template for summarizing several texts and tables in one request.
+    pack_texts:
+        Whether to pack several texts and tables into one request. Chunks whose
+        summary can not be parsed from the answer are summarized one by one.
+    pack_token_budget:
+        Estimated number of prompt tokens of a packed request.
+    pack_max_chunks:
+        Maximum number of chunks in a packed request.
+    payloads:
+        Store of downscaled and encoded images, can be shared with `Rag`.
+    num_ctx:
+        Context size of the model, it must fit the packed prompt with the answer.
+        Requests with another context size make Ollama reload the model.
+    keep_alive:
+        How long Ollama keeps the model loaded after a request.
+    timings:
+        Collector of prompt evaluation and generation times of the requests, can
+        be shared between summarizers.
     """
 
     text_prompt: str = SUMMARY_PROMPT_TEXT
@@ -60,6 +102,18 @@ class Summarizer:
     model: str = "llava"
     num_words: int = 100
     num_predict: int = 4000
+    cache: TieredCache | None = None
+    scheduler: Scheduler = field(default_factory=Scheduler)
+    packed_prompt: str = SUMMARY_PROMPT_PACKED
+    pack_texts: bool = False
+    pack_token_budget: int = 3000
+    pack_max_chunks: int = 10
+    payloads: ImagePayloadStore = field(
+        default_factory=lambda: ImagePayloadStore(cache_dir=None)
+    )
+    num_ctx: int = NUM_CTX
+    keep_alive: int | str | None = KEEP_ALIVE
+    timings: LlmTimings = field(default_factory=lambda: LlmTimings("Summaries"))
 
     def __post_init__(self) -> None:
         self.prompts: dict[ExtractionType, str] = {
@@ -68,20 +122,209 @@ class Summarizer:
             ExtractionType.IMAGE: self.image_prompt,
         }
 
+    def cache_params(self, types: list[ExtractionType] | None = None) -> dict[str, Any]:
+        """
+        Parameters which influence the generated summaries of the extraction types,
+        of all of them by default. Images are never packed.
+        """
+
+        if types is None:
+            types = list(ExtractionType)
+        packed = self.pack_texts and any(t != ExtractionType.IMAGE for t in types)
+
+        return {
+            "prompts": {t.name: self.prompts[t] for t in types},
+            "system_prompt": self.system_prompt,
+            "model": self.model,
+            "num_words": self.num_words,
+            "num_predict": self.num_predict,
+            "packed_prompt": self.packed_prompt if packed else None,
+            "image_payload": self.payloads.cache_params(),
+        }
+
     def get_summary(self, extractions: list[Extraction]) -> list[str]:
-        """Generates list of summaries. Simple zero-shot chain."""
+        """
+        Generates list of summaries. Simple zero-shot chain. With a cache only the
+        extractions which were not summarized before are sent to the LLM, repeated
+        extractions within the list are summarized once.
+        """
 
         if len(extractions) == 0:
             return []
 
-        llm = ChatOllama(model=self.model, num_predict=self.num_predict)
+        if self.cache is None:
+            return self.generate(extractions)
+
+        keys = [self.summary_key(e) for e in extractions]
+        summaries = [self.cache.get(k) for k in keys]
+
+        missing: dict[str, Extraction] = {}
+        for key, summary, extraction in zip(keys, summaries, extractions):
+            if summary is None:
+                missing.setdefault(key, extraction)
 
-        chain = self.get_prompt | llm | StrOutputParser()
+        generated = dict(zip(missing, self.generate(list(missing.values()))))
+        for key, summary in generated.items():
+            self.cache.put(key, summary)
 
-        summaries = chain.batch(extractions, {"max_concurrency": 5})
+        logger.info(
+            f"Summary cache hits {len(extractions) - len(missing)}, generated {len(missing)} summaries."
+        )
+
+        return [s if s is not None else generated[k] for k, s in zip(keys, summaries)]
+
+    def generate(self, extractions: list[Extraction]) -> list[str]:
+        if len(extractions) == 0:
+            return []
+
+        chain = self.get_prompt | self.get_llm() | StrOutputParser()
+
+        lanes: dict[str, list[int]] = {}
+        for i, extraction in enumerate(extractions):
+            lane = IMAGE_LANE if extraction.type == ExtractionType.IMAGE else TEXT_LANE
+            lanes.setdefault(lane, []).append(i)
+
+        summaries: list[str] = [""] * len(extractions)
+
+        # lanes have separate limits, so images and texts are summarized side by side
+        with ThreadPoolExecutor(max_workers=len(lanes)) as executor:
+            futures = {
+                lane: executor.submit(
+                    self.generate_lane,
+                    lane,
+                    chain,
+                    [extractions[i] for i in indices],
+                )
+                for lane, indices in lanes.items()
+            }
+            for lane, future in futures.items():
+                for i, summary in zip(lanes[lane], future.result()):
+                    summaries[i] = summary
 
         return summaries
 
+    def generate_lane(
+        self, lane: str, chain: Runnable, extractions: list[Extraction]
+    ) -> list[str]:
+        if lane == IMAGE_LANE or not self.pack_texts:
+            return self.scheduler.map(lane, chain.invoke, extractions)
+
+        packs = [p for p in self.pack(extractions) if len(p) > 1]
+
+        packed_chain = (
+            self.get_packed_prompt | self.get_llm(format="json") | StrOutputParser()
+        )
+
+        # packs and the single chunks share the lane, the latency is per chunk
+        answers = self.scheduler.map(
+            lane,
+            packed_chain.invoke,
+            [[extractions[i] for i in p] for p in packs],
+            size=len,
+        )
+
+        summaries: list[str | None] = [None] * len(extractions)
+        for pack, answer in zip(packs, answers):
+            for i, summary in zip(pack, parse_packed(answer, len(pack))):
+                summaries[i] = summary
+
+        fallback = [i for i, s in enumerate(summaries) if s is None]
+        logger.info(
+            f"Summarized {len(extractions) - len(fallback)} chunks in {len(packs)} packed requests, {len(fallback)} chunks one by one."
+        )
+
+        single = self.scheduler.map(
+            lane, chain.invoke, [extractions[i] for i in fallback]
+        )
+        for i, summary in zip(fallback, single):
+            summaries[i] = summary
+
+        return [s or "" for s in summaries]
+
+    def get_llm(self, **kwargs: Any) -> OllamaChat:
+        return OllamaChat(
+            model=self.model,
+            num_predict=self.num_predict,
+            num_ctx=self.num_ctx,
+            keep_alive=self.keep_alive,
+            callbacks=[self.timings],
+            **kwargs,
+        )
+
+    def warm_up(self) -> threading.Thread:
+        """Loads the model and evaluates the shared system prompt in the background."""
+
+        return self.get_llm().warm_up_in_background(self.system_prompt)
+
+    def pack(self, extractions: list[Extraction]) -> list[list[int]]:
+        """Greedily groups consecutive extractions into packs within the token budget."""
+
+        # the packed prompt and the answer with all summaries must fit the context
+        budget = min(
+            self.pack_token_budget, self.num_ctx - self.num_predict
+        ) - estimate_tokens(
+            self.system_prompt + self.packed_prompt
+        )
+
+        packs: list[list[int]] = []
+        current: list[int] = []
+        used = 0
+        for i, extraction in enumerate(extractions):
+            tokens = estimate_tokens(extraction.content)
+            if current and (
+                used + tokens > budget or len(current) == self.pack_max_chunks
+            ):
+                packs.append(current)
+                current = []
+                used = 0
+            current.append(i)
+            used += tokens
+
+        if current:
+            packs.append(current)
+
+        return packs
+
+    def get_packed_prompt(self, extractions: list[Extraction]) -> list[BaseMessage]:
+        """Creates message chat with system initialization and numbered chunks."""
+
+        chunks = "\n\n".join(
+            f"[{n}] {e.type.name.lower()}: {e.content}"
+            for n, e in enumerate(extractions, start=1)
+        )
+        temp_kwargs = {"extraction_content": chunks, "num_words": self.num_words}
+
+        system_temp = SystemMessagePromptTemplate.from_template(self.system_prompt)
+        human_temp = HumanMessagePromptTemplate.from_template(self.packed_prompt)
+
+        return [system_temp.format(**temp_kwargs), human_temp.format(**temp_kwargs)]
+
+    def summary_key(self, extraction: Extraction) -> str:
+        """Hash of everything which influences the summary of the extraction."""
+
+        if extraction.type == ExtractionType.IMAGE:
+            content = hash_params(
+                hash_file(extraction.content), self.payloads.cache_params()
+            )
+        else:
+            content = hashlib.sha256(extraction.content.encode("utf-8")).hexdigest()
+
+        return hash_params(
+            extraction.type.name,
+            content,
+            self.prompts[extraction.type],
+            self.system_prompt,
+            self.num_words,
+            self.model,
+            self.num_predict,
+            # images are never packed, packed and single summaries of them match
+            (
+                self.packed_prompt
+                if self.pack_texts and extraction.type != ExtractionType.IMAGE
+                else None
+            ),
+        )
+
     def get_prompt(self, extraction: Extraction) -> list[BaseMessage]:
         """Creates message chat with system initialization and query."""
 
@@ -107,7 +350,7 @@ class Summarizer:
             text = temp.format(**kwargs).content
 
             img_path = Summarizer.from_kwargs("extraction_content", **kwargs)
-            image_b64 = get_img_base64(img_path)
+            image_b64 = self.payloads.get_base64(img_path)
 
             image_part = {
                 "type": "image_url",
@@ -135,3 +378,40 @@ class Summarizer:
             return kwargs[kw]
         else:
             raise RuntimeError(f"Expected to have {kw} in {kwargs}")
+
+
+def parse_packed(answer: str, num_chunks: int) -> list[str | None]:
+    """
+    Parses summaries of numbered chunks from a packed answer. Summaries which are
+    missing or malformed are None.
+    """
+
+    summaries: list[str | None] = [None] * num_chunks
+
+    try:
+        data = json.loads(answer)
+    except json.JSONDecodeError:
+        return summaries
+
+    items = data.get("summaries") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        return summaries
+
+    for position, item in enumerate(items, start=1):
+        if isinstance(item, dict):
+            chunk_id, summary = item.get("id"), item.get("summary")
+        else:
+            chunk_id, summary = position, item
+
+        if isinstance(chunk_id, str) and chunk_id.strip().isdigit():
+            chunk_id = int(chunk_id)
+
+        if (
+            isinstance(chunk_id, int)
+            and 1 <= chunk_id <= num_chunks
+            and isinstance(summary, str)
+            and summary.strip()
+        ):
+            summaries[chunk_id - 1] = summary.strip()
+
+    return summaries
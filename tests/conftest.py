@@ -0,0 +1,25 @@
+import pytest
+from langchain_core.embeddings import Embeddings
+
+VOCABULARY = ["attention", "transformer", "image", "table", "loss", "gradient"]
+
+
+class KeywordEmbeddings(Embeddings):
+    """
+    Local stand-in of the embedding model. A text is embedded as counts of the words
+    of the vocabulary, so texts sharing words are similar and the nearest neighbours
+    of a query are known without GPT4All.
+    """
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        words = text.lower().split()
+        # the constant keeps texts without any of the words off the zero vector
+        return [words.count(w) + 0.01 for w in VOCABULARY]
+
+
+@pytest.fixture
+def embeddings() -> KeywordEmbeddings:
+    return KeywordEmbeddings()
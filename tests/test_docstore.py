@@ -0,0 +1,67 @@
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from mulmod.retrieve.docstore import SqliteDocStore
+
+
+def test_mset_mget_round_trip(tmp_path: Path) -> None:
+    store = SqliteDocStore(str(tmp_path / "docstore.sqlite"))
+    doc = Document(page_content="Attention is all you need.", metadata={"page": 1})
+    store.mset([("a", doc)])
+
+    assert store.mget(["a", "missing", "a"]) == [doc, None, doc]
+    assert len(store) == 1
+
+
+def test_documents_persist_across_instances(tmp_path: Path) -> None:
+    path = str(tmp_path / "docstore.sqlite")
+    store = SqliteDocStore(path)
+    store.mset([("a", Document(page_content="text"))])
+    store.close()
+
+    reopened = SqliteDocStore(path)
+    assert reopened.mget(["a"])[0].page_content == "text"
+    assert reopened.stats()["disk_hits"] == 1
+
+    reopened.mget(["a"])
+    assert reopened.stats()["memory_hits"] == 1
+
+
+def test_mset_replaces_remembered_document() -> None:
+    store = SqliteDocStore(max_items=1)
+    store.mset([("a", Document(page_content="old"))])
+    store.mget(["a"])
+    store.mset([("a", Document(page_content="new"))])
+
+    assert store.mget(["a"])[0].page_content == "new"
+
+
+def test_mdelete_and_yield_keys() -> None:
+    store = SqliteDocStore()
+    store.mset(
+        [(k, Document(page_content=k)) for k in ["img-1", "img-2", "txt-1", "im*g"]]
+    )
+    store.mget(["img-1"])
+    store.mdelete(["img-1", "missing"])
+
+    assert store.mget(["img-1"]) == [None]
+    assert sorted(store.yield_keys()) == ["im*g", "img-2", "txt-1"]
+    assert list(store.yield_keys("img")) == ["img-2"]
+    # glob characters of the prefix match literally
+    assert list(store.yield_keys("im*")) == ["im*g"]
+
+
+def test_ids_by_source() -> None:
+    store = SqliteDocStore()
+    store.mset(
+        [
+            ("a1", Document(page_content="", metadata={"source": "a.pdf"})),
+            ("a2", Document(page_content="", metadata={"source": "a.pdf"})),
+            ("b1", Document(page_content="", metadata={"source": "b.pdf"})),
+            ("none", Document(page_content="")),
+        ]
+    )
+    store.mdelete(["a2"])
+
+    assert store.ids_by_source() == {"a.pdf": {"a1"}, "b.pdf": {"b1"}}
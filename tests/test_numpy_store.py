@@ -0,0 +1,127 @@
+from pathlib import Path
+from typing import Any, Callable
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from mulmod.retrieve.numpy_store import NumpyVectorStore
+from mulmod.retrieve.quantized_store import BINARY, INT8, QuantizedVectorStore
+
+TEXTS = [
+    "attention attention transformer",
+    "image image table",
+    "loss gradient gradient",
+    "table table image",
+    "transformer attention loss",
+    "gradient loss loss",
+]
+IDS = [f"id{i}" for i in range(len(TEXTS))]
+METADATAS = [{"source": f"{i % 2}.pdf", "page": i} for i in range(len(TEXTS))]
+
+StoreFactory = Callable[..., NumpyVectorStore]
+
+
+def numpy_store(embeddings: Embeddings, **kwargs: Any) -> NumpyVectorStore:
+    return NumpyVectorStore(embeddings, **kwargs)
+
+
+def int8_store(embeddings: Embeddings, **kwargs: Any) -> NumpyVectorStore:
+    return QuantizedVectorStore(embeddings, quantization=INT8, **kwargs)
+
+
+def binary_store(embeddings: Embeddings, **kwargs: Any) -> NumpyVectorStore:
+    return QuantizedVectorStore(embeddings, quantization=BINARY, **kwargs)
+
+
+@pytest.fixture(params=[numpy_store, int8_store, binary_store])
+def make_store(request: pytest.FixtureRequest) -> StoreFactory:
+    return request.param
+
+
+def filled(
+    make_store: StoreFactory, embeddings: Embeddings, **kwargs: Any
+) -> NumpyVectorStore:
+    store = make_store(embeddings, initial_capacity=4, **kwargs)
+    store.add_texts(TEXTS, METADATAS, IDS)
+    return store
+
+
+def pages(documents: list[Document]) -> list[int]:
+    return [d.metadata["page"] for d in documents]
+
+
+def test_search_ranks_by_similarity(
+    make_store: StoreFactory, embeddings: Embeddings
+) -> None:
+    store = filled(make_store, embeddings)
+
+    results = store.similarity_search_with_score("attention transformer", k=2)
+
+    assert pages([d for d, _ in results]) == [0, 4]
+    assert results[0][0].page_content == TEXTS[0]
+    assert results[0][1] <= results[1][1]
+
+
+def test_search_with_filter(make_store: StoreFactory, embeddings: Embeddings) -> None:
+    store = filled(make_store, embeddings)
+
+    results = store.similarity_search("loss", k=2, filter={"source": "0.pdf"})
+    assert pages(results) == [4, 2]
+    # filters on keys which are not kept in memory scan the metadata on disk
+    results = store.similarity_search("image", k=3, filter={"page": {"$in": [1, 3]}})
+    assert sorted(pages(results)) == [1, 3]
+
+
+def test_delete_and_replace(make_store: StoreFactory, embeddings: Embeddings) -> None:
+    store = filled(make_store, embeddings)
+
+    store.delete(["id0", "missing"])
+    store.add_texts(["gradient"], [{"source": "0.pdf", "page": 10}], ["id4"])
+
+    results = store.similarity_search("attention transformer", k=6)
+    assert 0 not in pages(results)
+    assert 4 not in pages(results)
+    assert store.get(["id0", "id4"])["documents"] == ["gradient"]
+    assert len(store.get()["ids"]) == len(TEXTS) - 1
+
+
+def test_compacts_dead_rows(make_store: StoreFactory, embeddings: Embeddings) -> None:
+    store = filled(make_store, embeddings, compact_fraction=0.5)
+
+    store.delete(["id0", "id1"])
+    assert store.size == len(TEXTS)
+    store.delete(["id2"])
+    assert store.size == len(TEXTS) - 3
+
+    assert pages(store.similarity_search("table image", k=1)) == [3]
+    assert store.get()["ids"] == ["id3", "id4", "id5"]
+
+
+def test_persist_and_load(
+    make_store: StoreFactory, embeddings: Embeddings, tmp_path: Path
+) -> None:
+    store = filled(make_store, embeddings, persist_directory=str(tmp_path))
+    store.delete(["id1"])
+    store.persist()
+
+    loaded = make_store(embeddings, persist_directory=str(tmp_path))
+
+    # the deleted row was dropped on persist
+    assert loaded.size == len(TEXTS) - 1
+    for query in ["attention", "image table", "loss"]:
+        assert pages(loaded.similarity_search(query, k=3)) == pages(
+            store.similarity_search(query, k=3)
+        )
+    assert loaded.get(["id1", "id3"])["metadatas"] == [METADATAS[3]]
+
+
+def test_persist_without_directory_fails(embeddings: Embeddings) -> None:
+    with pytest.raises(RuntimeError):
+        NumpyVectorStore(embeddings).persist()
+
+
+def test_int8_recall(embeddings: Embeddings) -> None:
+    store = filled(int8_store, embeddings)
+
+    assert store.evaluate_recall(["attention", "table", "gradient loss"]) == 1.0
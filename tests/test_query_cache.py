@@ -0,0 +1,60 @@
+from langchain_core.documents import Document
+
+from mulmod.retrieve.query_cache import QueryCache
+
+RESULTS = [(Document(page_content="Attention is all you need."), 0.1)]
+
+
+def test_hit_by_normalized_query() -> None:
+    cache = QueryCache()
+    cache.put(QueryCache.key("What is attention?", k=3), 0, RESULTS)
+
+    assert cache.get(QueryCache.key("  what is   ATTENTION", k=3), 0) == RESULTS
+    assert cache.get(QueryCache.key("what is attention", k=4), 0) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_change_of_index_invalidates() -> None:
+    cache = QueryCache()
+    key = QueryCache.key("attention")
+    cache.put(key, 0, RESULTS)
+
+    assert cache.get(key, 1) is None
+    # the stale entry was dropped, it is not served for its own generation either
+    assert cache.get(key, 0) is None
+    assert cache.stats()["invalidated"] == 1
+    assert cache.stats()["items"] == 0
+
+
+def test_entries_expire() -> None:
+    cache = QueryCache(ttl_s=-1)
+    key = QueryCache.key("attention")
+    cache.put(key, 0, RESULTS)
+
+    assert cache.get(key, 0) is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_least_recently_used_is_evicted() -> None:
+    cache = QueryCache(max_items=2)
+    for query in ["a", "b"]:
+        cache.put(QueryCache.key(query), 0, RESULTS)
+    cache.get(QueryCache.key("a"), 0)
+    cache.put(QueryCache.key("c"), 0, RESULTS)
+
+    assert cache.get(QueryCache.key("a"), 0) == RESULTS
+    assert cache.get(QueryCache.key("b"), 0) is None
+
+
+def test_results_are_copied() -> None:
+    cache = QueryCache()
+    key = QueryCache.key("attention")
+    results = list(RESULTS)
+    cache.put(key, 0, results)
+    results.clear()
+
+    cached = cache.get(key, 0)
+    assert cached == RESULTS
+    cached.clear()
+    assert cache.get(key, 0) == RESULTS
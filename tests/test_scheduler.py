@@ -0,0 +1,238 @@
+import http.client
+import json
+import socket
+import threading
+import time
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mulmod.scheduler import Lane, Scheduler, is_transient
+
+
+class FakeBackend(ThreadingHTTPServer):
+    """
+    Local stand-in of the LLM backend. Answers the first `failures` requests with
+    `failure_status`, then echoes the prompt after `delay` seconds per packed item.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, failures: int = 0, failure_status: int = 503, delay: float = 0.0
+    ):
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+        self.failures = failures
+        self.failure_status = failure_status
+        self.delay = delay
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    server: FakeBackend
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+        with self.server.lock:
+            self.server.requests += 1
+            failed = self.server.requests <= self.server.failures
+
+        if failed:
+            self.send_response(self.server.failure_status)
+            self.end_headers()
+            return
+
+        time.sleep(self.server.delay * len(body["prompts"]))
+        data = json.dumps({"responses": body["prompts"]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def backend(request: pytest.FixtureRequest) -> Iterator[FakeBackend]:
+    server = FakeBackend(**getattr(request, "param", {}))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def generate(port: int, prompts: list[str]) -> list[str]:
+    """Client of the fake backend which reports errors like the Ollama client."""
+
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        connection.request("POST", "/api/generate", json.dumps({"prompts": prompts}))
+        response = connection.getresponse()
+        data = response.read()
+    finally:
+        connection.close()
+
+    if response.status != 200:
+        raise ValueError(
+            f"Ollama call failed with status code {response.status}. Details: {data!r}"
+        )
+    return json.loads(data)["responses"]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_is_transient() -> None:
+    assert is_transient(ConnectionRefusedError())
+    assert is_transient(TimeoutError())
+    assert is_transient(ValueError("Ollama call failed with status code 503."))
+    assert is_transient(ValueError("Ollama call failed with status code 429."))
+    assert not is_transient(ValueError("Ollama call failed with status code 404."))
+    assert not is_transient(ValueError("Invalid prompt."))
+    assert not is_transient(KeyError("responses"))
+
+
+@pytest.mark.parametrize(
+    "backend, transient",
+    [
+        ({"failures": 1, "failure_status": 500}, True),
+        ({"failures": 1, "failure_status": 400}, False),
+    ],
+    indirect=["backend"],
+)
+def test_is_transient_backend_errors(backend: FakeBackend, transient: bool) -> None:
+    with pytest.raises(ValueError) as error:
+        generate(backend.port, ["a"])
+    assert is_transient(error.value) == transient
+
+
+def test_is_transient_unreachable_backend() -> None:
+    with pytest.raises(OSError) as error:
+        generate(free_port(), ["a"])
+    assert is_transient(error.value)
+
+
+def test_lane_grows_on_fast_requests() -> None:
+    lane = Lane(name="test", initial_concurrency=1, max_concurrency=3)
+    for _ in range(20):
+        lane.acquire()
+        lane.release(0.1, failed=False)
+
+    assert lane.limit == 3
+    assert lane.completed == 20
+
+
+def test_lane_shrinks_on_errors_and_slow_requests() -> None:
+    lane = Lane(name="test", initial_concurrency=4, decrease_factor=0.5)
+
+    lane.acquire()
+    lane.release(0.1, failed=True)
+    assert lane.limit == 2
+    assert lane.errors == 1
+
+    lane.acquire()
+    lane.release(0.1, failed=False)
+    lane.acquire()
+    lane.release(1.0, failed=False)
+    assert lane.limit == pytest.approx(1.25)
+    assert lane.in_flight == 0
+
+
+def test_lane_normalizes_latency_by_size() -> None:
+    lane = Lane(name="test", initial_concurrency=4, max_concurrency=4)
+    lane.acquire()
+    lane.release(0.1, failed=False)
+
+    # a pack of ten chunks takes ten times longer without any congestion
+    for _ in range(5):
+        lane.acquire()
+        lane.release(1.0, failed=False, size=10)
+
+    assert lane.limit == 4
+
+
+def test_lane_blocks_above_limit() -> None:
+    lane = Lane(name="test", initial_concurrency=1)
+    lane.acquire()
+
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (lane.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    lane.release(0.1, failed=False)
+    assert acquired.wait(1)
+    thread.join()
+
+
+@pytest.mark.parametrize("backend", [{"failures": 2}], indirect=True)
+def test_map_retries_transient_errors(backend: FakeBackend) -> None:
+    scheduler = Scheduler(
+        lanes={"text": Lane(name="text", initial_concurrency=1)}, backoff_base=0.01
+    )
+
+    results = scheduler.map(
+        "text", lambda p: generate(backend.port, [p])[0], ["a", "b", "c"]
+    )
+
+    assert results == ["a", "b", "c"]
+    assert backend.requests == 5
+    report = scheduler.report()[0]
+    assert report["errors"] == 2
+    assert report["retried"] == 2
+    assert report["completed"] == 3
+
+
+@pytest.mark.parametrize(
+    "backend", [{"failures": 1, "failure_status": 400}], indirect=True
+)
+def test_map_does_not_retry_permanent_errors(backend: FakeBackend) -> None:
+    scheduler = Scheduler(
+        lanes={"text": Lane(name="text", initial_concurrency=1)}, backoff_base=0.01
+    )
+
+    with pytest.raises(ValueError, match="status code 400"):
+        scheduler.map("text", lambda p: generate(backend.port, [p])[0], ["a", "b"])
+
+    assert scheduler.lanes["text"].retried == 0
+
+
+@pytest.mark.parametrize("backend", [{"failures": 10}], indirect=True)
+def test_map_gives_up_after_max_retries(backend: FakeBackend) -> None:
+    scheduler = Scheduler(
+        lanes={"text": Lane(name="text", initial_concurrency=1)},
+        max_retries=2,
+        backoff_base=0.01,
+    )
+
+    with pytest.raises(ValueError, match="status code 503"):
+        scheduler.map("text", lambda p: generate(backend.port, [p])[0], ["a"])
+
+    assert backend.requests == 3
+
+
+@pytest.mark.parametrize("backend", [{"delay": 0.02}], indirect=True)
+def test_map_keeps_limit_with_packed_requests(backend: FakeBackend) -> None:
+    lane = Lane(name="text", initial_concurrency=2, max_concurrency=2)
+    scheduler = Scheduler(lanes={"text": lane})
+
+    items = [["a"], ["b", "c", "d", "e", "f", "g"], ["h"], ["i", "j", "k", "l", "m"]]
+    results = scheduler.map(
+        "text", lambda p: generate(backend.port, p), items, size=len
+    )
+
+    assert results == items
+    assert lane.limit == 2
+    assert lane.errors == 0
@@ -0,0 +1,123 @@
+from pathlib import Path
+
+import pytest
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from PIL import Image
+
+from mulmod.img import ImagePayloadStore
+from mulmod.retrieve.docstore import SqliteDocStore
+from mulmod.retrieve.numpy_store import NumpyVectorStore
+from mulmod.retrieve.snapshot import (
+    Snapshot,
+    SnapshotDocStore,
+    SnapshotPayloadStore,
+    SnapshotVectorStore,
+    write_snapshot,
+)
+
+KEYS = ["attention transformer", "image table", "loss gradient", "table"]
+
+
+@pytest.fixture
+def stores(
+    embeddings: Embeddings, tmp_path: Path
+) -> tuple[NumpyVectorStore, SqliteDocStore, ImagePayloadStore, str]:
+    img_path = str(tmp_path / "figure.png")
+    Image.new("RGB", (32, 16), (200, 30, 30)).save(img_path)
+
+    vectorstore = NumpyVectorStore(embeddings)
+    metadatas = [
+        {"source": f"{i % 2}.pdf", "page": i, "doc_id": f"doc{i}"}
+        for i in range(len(KEYS))
+    ]
+    vectorstore.add_texts(KEYS, metadatas, [f"id{i}" for i in range(len(KEYS))])
+    vectorstore.delete(["id3"])
+
+    docstore = SqliteDocStore()
+    docstore.mset(
+        [
+            ("doc0", Document(page_content="Attention is all you need.")),
+            ("doc1", Document(page_content="", metadata={"img_path": img_path})),
+            ("doc2", Document(page_content="Loss curves.")),
+        ]
+    )
+
+    return vectorstore, docstore, ImagePayloadStore(cache_dir=None), img_path
+
+
+def test_round_trip(
+    stores: tuple[NumpyVectorStore, SqliteDocStore, ImagePayloadStore, str],
+    embeddings: Embeddings,
+    tmp_path: Path,
+) -> None:
+    vectorstore, docstore, payloads, img_path = stores
+    path = str(tmp_path / "index.mmsnap")
+
+    write_snapshot(path, vectorstore, docstore, payloads, {"backend": "numpy"})
+    snapshot = Snapshot(path)
+
+    assert snapshot.size == 3
+    assert snapshot.dim == 6
+    assert snapshot.params == {"backend": "numpy"}
+    assert "id1" in snapshot.row_ids
+    assert "id3" not in snapshot.row_ids
+
+    snapshot_docstore = SnapshotDocStore(snapshot)
+    assert snapshot_docstore.mget(["doc0", "missing"]) == [
+        docstore.mget(["doc0"])[0],
+        None,
+    ]
+    assert sorted(snapshot_docstore.yield_keys("doc")) == ["doc0", "doc1", "doc2"]
+
+    snapshot_payloads = SnapshotPayloadStore(cache_dir=None, snapshot=snapshot)
+    assert snapshot_payloads.get_base64(img_path) == payloads.get_base64(img_path)
+
+    snapshot_vectorstore = SnapshotVectorStore(snapshot, embeddings)
+    for query in ["attention", "table image", "gradient"]:
+        expected = vectorstore.similarity_search_with_score(query, k=2)
+        assert snapshot_vectorstore.similarity_search_with_score(query, k=2) == [
+            (d, pytest.approx(s, abs=1e-6)) for d, s in expected
+        ]
+    results = snapshot_vectorstore.similarity_search(
+        "attention", k=3, filter={"source": "1.pdf"}
+    )
+    assert [d.metadata["page"] for d in results] == [1]
+
+
+def test_snapshot_is_read_only(
+    stores: tuple[NumpyVectorStore, SqliteDocStore, ImagePayloadStore, str],
+    embeddings: Embeddings,
+    tmp_path: Path,
+) -> None:
+    vectorstore, docstore, payloads, _ = stores
+    path = str(tmp_path / "index.mmsnap")
+    write_snapshot(path, vectorstore, docstore, payloads, {})
+    snapshot = Snapshot(path)
+
+    with pytest.raises(RuntimeError, match="read-only"):
+        SnapshotVectorStore(snapshot, embeddings).add_texts(["text"])
+    with pytest.raises(RuntimeError, match="read-only"):
+        SnapshotDocStore(snapshot).mdelete(["doc0"])
+
+
+def test_empty_index_is_not_exported(embeddings: Embeddings, tmp_path: Path) -> None:
+    path = tmp_path / "index.mmsnap"
+
+    with pytest.raises(ValueError):
+        write_snapshot(
+            str(path),
+            NumpyVectorStore(embeddings),
+            SqliteDocStore(),
+            ImagePayloadStore(cache_dir=None),
+            {},
+        )
+    assert not path.exists()
+
+
+def test_partial_file_is_refused(tmp_path: Path) -> None:
+    path = tmp_path / "index.mmsnap"
+    path.write_bytes(b"MMSNAP01" + bytes(64))
+
+    with pytest.raises(ValueError, match="not an index snapshot"):
+        Snapshot(str(path))